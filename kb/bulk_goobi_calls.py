@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+import sys
+import shlex
+import configparser
+from optparse import OptionParser
+
+from goobi.goobi_communicate import GoobiCommunicate, BULK_WORKERS
+
+def main():
+	'''
+	Make Goobi calls for many processes, e.g. set a property or close a
+	step for all processes of a mass reprocessing. Each line of the input
+	file (or stdin) is a process id, a command and its arguments:
+
+		123 addProperty name=image_count value=42 overwrite=true
+		124 closeStep step_id=5678
+		125 addToProcessLog level=info "message=Reprocessed by maintenance"
+
+	The calls are made a few at a time (see --workers), and the result of
+	each is printed. Exit code is 1 if any call failed.
+	'''
+	options = getOptions()
+	calls = readCalls(options.calls_file)
+	config = configparser.RawConfigParser()
+	config.read(options.settings)
+	com = GoobiCommunicate(config.get('goobi', 'host'),
+						   config.get('goobi', 'passcode'))
+	results = com.bulk(calls, max_workers=options.workers)
+	failed = 0
+	for result in results:
+		if result['ok']:
+			status = 'OK'
+		else:
+			status = 'FAILED: {0}'.format(result['error'])
+			failed += 1
+		print('{0} {1} {2}'.format(result['process_id'], result['command'], status))
+	print('{0} calls, {1} failed.'.format(len(results), failed))
+	sys.exit(1 if failed else 0)
+
+def readCalls(calls_file):
+	'''
+	Return (process_id, command, args) of each line of calls_file
+	'''
+	calls = []
+	input_file = open(calls_file) if calls_file else sys.stdin
+	try:
+		for line in input_file:
+			parts = shlex.split(line, comments=True)
+			if not parts: continue
+			if len(parts) < 2:
+				raise ValueError('Line without command: {0}'.format(line.strip()))
+			args = {}
+			for arg in parts[2:]:
+				name, _, value = arg.partition('=')
+				if value.lower() in ('true', 'false'):
+					value = (value.lower() == 'true')
+				args[name] = value
+			calls.append((parts[0], parts[1], args))
+	finally:
+		if calls_file: input_file.close()
+	return calls
+
+def getOptions():
+	parser=OptionParser()
+	parser.add_option('-c', '--settings', dest='settings',
+		default='/opt/digiverso/goobi/scripts/kb/workflows/system/config.ini',
+		help='The system config file with the goobi section (host and passcode).')
+	parser.add_option('-f', '--file', dest='calls_file',
+		help='File with a call per line. If not specified, calls are read from stdin.')
+	parser.add_option('-w', '--workers', dest='workers', type='int', default=BULK_WORKERS,
+		help='Number of calls made at the same time.')
+	(options, args) = parser.parse_args()
+	return options
+
+if __name__ == '__main__':
+	main()
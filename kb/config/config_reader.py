@@ -1,7 +1,26 @@
 #!/usr/bin/env python
 # -*- coding: utf-8
-import configparser
-import codecs
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import types
+
+from tools.lazy_import import lazy_module
+
+# Only needed when a config file is not in the cache
+configparser = lazy_module('configparser')
+
+# Merged configurations are cached here as json, keyed by path, mtime and size
+# of each config file, so a step only parses its config files when they change.
+# The configs hold passwords, so the cache is per user and only readable by it.
+CACHE_DIR = os.environ.get('GOOBI_CONFIG_CACHE',
+						   os.path.join(tempfile.gettempdir(),
+										'goobi_config_cache_{0}'.format(os.getuid())))
+
+# Configurations already loaded in this process, key -> sections
+_loaded = {}
 
 
 class ConfigSection:
@@ -11,7 +30,7 @@ class ConfigSection:
 class ConfigReader:
 	'''
 		Easy access config values. This reads in the configuration values and creates attributes for each. Spaces in names are replaced with underscores
-		
+
 		e.g.:
 			config.ini :
 				[my section]
@@ -20,49 +39,147 @@ class ConfigReader:
 			read.py :
 				c = ConfigReader( "config.ini" )
 				print(c.my_section.myname # output string "my value")
+
+		Sections of old_config not in filename are added to the new config (or
+		replace them with overwrite_sections), so a workflow config can be read
+		on top of the system config. The merged values are kept in read-only
+		dicts (self.sections), and cached on disk (see CACHE_DIR).
 	'''
-	
+
 	def __init__(self, filename, old_config=None,overwrite_sections=False,
 				 overwrite_options=False):
-		settings = configparser.ConfigParser()
-		settings.readfp( codecs.open( filename, encoding="utf-8", mode="rb") )
+		st = os.stat(filename)
+		self.key = [[os.path.abspath(filename), st.st_mtime_ns, st.st_size,
+					 overwrite_sections, overwrite_options]]
 		if old_config:
-			old_config = old_config.config
-			for section in old_config.sections():
-				if overwrite_sections and settings.has_section(section):
-					continue
-				settings.add_section(section)
-				for name, value in old_config.items( section ):
-					if overwrite_options and settings.has_option(section, name):
-						continue
-					settings.set(section, name, value)
-		self.config = settings
-		
-		for section in settings.sections() :
+			self.key = old_config.key + self.key
+		sections = _load_cached(self.key)
+		if sections is None:
+			sections = _parse(filename)
+			if old_config:
+				sections = _merge(sections, old_config.sections,
+								  overwrite_sections, overwrite_options)
+			_store_cached(self.key, sections)
+		self.sections = types.MappingProxyType(
+			dict((name, types.MappingProxyType(items))
+				 for name, items in sections.items()))
+		self._config = None
+
+		for section, items in self.sections.items() :
 			section_name = section.replace( " ", "_" )
 			new_section = ConfigSection()
 			vars(self) [section_name] = new_section
-			
-			for name, value in settings.items( section ):
+
+			for name, value in items.items():
 				if value.lower() == "true" :
 					vars( new_section )[name] =  True
 				elif value.lower() == "false" :
 					vars( new_section )[name] =  False
 				else :
 					vars( new_section )[name] =  value
-					
+
+	@property
+	def config(self):
+		'''
+		The configuration as a ConfigParser, for code using it directly.
+		'''
+		if self._config is None:
+			settings = configparser.ConfigParser(interpolation=None)
+			settings.read_dict(self.sections)
+			self._config = settings
+		return self._config
+
 	def hasSection( self, section_name ):
-		return section_name in self.config.sections()
-	
+		return section_name in self.sections
+
 	def hasItem( self, section_name, item_name ):
-		return section_name in self.config.sections() and item_name in [n for n,_ in self.config.items(section_name)]
-		
+		section = self.sections.get(section_name)
+		return section is not None and item_name in section
+
 	def item( self, section_name, item_name ):
 		item = None
 		if self.hasItem( section_name, item_name ):
-			item = vars( vars(self)[section_name] )[item_name]
+			item = vars( vars(self)[section_name.replace(" ", "_")] )[item_name]
 		return item
-		
+
+	def section( self, section_name ):
+		'''
+		Return the items of a section as a dict of strings or None.
+		'''
+		section = self.sections.get(section_name)
+		return None if section is None else dict(section)
+
+def _parse(filename):
+	settings = configparser.ConfigParser()
+	with open(filename, encoding="utf-8") as config_file:
+		settings.read_file(config_file)
+	return dict((section, dict(settings.items(section)))
+				for section in settings.sections())
+
+def _merge(sections, old_sections, overwrite_sections, overwrite_options):
+	'''
+	Add the sections of old_sections to sections (from the new file).
+	'''
+	merged = dict(sections)
+	for section, items in old_sections.items():
+		if section in sections:
+			if overwrite_sections:
+				continue
+			raise configparser.DuplicateSectionError(section)
+		merged[section] = dict(items)
+	return merged
+
+def _cache_path(key_text):
+	name = hashlib.sha1(key_text.encode('utf-8')).hexdigest() + '.json'
+	return os.path.join(CACHE_DIR, name)
+
+def _load_cached(key):
+	key_text = json.dumps(key)
+	if key_text in _loaded:
+		return _loaded[key_text]
+	try:
+		fd = os.open(_cache_path(key_text), os.O_RDONLY | os.O_NOFOLLOW)
+		with open(fd, encoding="utf-8") as cache_file:
+			if not _private(os.fstat(fd)):
+				# Not written by this user - don't take config values from it
+				return None
+			cached = json.load(cache_file)
+		if cached['key'] != key:
+			return None
+		_loaded[key_text] = cached['sections']
+		return cached['sections']
+	except (OSError, ValueError, KeyError, TypeError):
+		return None
+
+def _store_cached(key, sections):
+	key_text = json.dumps(key)
+	_loaded[key_text] = sections
+	path = _cache_path(key_text)
+	tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+	try:
+		if not os.path.exists(CACHE_DIR):
+			os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+		if not _private(os.lstat(CACHE_DIR), 0o077):
+			# E.g. made by another user - others could read or replace the files
+			return
+		fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW,
+					 0o600)
+		with open(fd, 'w', encoding="utf-8") as cache_file:
+			json.dump({'key': key, 'sections': sections}, cache_file)
+		os.replace(tmp_path, path)
+	except OSError:
+		# The cache is only a shortcut - the config is read from its files
+		pass
+
+def _private(file_stat, mode_mask=0o077):
+	'''
+	Return True if the file or folder of file_stat is owned by this user, is 
+	not a symlink and has none of the permissions in mode_mask.
+	'''
+	return (file_stat.st_uid == os.getuid() and
+			not stat.S_ISLNK(file_stat.st_mode) and
+			not file_stat.st_mode & mode_mask)
+
 if __name__ == '__main__' :
 
 	c = ConfigReader( "../config.ini" )
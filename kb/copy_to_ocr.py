@@ -86,36 +86,48 @@ class CopyToOcr(Step):
         self.expected_image_count = len(img_list)-2
 
     def waitForPreprocessedImages(self):
-        retry = 0
-        while retry <= self.pp_retry_num:
-            # ==================================================================
-            # Get current number of preprocessed images
-            # ==================================================================
-            pp_files = fs.getFilesInFolderWithExts(self.source_folder, self.valid_exts)
-            # ==================================================================
-            # Exit loop when preprocessed images are ready
-            # ==================================================================
-            if len(pp_files) == self.expected_image_count:
-                # ==============================================================
-                # Wait 30 sec to make sure images are completely copied
-                # ==============================================================
-                time.sleep(30)
+        # ======================================================================
+        # Poll until the preprocessed images are ready, the count is wrong or
+        # the deadline (preprocess_retry_wait*preprocess_retry_num) is reached
+        # ======================================================================
+        self.pp_count_error = False
+        policy = self.getPollingPolicy(self.pp_retry_wait, self.pp_retry_num,
+                                       page_count=self.expected_image_count)
+        if not policy.wait(self.preprocessedImagesReady, log=self.debug_message):
+            return False
+        if self.pp_count_error:
+            return False
+        # ======================================================================
+        # Wait 30 sec to make sure images are completely copied
+        # ======================================================================
+        time.sleep(30)
+        return True
+
+    def preprocessedImagesReady(self):
+        '''
+        Check function for the polling policy. Returns True when polling should
+        stop, i.e. also when there are too many images (self.pp_count_error).
+        '''
+        # ======================================================================
+        # Get current number of preprocessed images
+        # ======================================================================
+        pp_files = fs.getFilesInFolderWithExts(self.source_folder, self.valid_exts)
+        # ======================================================================
+        # Stop polling when preprocessed images are ready
+        # ======================================================================
+        if len(pp_files) == self.expected_image_count:
+            return True
+        # ======================================================================
+        # This shouldn't happen, but we have seen pdf's with duplicate pages, so better check
+        # ======================================================================
+        if len(pp_files) > self.expected_image_count:
+            if len(pp_files) > 0:
+                self.debug_message("Der er flere preprocesserede billeder ({}) end scannede billeder ({})"
+                                   .format(pp_files, self.expected_image_count))
+                self.pp_count_error = True
                 return True
-            # ==================================================================
-            # This shouldn't happen, but we have seen pdf's with duplicate pages, so better check
-            # ==================================================================
-            if len(pp_files) > self.expected_image_count:
-                if len(pp_files) > 0:
-                    self.debug_message("Der er flere preprocesserede billeder ({}) end scannede billeder ({})"
-                                       .format(pp_files, self.expected_image_count))
-                    return False
-            # ==================================================================
-            # Wait "self.pp_retry_wait" seconds
-            # ==================================================================
-            retry += 1
-            self.debug_message("Preprocesserede billeder ikke klar, venter {} sek".format(self.pp_retry_wait))
-            self.debug_message("Retry {} of {}".format(retry, self.pp_retry_num))
-            time.sleep(self.pp_retry_wait)
+        self.debug_message("Preprocesserede billeder ikke klar ({} af {})"
+                           .format(len(pp_files), self.expected_image_count))
         return False
     
     def step(self):
@@ -7,7 +7,6 @@ Created on 09/12/2014
 from goobi.goobi_step import Step
 from tools import tools
 import os
-import time
 
 
 class CountImageFiles(Step):
@@ -35,25 +34,15 @@ class CountImageFiles(Step):
             # Get the number of valid images
             image_count = tools.getFileCountWithExtension(self.image_path, self.valid_exts)
             self.debug_message("Der blev optalt {} billeder".format(image_count))
-            # write the number of images to a Goobi property. It sometimes fail, hence the retry stuff
-            max_retry = 10
-            retry = 0
-            ok = False
-            while not ok:
-                ok = self.goobi_com.addProperty(name=self.property_name, value=image_count, overwrite=True)
-                retry += 1
-                if not ok:
-                    self.debug_message("Billedantallet kunne ikke gemmes! Proever igen... (retry={})".format(retry))
-                    time.sleep(5)
-                    if retry > max_retry:
-                        error = "Fejl, Kunne ikke gemme billedantallet i Goobi's database!"
-                        self.debug_message(error)
-                        # return error
-                        # Return None for now, we don't want a web api lockup to stop the workflow
-                        # Until a "sudo service tomcat restart", imagecount will be 0.
-                        # todo: solve problem with web api lockup
-                        return None
-            self.debug_message("Billedantallet ({}) blev gemt korrekt i forsoeg nr {}".format(image_count, retry))
+            # write the number of images to a Goobi property. GoobiCommunicate
+            # retries the call, and spools it to be sent later if Goobi's web
+            # api is down
+            if not self.goobi_com.addProperty(name=self.property_name, value=image_count, overwrite=True):
+                error = "Fejl, Kunne ikke gemme billedantallet i Goobi's database - det sendes igen senere"
+                self.debug_message(error)
+                # Return None, we don't want a web api lockup to stop the workflow
+                return None
+            self.debug_message("Billedantallet ({}) blev gemt korrekt".format(image_count))
         # not sure which exceptions to expect...
         except ValueError as e:
             error = str(e.with_traceback)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+'''
+Spreading step jobs over several step servers (nodes).
+
+Any step server can act as coordinator: besides running jobs with its own
+processors, it hands out jobs from its (durable) queue to worker nodes
+asking for them with the "claim" verb (see goobi/job_protocol.py). A step
+server becomes a worker by setting "coordinator": "<host>:<port>" in its
+config. Its RemoteWorker then claims as many jobs as it has idle
+processors and free cores/memory, runs them like local jobs and reports
+them back with the "complete" verb.
+
+Workers pull jobs when they have capacity, so an idle node takes work that
+would otherwise wait for a busy one. A claimed job is leased to the
+worker: each claim request renews the leases of the jobs the worker is
+running, and a job whose lease runs out (e.g. the worker died) is placed
+in the queue again.
+
+Jobs can have affinity to a node, e.g. when the process folder is on a
+disk local to that node: either by the argument "node=<name>" or by
+node_paths, a dict of path prefix -> node name matched against the values
+of the job's arguments. Such jobs are only given to their node, unless
+steal_after is set and the job has waited that many seconds.
+'''
+import socket
+import threading
+import time
+
+from goobi import job_protocol
+from goobi.fair_queue import get_argument, split_cmd
+from goobi.step_job_processor import StepJob
+
+# Seconds a worker holds a job without renewing its lease
+LEASE_TIME = 60
+# Seconds a claim request waits for a job before returning with none
+CLAIM_WAIT = 15
+
+
+def node_name():
+    return socket.gethostname()
+
+
+def parse_address(address):
+    '''
+    Return (host, port) from "host:port".
+    '''
+    host, _, port = address.rpartition(':')
+    return host or 'localhost', int(port)
+
+
+class NodeAffinity():
+    '''
+    Decides which nodes may run a job.
+    '''
+    def __init__(self, node, node_paths=None, steal_after=None):
+        '''
+        :param node: name of this node
+        :param node_paths: dict path prefix -> name of node with that path
+        :param steal_after: seconds after which any node may run a job with
+            affinity to another node. None to never run such jobs elsewhere.
+        '''
+        self.node = node
+        self.node_paths = node_paths or {}
+        self.steal_after = steal_after
+
+    def preferred_node(self, job):
+        '''
+        Return the name of the node a job should run on, or None.
+        '''
+        if not hasattr(job, 'node_affinity'):
+            node = get_argument(job.cmd, 'node')
+            if node is None and self.node_paths:
+                for arg in split_cmd(job.cmd):
+                    value = arg.split('=', 1)[-1]
+                    for prefix, path_node in self.node_paths.items():
+                        if value.startswith(prefix):
+                            node = path_node
+                            break
+                    if node is not None:
+                        break
+            job.node_affinity = node
+        return job.node_affinity
+
+    def allows(self, job, node=None, now=None):
+        '''
+        Return True if node (default this node) may run job.
+        '''
+        node = node or self.node
+        preferred = self.preferred_node(job)
+        if preferred is None or preferred == node:
+            return True
+        if self.steal_after is None:
+            return False
+        now = now or time.time()
+        return now - job.enqueued > self.steal_after
+
+
+class LeaseReaper(threading.Thread):
+    '''
+    Places jobs of workers that stopped renewing their leases in the queue
+    again.
+    '''
+    def __init__(self, job_queue, interval=LEASE_TIME/4.0):
+        super(LeaseReaper, self).__init__()
+        self.daemon = True
+        self.job_queue = job_queue
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.job_queue.requeue_expired()
+
+
+class RemoteWorker(threading.Thread):
+    '''
+    Claims jobs from a coordinator for the processors of this step server
+    and reports them back when done.
+    '''
+    def __init__(self, coordinator, node, job_queue, processor_num,
+                 logger, claim_wait=CLAIM_WAIT, retry_wait=10):
+        '''
+        :param coordinator: (host, port) of coordinating step server
+        :param node: name of this node
+        :param job_queue: queue of this step server to place claimed jobs in
+        :param processor_num: number of processors taking jobs from job_queue
+        '''
+        super(RemoteWorker, self).__init__()
+        self.daemon = True
+        self.coordinator = coordinator
+        self.node = node
+        self.job_queue = job_queue
+        self.processor_num = processor_num
+        self.logger = logger
+        self.claim_wait = claim_wait
+        self.retry_wait = retry_wait
+        self.jobs = {}
+        self.lease_time = LEASE_TIME
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def capacity(self):
+        '''
+        Return the number of idle processors and the free cores and memory.
+        '''
+        with self.job_queue.condition:
+            idle = (self.processor_num - len(self.job_queue.running) -
+                    len(self.job_queue.get_queue()))
+            scheduler = self.job_queue.scheduler
+            if scheduler is None:
+                return max(idle, 0), None, None
+            return (max(idle, 0),
+                    scheduler.cpu_capacity - scheduler.cpu_used,
+                    scheduler.memory_capacity - scheduler.memory_used)
+
+    def request(self, message, timeout=30):
+        host, port = self.coordinator
+        return job_protocol.request(host, port, message, timeout)
+
+    def claim(self):
+        idle, cpu, memory = self.capacity()
+        now = time.time()
+        with self.lock:
+            # Only the leases of jobs started here are renewed. A job still
+            # waiting here when its lease runs out is handed out again by 
+            # the coordinator, so it must not run here as well.
+            running = [uid for uid, job in self.jobs.items()
+                       if job.started is not None]
+            lapsed = [uid for uid, job in self.jobs.items()
+                      if job.started is None and
+                      now - job.enqueued > self.lease_time]
+            for uid in lapsed:
+                del self.jobs[uid]
+        for uid in lapsed:
+            self.job_queue.cancel(uid)
+        # Only wait for jobs on the coordinator when there's room for one;
+        # otherwise the request just renews the leases
+        wait = self.claim_wait if idle else 0
+        response = self.request({'verb': job_protocol.VERB_CLAIM,
+                                 'node': self.node,
+                                 'max_jobs': idle,
+                                 'cpu': cpu,
+                                 'memory': memory,
+                                 'running': running,
+                                 'wait': wait},
+                                timeout=wait + 30)
+        if not response.get('ok'):
+            raise job_protocol.ProtocolError(response.get('error', ''))
+        self.lease_time = response.get('lease_time', self.lease_time)
+        for uid in response.get('cancel', []):
+            self.job_queue.cancel(uid)
+        for claimed in response.get('jobs', []):
+            with self.lock:
+                if claimed['job_id'] in self.jobs:
+                    # Still running here after the lease ran out
+                    continue
+            job = StepJob(claimed['cmd'], uid=claimed['job_id'])
+            # The job is stored by the coordinator, not by this node
+            job.durable = False
+            job.on_done = self.complete
+            # Placed on this node by the coordinator, which applied the
+            # affinity already - the local queue must not hold it back
+            job.node_affinity = None
+            with self.lock:
+                self.jobs[job.uid] = job
+            self.job_queue.put(job)
+            msg = 'Step job {0} claimed from coordinator {1}:{2}.'
+            self.logger.info(msg.format(job.cmd, *self.coordinator))
+        return idle, len(response.get('jobs', []))
+
+    def complete(self, job, ok):
+        '''
+        Report a job to the coordinator. Called by the processor when done.
+        '''
+        with self.lock:
+            self.jobs.pop(job.uid, None)
+        for attempt in range(3):
+            try:
+                self.request({'verb': job_protocol.VERB_COMPLETE,
+                              'node': self.node,
+                              'job_id': job.uid,
+                              'ok': ok})
+                return
+            except (OSError, job_protocol.ProtocolError) as e:
+                err = 'Failed to report step job {0} to coordinator: {1}'
+                self.logger.warning(err.format(job.uid, e))
+                time.sleep(1 + attempt)
+        # The lease runs out and the coordinator runs the job again
+        err = 'Step job {0} not reported to coordinator - it will be run again.'
+        self.logger.error(err.format(job.cmd))
+
+    def run(self):
+        msg = 'Claiming step jobs from coordinator {0}:{1} as node {2}.'
+        self.logger.info(msg.format(self.coordinator[0], self.coordinator[1],
+                                    self.node))
+        while not self.stopped.is_set():
+            try:
+                idle, claimed = self.claim()
+            except (OSError, job_protocol.ProtocolError) as e:
+                err = 'Failed to claim step jobs from coordinator {0}:{1}: {2}'
+                self.logger.warning(err.format(self.coordinator[0],
+                                               self.coordinator[1], e))
+                self.stopped.wait(self.retry_wait)
+                continue
+            if not idle:
+                # Wait for a processor to become idle, renewing leases now
+                # and then
+                with self.job_queue.condition:
+                    self.job_queue.condition.wait(self.lease_time/4.0)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+'''
+Ordering of step jobs by priority lane and workflow.
+
+A step job is placed in a priority lane with the argument
+"priority=<lane>" in the step job command, e.g.
+
+    python send_job_to_server.py python /opt/.../count_image_files.py \
+        process_id=12 ... priority=interactive
+
+Lanes are served in strict order: a job in the interactive lane is taken
+before any job in the normal lane, which is taken before any job in the
+bulk lane. Jobs without a priority go in the normal lane.
+
+Within a lane, jobs from different workflows (dod, tidsskrift, basis, ...
+taken from the folder of the config_path argument) share the lane by
+weighted fair queuing: each job is tagged on arrival with a virtual start
+time, max(virtual time of lane, tag of last job from the workflow) +
+1/weight, and jobs are taken in tag order. A workflow with weight 2 thus
+gets twice the jobs of a workflow with weight 1 when both have jobs
+waiting, and a backlog of 200 jobs from one workflow doesn't hold back a
+job from another.
+'''
+import bisect
+import itertools
+import os
+import shlex
+
+LANE_INTERACTIVE = 'interactive'
+LANE_NORMAL = 'normal'
+LANE_BULK = 'bulk'
+LANES = [LANE_INTERACTIVE, LANE_NORMAL, LANE_BULK]
+DEFAULT_LANE = LANE_NORMAL
+DEFAULT_WORKFLOW = 'default'
+
+
+def split_cmd(cmd):
+    '''
+    Split a step job command in arguments like the shell executing it does.
+    '''
+    try:
+        return shlex.split(cmd)
+    except ValueError:
+        return cmd.split()
+
+
+def get_argument(cmd, name):
+    '''
+    Return the value of argument "name=<value>" in a step job command or None.
+    '''
+    prefix = name + '='
+    for arg in split_cmd(cmd):
+        if arg.startswith(prefix):
+            return arg[len(prefix):].strip('"')
+    return None
+
+
+def job_key(cmd):
+    '''
+    Return (script file name, process_id, step_id) of a step job command, 
+    i.e. what two jobs doing the same thing have in common, or None if the
+    command has no process_id.
+    '''
+    process_id = get_argument(cmd, 'process_id')
+    if process_id is None:
+        return None
+    cmd_list = split_cmd(cmd)
+    script = os.path.basename(cmd_list[1]) if len(cmd_list) > 1 else ''
+    return (script, process_id, get_argument(cmd, 'step_id'))
+
+
+def job_lane(cmd):
+    lane = get_argument(cmd, 'priority')
+    if lane in LANES:
+        return lane
+    return DEFAULT_LANE
+
+
+def job_workflow(cmd):
+    '''
+    Return the name of the workflow of a step job, i.e. the name of the
+    folder with the config file given by config_path, e.g. "dod" for
+    config_path=workflows/dod/config.ini.
+    '''
+    config_path = get_argument(cmd, 'config_path')
+    if not config_path:
+        return DEFAULT_WORKFLOW
+    workflow = os.path.basename(os.path.dirname(config_path))
+    return workflow or DEFAULT_WORKFLOW
+
+
+class FairQueue():
+    '''
+    List of jobs kept in the order they should be taken: by lane, then by
+    fair queuing tag. Supports the deque operations used by StepJobQueue.
+
+    Jobs must have the attributes lane and workflow. Other objects (e.g. a
+    stop sentinel) can only be placed first with appendleft().
+    '''
+    def __init__(self, weights=None):
+        '''
+        :param weights: dict of workflow name -> weight. Default weight is 1.
+        '''
+        self.weights = weights or {}
+        self.jobs = []
+        self.keys = []
+        self.virtual_time = dict((lane, 0.0) for lane in LANES)
+        self.last_tag = {}
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __bool__(self):
+        return len(self.jobs) > 0
+
+    def __iter__(self):
+        return iter(list(self.jobs))
+
+    def __getitem__(self, index):
+        return self.jobs[index]
+
+    def __delitem__(self, index):
+        job = self.jobs[index]
+        key = self.keys[index]
+        del self.jobs[index]
+        del self.keys[index]
+        # The lane's virtual time follows the tag of the job taken
+        lane = getattr(job, 'lane', None)
+        if lane in self.virtual_time:
+            self.virtual_time[lane] = max(self.virtual_time[lane], key[1])
+
+    def _insert(self, key, job):
+        index = bisect.bisect(self.keys, key)
+        self.keys.insert(index, key)
+        self.jobs.insert(index, job)
+
+    def append(self, job):
+        lane = job.lane if job.lane in LANES else DEFAULT_LANE
+        weight = float(self.weights.get(job.workflow, 1)) or 1.0
+        flow = (lane, job.workflow)
+        tag = max(self.virtual_time[lane], self.last_tag.get(flow, 0.0))
+        tag += 1.0/weight
+        self.last_tag[flow] = tag
+        self._insert((LANES.index(lane), tag, next(self.counter)), job)
+
+    def appendleft(self, job):
+        self._insert((-1, 0.0, -next(self.counter)), job)
+
+    def extend(self, jobs):
+        for job in jobs:
+            self.append(job)
+
+    def popleft(self):
+        if not self.jobs:
+            raise IndexError('pop from an empty queue')
+        job = self.jobs[0]
+        del self[0]
+        return job
+
+    def remove(self, job):
+        del self[self.jobs.index(job)]
+
+    def clear(self):
+        self.jobs = []
+        self.keys = []
+
+    def lane_size(self, lane):
+        '''
+        Return the number of jobs in lane.
+        '''
+        if lane not in LANES:
+            return 0
+        rank = LANES.index(lane)
+        return (bisect.bisect_left(self.keys, (rank + 1,)) -
+                bisect.bisect_left(self.keys, (rank,)))
+
+    def lane_sizes(self):
+        return dict((lane, self.lane_size(lane)) for lane in LANES)
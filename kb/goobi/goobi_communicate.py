@@ -2,7 +2,467 @@
 # -*- coding: utf-8
 #Send a log message: 'http://127.0.0.1/goobi/wi?command=addToProcessLog&processId='+processId+'&value=Beginning&jpeg2000&conversion&type=error&token=Xasheax7ai'
 # close a step automatically: 'http://127.0.0.1/goobi/wi?command=closeStep&stepId='+stepId+'&token=Xasheax7ai'
-from urllib import request,parse
+import contextlib
+import json
+import os
+import random
+import stat
+import tempfile
+import threading
+import time
+
+from tools import instrumentation
+from tools.lazy_import import lazy_module
+
+# http.client (with email and ssl) is a large part of the import time of a
+# step - only import it when Goobi is called
+client = lazy_module('http.client')
+parse = lazy_module('urllib.parse')
+futures = lazy_module('concurrent.futures')
+
+# Commands Goobi can get twice without harm. They are retried even when Goobi
+# may have received them; other commands only when they weren't sent.
+# AddProperty is retried when it overwrites the property. closeStep is not:
+# if Goobi has moved the workflow on, a second one could close a later step.
+RETRY_SAFE_COMMANDS = set(['addToProcessLog'])
+# Commands that may wait: if Goobi can't be reached they are spooled (see
+# Spool) and sent with the next calls that get through
+SPOOL_COMMANDS = set(['addToProcessLog', 'AddProperty'])
+# Seconds a call is retried for, with exponential backoff and jitter - about
+# the minute steps used to retry for themselves, so a short hiccup of Goobi
+# doesn't fail (or defer) a call
+RETRY_WINDOW = 60
+RETRY_WAIT = 0.5
+RETRY_MAX_WAIT = 10
+# Failed attempts in a row after which calls to Goobi are stopped for
+# BREAKER_RESET seconds, doubled up to BREAKER_MAX_RESET while they fail
+BREAKER_FAILURES = 5
+BREAKER_RESET = 30
+BREAKER_MAX_RESET = 300
+# Seconds between looking for a breaker opened by another step
+BREAKER_SYNC = 5
+# Spooled calls and circuit breaker state, shared by the steps of a server
+# run by the same user. Files in it are only used if the folder and the file
+# are owned by the user and not writable by others.
+SPOOL_DIR = os.environ.get('GOOBI_SPOOL', os.path.join(
+    tempfile.gettempdir(), 'goobi_spool_{0}'.format(os.getuid())))
+# Spooled calls older than this (seconds) are dropped
+SPOOL_MAX_AGE = 7*24*60*60
+# Max calls sent from the spool at a time, and seconds between looking for
+# spooled calls
+SPOOL_DRAIN_MAX = 100
+SPOOL_CHECK = 60
+# Calls sent at the same time by GoobiCommunicate.bulk()
+BULK_WORKERS = 8
+# Methods that can be called by bulk(), and whether they take process_id
+BULK_COMMANDS = {'addToProcessLog': True,
+                 'addProperty': True,
+                 'closeStep': True,
+                 'closeStepByProcessId': True,
+                 'reportToPrevStep': False}
+
+
+class NotSentError(Exception):
+    '''
+    The connection to Goobi failed before the request was sent.
+    '''
+    def __init__(self, strerror):
+        self.strerror = strerror
+
+    def __str__(self):
+        return self.strerror
+
+
+class ConnectionPool():
+    '''
+    Persistent (keep-alive) HTTP connections to Goobi, shared by all
+    GoobiCommunicate objects of a process, so a step logging many messages
+    through GoobiLogger uses one connection instead of one per message.
+
+    Idle connections are kept per (protocol, host) up to max_idle, and
+    dropped when they have been idle for max_idle_time seconds, before
+    Tomcat closes them (keepAliveTimeout is 20 s by default). The pool is
+    thread safe, and a forked process starts with an empty pool.
+    '''
+    def __init__(self, max_idle=4, max_idle_time=15, timeout=30):
+        self.max_idle = max_idle
+        self.max_idle_time = max_idle_time
+        self.timeout = timeout
+        self.idle = {}
+        # Larger max_idle asked for by keep_idle() while it is in use
+        self.kept = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.stats = {'requests': 0,
+                      'failed': 0,
+                      'connections_opened': 0,
+                      'connections_reused': 0,
+                      'connections_closed': 0}
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get(self, protocol, host):
+        '''
+        Return (connection, reused) - an idle connection to host if there is
+        one, otherwise a new one.
+        '''
+        key = (protocol, host)
+        now = time.time()
+        with self.lock:
+            if self.pid != os.getpid():
+                # Connections of the parent process - don't share its sockets
+                self.idle = {}
+                self.pid = os.getpid()
+            idle = self.idle.get(key, [])
+            while idle:
+                connection, idle_since = idle.pop()
+                if now - idle_since < self.max_idle_time:
+                    self.stats['connections_reused'] += 1
+                    return connection, True
+                self.stats['connections_closed'] += 1
+                connection.close()
+            self.stats['connections_opened'] += 1
+        if protocol == 'https':
+            return client.HTTPSConnection(host, timeout=self.timeout), False
+        return client.HTTPConnection(host, timeout=self.timeout), False
+
+    def put(self, protocol, host, connection):
+        '''
+        Return a connection, with its response read, to the pool.
+        '''
+        with self.lock:
+            idle = self.idle.setdefault((protocol, host), [])
+            if len(idle) < self._max_idle() and self.pid == os.getpid():
+                idle.append((connection, time.time()))
+                return
+            self.stats['connections_closed'] += 1
+        connection.close()
+
+    def discard(self, connection):
+        self._count('connections_closed')
+        connection.close()
+
+    def _max_idle(self):
+        return max([self.max_idle] + self.kept)
+
+    @contextlib.contextmanager
+    def keep_idle(self, max_idle):
+        '''
+        Keep up to max_idle idle connections per host while in the with 
+        block, e.g. one per worker of GoobiCommunicate.bulk(). Afterwards
+        the connections over the pool's own max_idle are closed.
+        '''
+        with self.lock:
+            self.kept.append(max_idle)
+        try:
+            yield self
+        finally:
+            closing = []
+            with self.lock:
+                self.kept.remove(max_idle)
+                limit = self._max_idle()
+                for idle in self.idle.values():
+                    while len(idle) > limit:
+                        closing.append(idle.pop(0)[0])
+            for connection in closing:
+                self.discard(connection)
+
+    def request(self, protocol, host, path):
+        '''
+        GET path from host. Return (status, reason) of the response, which is
+        read and closed. Raises OSError or http.client.HTTPException when no
+        response is received.
+        '''
+        self._count('requests')
+        for attempt in range(2):
+            connection, reused = self.get(protocol, host)
+            if connection.sock is None:
+                try:
+                    connection.connect()
+                except OSError as e:
+                    self.discard(connection)
+                    self._count('failed')
+                    raise NotSentError(str(e))
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                response.close()
+            except (OSError, client.HTTPException) as e:
+                self.discard(connection)
+                if reused and attempt == 0 and isinstance(e, ConnectionError):
+                    # The server closed the idle connection - try a new one
+                    continue
+                self._count('failed')
+                raise
+            if response.will_close:
+                self.discard(connection)
+            else:
+                self.put(protocol, host, connection)
+            return response.status, response.reason
+
+    def close(self):
+        '''
+        Close all idle connections.
+        '''
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection, _ in connections:
+                self.discard(connection)
+
+    def connection_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['idle'] = sum(len(c) for c in self.idle.values())
+        return stats
+
+
+# Pool used by GoobiCommunicate unless it is given another one
+pool = ConnectionPool()
+
+
+def _safe_name(host):
+    return parse.quote(host, safe='')
+
+
+def _private(file_stat):
+    '''
+    Return True if file_stat is of a file or folder owned by the current user
+    that others can't read or write.
+    '''
+    return (file_stat.st_uid == os.getuid() and
+            not stat.S_ISLNK(file_stat.st_mode) and
+            not file_stat.st_mode & 0o077)
+
+
+def _private_dir(*paths):
+    '''
+    Create the folders in paths (parents first) with mode 0700 if they don't
+    exist. Return True if they are all private.
+    '''
+    for path in paths:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        if not _private(os.lstat(path)):
+            return False
+    return True
+
+
+def _open_private(path):
+    '''
+    Open a private file for reading. Raise OSError if it isn't private.
+    '''
+    fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    if not _private(os.fstat(fd)):
+        os.close(fd)
+        raise OSError('Not a private file: {0}'.format(path))
+    return os.fdopen(fd, encoding='utf-8')
+
+
+def _create_private(path):
+    '''
+    Create a new private file for writing.
+    '''
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW,
+                 0o600)
+    return os.fdopen(fd, 'w', encoding='utf-8')
+
+
+class CircuitBreaker():
+    '''
+    Stops calls to a Goobi host after BREAKER_FAILURES failed attempts in a
+    row, so steps don't keep a locked up Tomcat busy (and wait for it). While
+    the breaker is open calls fail at once. After the reset time calls are
+    let through again; if the first one fails the breaker opens again for
+    twice as long.
+
+    The state is kept in memory. When the breaker opens, the time it is
+    open until is also written to a file in SPOOL_DIR, which is read every
+    BREAKER_SYNC seconds, so other steps (processes) stop calling Goobi 
+    too. The file is only shared on a best effort basis - the breaker works
+    without it.
+    '''
+    def __init__(self, host, failures=BREAKER_FAILURES, reset=BREAKER_RESET,
+                 max_reset=BREAKER_MAX_RESET, state_dir=None):
+        self.max_failures = failures
+        self.min_reset = reset
+        self.max_reset = max_reset
+        self.reset = reset
+        self.failures = 0
+        self.open_until = 0
+        self.last_sync = 0
+        self.state_dir = state_dir or SPOOL_DIR
+        self.path = os.path.join(self.state_dir,
+                                 'circuit_' + _safe_name(host) + '.json')
+        self.lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with _open_private(self.path) as state_file:
+                state = json.load(state_file)
+            return state['open_until'], state['reset']
+        except (OSError, ValueError, KeyError, TypeError):
+            return 0, None
+
+    def _write(self):
+        try:
+            if not _private_dir(self.state_dir):
+                return
+            tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+            with contextlib.suppress(FileNotFoundError):
+                # Left by a step that had the same pid
+                os.remove(tmp_path)
+            with _create_private(tmp_path) as state_file:
+                json.dump({'open_until': self.open_until,
+                           'reset': self.reset}, state_file)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+    def allow(self):
+        '''
+        Return False if calls are stopped.
+        '''
+        now = time.time()
+        with self.lock:
+            if now - self.last_sync >= BREAKER_SYNC:
+                self.last_sync = now
+                open_until, reset = self._read()
+                if open_until > self.open_until:
+                    # Opened by another step - the next failure opens it again
+                    self.open_until = open_until
+                    self.reset = reset or self.min_reset
+                    self.failures = self.max_failures - 1
+            return now >= self.open_until
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures < self.max_failures:
+                return
+            if self.open_until:
+                # Failed again after being open
+                self.reset = min(self.reset*2, self.max_reset)
+            self.open_until = time.time() + self.reset
+            self.failures = self.max_failures - 1
+            self._write()
+
+    def succeeded(self):
+        with self.lock:
+            was_open = self.open_until
+            self.failures = 0
+            self.open_until = 0
+            self.reset = self.min_reset
+        if was_open:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def is_open(self):
+        return time.time() < self.open_until
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def circuit_breaker(host):
+    '''
+    Return the CircuitBreaker of host shared in this process.
+    '''
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
+
+
+class Spool():
+    '''
+    Calls to a Goobi host that couldn't be sent, kept as json files in a
+    folder in SPOOL_DIR per host until they are sent by drain(). The files
+    are claimed by renaming them, so several steps can drain the spool at
+    the same time without sending a call twice.
+    '''
+    def __init__(self, host, spool_dir=None):
+        self.spool_dir = spool_dir or SPOOL_DIR
+        self.path = os.path.join(self.spool_dir, _safe_name(host))
+        self.count = 0
+        self.last_check = 0
+        self.drain_lock = threading.Lock()
+
+    def add(self, command, additional):
+        '''
+        Spool a call. Return False if it couldn't be written.
+        '''
+        self.count += 1
+        name = '{0:.6f}-{1}-{2}-{3}.json'.format(time.time(), os.getpid(),
+                                                threading.get_ident(),
+                                                self.count)
+        path = os.path.join(self.path, name)
+        try:
+            if not _private_dir(self.spool_dir, self.path):
+                return False
+            with _create_private(path + '.tmp') as spool_file:
+                json.dump({'command': command,
+                           'additional': additional,
+                           'created': time.time()}, spool_file)
+            os.replace(path + '.tmp', path)
+            return True
+        except OSError:
+            return False
+
+    def due(self):
+        '''
+        Return True if it's time to look for spooled calls.
+        '''
+        now = time.time()
+        if now - self.last_check < SPOOL_CHECK:
+            return False
+        self.last_check = now
+        return True
+
+    def drain(self, send, max_calls=SPOOL_DRAIN_MAX):
+        '''
+        Send spooled calls, oldest first, with send(command, additional),
+        until one fails. Return the number sent.
+        '''
+        if not self.drain_lock.acquire(False):
+            return 0
+        sent = 0
+        try:
+            try:
+                if not _private_dir(self.spool_dir, self.path):
+                    return 0
+                names = sorted(n for n in os.listdir(self.path)
+                               if n.endswith('.json'))
+            except OSError:
+                return 0
+            for name in names[:max_calls]:
+                path = os.path.join(self.path, name)
+                claimed = '{0}.{1}'.format(path, os.getpid())
+                try:
+                    if not _private(os.lstat(path)):
+                        # Not written by a step of ours
+                        continue
+                    os.rename(path, claimed)
+                    with _open_private(claimed) as spool_file:
+                        call = json.load(spool_file)
+                except (OSError, ValueError):
+                    # Taken by another step
+                    continue
+                if (isinstance(call, dict) and
+                        time.time() - call.get('created', 0) < SPOOL_MAX_AGE):
+                    if not send(call['command'], call['additional']):
+                        os.rename(claimed, path)
+                        break
+                    sent += 1
+                os.remove(claimed)
+        finally:
+            self.drain_lock.release()
+        return sent
 
 
 class GoobiCommunicate() :
@@ -15,13 +475,21 @@ class GoobiCommunicate() :
     url_token = "&token={token}"
     url_command = "command={command}"
     
+    retry_window = RETRY_WINDOW
+    retry_wait = RETRY_WAIT
+    retry_max_wait = RETRY_MAX_WAIT
+    
     def __init__( self, host, password_token, debugging=False,
-                  process_id = None ) :
+                  process_id = None, connection_pool=None, use_spool=True ) :
     
         self.host = host if host is not None else '127.0.0.1'
         self.token = password_token
         self.debugging = debugging
         self.process_id = process_id
+        self.pool = connection_pool if connection_pool is not None else pool
+        self.breaker = circuit_breaker(self.host)
+        # Calls in SPOOL_COMMANDS that fail are sent later
+        self.spool = Spool(self.host) if use_spool else None
         
         self._update_url_base()
     
@@ -103,6 +571,52 @@ class GoobiCommunicate() :
 
         return self._send( "AddProperty", additional )
     
+    def bulk( self, calls, max_workers=BULK_WORKERS ):
+        '''
+        Make many calls, e.g. set a property on hundreds of processes, with
+        up to max_workers calls at a time over pooled connections.
+        
+        calls is a list of (process_id, command, args): command is a method
+        in BULK_COMMANDS and args a dict of its other keyword arguments, e.g.
+        
+            (123, 'addProperty', {'name': 'image_count', 'value': 42,
+                                  'overwrite': True})
+        
+        Return a list with a dict per call, in the order of calls, with the
+        keys process_id, command, ok and error (None or the reason it
+        failed). A call failing doesn't stop the others.
+        '''
+        calls = list(calls)
+        if not calls:
+            return []
+        max_workers = max(1, min(max_workers, len(calls)))
+        # Keep a connection per worker between calls
+        with self.pool.keep_idle(max_workers):
+            with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                return list(executor.map(self._bulk_call, calls))
+    
+    def _bulk_call( self, call ):
+        process_id, command, args = call
+        result = {'process_id': process_id, 'command': command,
+                  'ok': False, 'error': None}
+        if command not in BULK_COMMANDS:
+            msg = 'Command {0} can not be used in bulk calls.'
+            result['error'] = msg.format(command)
+            return result
+        args = dict(args or {})
+        if BULK_COMMANDS[command]:
+            args['process_id'] = process_id
+        try:
+            result['ok'] = bool(getattr(self, command)(**args))
+        except (TypeError, ValueError) as e:
+            result['error'] = str(e)
+            return result
+        if not result['ok']:
+            result['error'] = ('Goobi calls stopped after failures'
+                               if self.breaker.is_open() else
+                               'Goobi did not accept the call')
+        return result
+    
     def _update_url_base( self ):
         '''
         TODO: Document method
@@ -115,9 +629,54 @@ class GoobiCommunicate() :
         '''
         return parse.quote( str(string), safe="" )
     
+    def connection_stats( self ):
+        '''
+        Return counts of requests and connections of the connection pool.
+        '''
+        return self.pool.connection_stats()
+    
     def _send( self, command, additional=None ) :
         '''
-        TODO: Document method
+        Call command with the arguments in additional. Return True if Goobi
+        answered OK.
+        
+        Failed attempts are retried (see RETRY_SAFE_COMMANDS), and calls
+        in SPOOL_COMMANDS that fail are spooled to be sent later.
+        '''
+        with instrumentation.timer( 'goobi.' + command ):
+            ok, maybe_received, answered = self._call( command, additional )
+        if ok:
+            if self.spool and self.spool.due():
+                self.spool.drain( self._drain_call )
+            return True
+        instrumentation.count( 'goobi.' + command + '.failed' )
+        if (self.spool and not answered and command in SPOOL_COMMANDS and
+                (not maybe_received or self._retry_safe( command, additional ))):
+            if self.spool.add( command, additional ):
+                instrumentation.count( 'goobi.spooled' )
+                if self.debugging:
+                    print("Debug: GoobiCommunicate() Spooled", command, "to send later")
+        return False
+    
+    def _drain_call( self, command, additional ):
+        # A spooled call Goobi refuses is dropped like a call sent right away.
+        # It is tried once - the spool is drained by the step's own calls.
+        ok, _, answered = self._call( command, additional, retry_window=0 )
+        return ok or answered
+    
+    def _retry_safe( self, command, additional ):
+        if command in RETRY_SAFE_COMMANDS:
+            return True
+        return (command == 'AddProperty' and additional and
+                str(additional.get('overwriteExistingProperty')).lower() == 'true')
+    
+    def _call( self, command, additional=None, retry_window=None ) :
+        '''
+        Call command, retrying for up to retry_window seconds. If the 
+        circuit breaker stops calls, wait for it if it lets calls through
+        within the window. Return (ok, maybe_received, answered) -
+        whether Goobi answered OK, if not whether Goobi may have received
+        it, and whether Goobi answered (refused) it.
         '''
         url = self.url_base
         url += self.url_command.format( command=command )
@@ -131,18 +690,60 @@ class GoobiCommunicate() :
         if self.debugging and additional and 'value' in additional:
             print(additional['value'])
         
-        # TODO: Tidy this up. Need to catch exceptions properly and ensure 
-        # request is closed (although python handles that too)
-        try:
-            response = request.urlopen(url)
-            if response.code == 200: return True
-            else:
+        url = parse.urlsplit(url)
+        path = url.path + '?' + url.query
+        retry_safe = self._retry_safe( command, additional )
+        maybe_received = False
+        if retry_window is None:
+            retry_window = self.retry_window
+        deadline = time.time() + retry_window
+        attempt = -1
+        while True:
+            attempt += 1
+            if attempt:
+                wait = min(self.retry_wait * 2**(attempt-1), self.retry_max_wait)
+                wait *= random.uniform(0.5, 1.0)
+                if time.time() + wait > deadline:
+                    return False, maybe_received, False
+                time.sleep(wait)
+            while not self.breaker.allow():
+                if self.breaker.open_until > deadline:
+                    if self.debugging:
+                        print("Debug: GoobiCommunicate() Calls to Goobi stopped after failures:", command)
+                    return False, maybe_received, False
+                time.sleep(max(self.breaker.open_until - time.time(), 0.01))
+            if attempt:
+                instrumentation.count('goobi.retries')
+            try:
+                status, reason = self.pool.request(url.scheme, url.netloc, path)
+            except NotSentError as e:
+                self.breaker.failed()
                 if self.debugging:
-                    print("Debug: GoobiCommunicate() None OK response from Goobi:", response.msg, response.code)
-            response.close()        
-        except:
-            pass
-        return False
+                    print("Debug: GoobiCommunicate() No connection to Goobi:", e)
+                continue
+            except (OSError, client.HTTPException) as e:
+                self.breaker.failed()
+                maybe_received = True
+                if self.debugging:
+                    print("Debug: GoobiCommunicate() No response from Goobi:", e)
+                if retry_safe:
+                    continue
+                return False, maybe_received, False
+            if status == 200:
+                self.breaker.succeeded()
+                return True, True, True
+            if self.debugging:
+                print("Debug: GoobiCommunicate() None OK response from Goobi:", reason, status)
+            if status >= 500 or status == 429:
+                # Goobi (Tomcat) is in trouble
+                self.breaker.failed()
+                maybe_received = True
+                if retry_safe:
+                    continue
+                return False, maybe_received, False
+            # Goobi refused the call - retrying won't help
+            self.breaker.succeeded()
+            return False, True, True
 if __name__ == '__main__' :
 
     comm = GoobiCommunicate( "127.0.0.1", "Xasheax7ai", True )
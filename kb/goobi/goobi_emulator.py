@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+'''
+Local stand-in for the Goobi web api, for testing and benchmarking
+GoobiCommunicate, GoobiLogger and steps without a Goobi/Tomcat.
+
+It answers GET /goobi/wi?command=<command>&...&token=<token> for the
+commands GoobiCommunicate uses (addToProcessLog, closeStep,
+closeStepByProcessId, reportProblem, AddProperty) and records the calls:
+GET /emulator/state returns the log messages and properties per process,
+the closed and reported steps and the number of calls per command and
+status as JSON.
+
+To test how the scripts cope with a slow or failing Goobi, every call can
+be delayed (latency seconds plus up to jitter seconds) and a share of the
+calls can fail: failure_rate of them are answered with failure_status
+(503 by default) and drop_rate of them get no answer at all (the
+connection is closed).
+
+Run it on its own with
+
+    python goobi/goobi_emulator.py --port 8080 --latency 0.05 --failure-rate 0.1
+
+and set the host in the goobi section of the system config to
+localhost:8080, or start it in a test with start_emulator(). See also
+goobi_load_test.py.
+'''
+import http.server
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from optparse import OptionParser
+
+# Arguments each command must have
+COMMANDS = {'addToProcessLog': ['processId', 'type', 'value'],
+            'closeStep': ['stepId'],
+            'closeStepByProcessId': ['processId'],
+            'reportProblem': ['stepId', 'destinationStepName', 'errorMessage'],
+            'AddProperty': ['processId', 'property', 'value']}
+
+
+class GoobiEmulator(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, token=None, latency=0.0, jitter=0.0,
+                 failure_rate=0.0, failure_status=503, drop_rate=0.0,
+                 seed=None):
+        '''
+        :param token: token calls must have, None to accept any
+        :param latency: seconds every call is delayed
+        :param jitter: up to this many seconds more are added at random
+        :param failure_rate: share of calls answered with failure_status
+        :param drop_rate: share of calls closed without an answer
+        '''
+        self.token = token
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reset()
+        http.server.ThreadingHTTPServer.__init__(self, server_address,
+                                                 GoobiEmulatorHandler)
+
+    def reset(self):
+        '''
+        Forget the recorded calls.
+        '''
+        with self.lock:
+            self.logs = {}
+            self.properties = {}
+            self.closed_steps = []
+            self.closed_processes = []
+            self.problems = []
+            self.calls = {}
+
+    def outcome(self):
+        '''
+        Return 'drop', 'fail' or 'ok' for a call, by the configured rates.
+        '''
+        with self.lock:
+            draw = self.random.random()
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if draw < self.drop_rate:
+            return 'drop'
+        if draw < self.drop_rate + self.failure_rate:
+            return 'fail'
+        return 'ok'
+
+    def count(self, command, status):
+        with self.lock:
+            counts = self.calls.setdefault(command, {})
+            counts[str(status)] = counts.get(str(status), 0) + 1
+
+    def record(self, command, args):
+        with self.lock:
+            if command == 'addToProcessLog':
+                self.logs.setdefault(args['processId'], []).append(
+                    {'type': args['type'], 'value': args['value']})
+            elif command == 'AddProperty':
+                properties = self.properties.setdefault(args['processId'], {})
+                values = properties.setdefault(args['property'], [])
+                if args.get('overwriteExistingProperty', '').lower() == 'true':
+                    del values[:]
+                values.append(args['value'])
+            elif command == 'closeStep':
+                self.closed_steps.append(args['stepId'])
+            elif command == 'closeStepByProcessId':
+                self.closed_processes.append(args['processId'])
+            elif command == 'reportProblem':
+                self.problems.append({'stepId': args['stepId'],
+                                      'destinationStepName': args['destinationStepName'],
+                                      'errorMessage': args['errorMessage']})
+
+    def state(self):
+        with self.lock:
+            return {'logs': self.logs,
+                    'properties': self.properties,
+                    'closed_steps': self.closed_steps,
+                    'closed_processes': self.closed_processes,
+                    'problems': self.problems,
+                    'calls': self.calls}
+
+
+class GoobiEmulatorHandler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive, like Tomcat
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path.rstrip('/') == '/emulator/state':
+            self.answer(200, json.dumps(self.server.state(), indent=2,
+                                        sort_keys=True))
+            return
+        if url.path.rstrip('/') != '/goobi/wi':
+            self.answer(404, 'Not found')
+            return
+        args = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        command = args.get('command', '')
+        outcome = self.server.outcome()
+        if outcome == 'drop':
+            self.server.count(command, 'dropped')
+            self.close_connection = True
+            return
+        if outcome == 'fail':
+            self.answer(self.server.failure_status, 'Failure injected',
+                        command)
+            return
+        if self.server.token is not None and args.get('token') != self.server.token:
+            self.answer(401, 'Wrong token', command)
+            return
+        if command not in COMMANDS:
+            self.answer(400, 'Unknown command', command)
+            return
+        missing = [name for name in COMMANDS[command] if name not in args]
+        if missing:
+            self.answer(400, 'Missing ' + ', '.join(missing), command)
+            return
+        self.server.record(command, args)
+        self.answer(200, 'OK', command)
+
+    def answer(self, status, text, command=None):
+        if command is not None:
+            self.server.count(command, status)
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_emulator(server_address=('127.0.0.1', 0), **kwargs):
+    '''
+    Start a GoobiEmulator in a daemon thread and return it. Its host for
+    GoobiCommunicate is "127.0.0.1:<server.server_port>". Stop it with
+    server.shutdown().
+    '''
+    server = GoobiEmulator(server_address, **kwargs)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='goobi_emulator')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--host', dest='host', default='127.0.0.1')
+    parser.add_option('--port', dest='port', type='int', default=8080)
+    parser.add_option('--token', dest='token',
+                      help='Token calls must have. Any token is accepted if not given.')
+    parser.add_option('--latency', dest='latency', type='float', default=0.0,
+                      help='Seconds every call is delayed.')
+    parser.add_option('--jitter', dest='jitter', type='float', default=0.0,
+                      help='Up to this many seconds are added to the latency at random.')
+    parser.add_option('--failure-rate', dest='failure_rate', type='float', default=0.0,
+                      help='Share of calls answered with --failure-status.')
+    parser.add_option('--failure-status', dest='failure_status', type='int', default=503)
+    parser.add_option('--drop-rate', dest='drop_rate', type='float', default=0.0,
+                      help='Share of calls closed without an answer.')
+    (options, args) = parser.parse_args()
+    server = GoobiEmulator((options.host, options.port), options.token,
+                           options.latency, options.jitter,
+                           options.failure_rate, options.failure_status,
+                           options.drop_rate)
+    print('Goobi emulator on http://{0}:{1}/goobi/wi'.format(options.host,
+                                                            server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,154 @@
 # -*- coding: utf-8
 
 
+import atexit
+import collections
 import datetime
+import logging
 import sys
+import threading
 import time
+import weakref
 
 from goobi.goobi_communicate import GoobiCommunicate
 
+# Seconds the log shipper waits for more messages to send them in one call
+BATCH_WAIT = 0.5
+# Max length of the messages joined into one call to Goobi (sent in the URL)
+BATCH_CHARS = 2000
+# Max number of messages waiting to be sent - more are dropped (and counted)
+MAX_BUFFERED = 1000
+# Seconds to wait for waiting messages to be sent when the step ends
+FLUSH_TIMEOUT = 30
+
+_shippers = weakref.WeakSet()
+
+
+def flush_all(timeout=FLUSH_TIMEOUT):
+    '''
+    Send the waiting messages of all GoobiLoggers of this process. Called at
+    exit. The warm step runner ends its jobs with os._exit, which skips the
+    atexit functions, so it calls this and step_logging.stop_all itself.
+    '''
+    for shipper in list(_shippers):
+        shipper.flush(timeout)
+
+atexit.register(flush_all)
+
+
+class LogShipper(threading.Thread):
+    '''
+    Sends log messages to Goobi in a background thread, so a step logging
+    progress doesn't wait for Goobi for every line.
+
+    Messages are buffered and sent every BATCH_WAIT seconds; consecutive
+    messages of the same level and process are joined (one per line) into
+    one addToProcessLog call of at most BATCH_CHARS characters. Errors are
+    sent right away. If more than max_buffered messages are waiting (Goobi
+    is slow or down), further messages other than errors are dropped; the
+    number dropped is counted and reported to Goobi with the next messages.
+    '''
+    def __init__(self, com, max_buffered=MAX_BUFFERED, batch_wait=BATCH_WAIT,
+                 batch_chars=BATCH_CHARS):
+        super(LogShipper, self).__init__(name='goobi_log_shipper')
+        self.daemon = True
+        self.com = com
+        self.max_buffered = max_buffered
+        self.batch_wait = batch_wait
+        self.batch_chars = batch_chars
+        self.buffer = collections.deque()
+        self.condition = threading.Condition()
+        self.running = False
+        self.sending = False
+        self.urgent = False
+        self.flushing = 0
+        self.unreported_drops = 0
+        self.stats = {'messages': 0, 'dropped': 0, 'calls': 0, 'failed': 0}
+        _shippers.add(self)
+
+    def put(self, level, message, process_id):
+        '''
+        Buffer a message. Return False if it was dropped.
+        '''
+        with self.condition:
+            if len(self.buffer) >= self.max_buffered and level != 'error':
+                self.stats['dropped'] += 1
+                self.unreported_drops += 1
+                return False
+            self.buffer.append((level, message, process_id))
+            if level == 'error':
+                self.urgent = True
+            if not self.running:
+                self.running = True
+                self.start()
+            self.condition.notify_all()
+        return True
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        '''
+        Send the waiting messages now and wait until they are sent. Return
+        False if they weren't all sent within timeout seconds.
+        '''
+        with self.condition:
+            self.flushing += 1
+            self.condition.notify_all()
+            try:
+                return self.condition.wait_for(
+                    lambda: not (self.buffer or self.sending), timeout)
+            finally:
+                self.flushing -= 1
+
+    def _batches(self):
+        '''
+        Take the buffered messages as (level, message, process_id) batches.
+        Call with self.condition held.
+        '''
+        batches = []
+        process_id = self.buffer[0][2]
+        while self.buffer:
+            level, message, process_id = self.buffer.popleft()
+            self.stats['messages'] += 1
+            if batches:
+                last = batches[-1]
+                if (last[0] == level and last[2] == process_id and
+                        last[3] + len(message) + 1 <= self.batch_chars):
+                    last[1].append(message)
+                    last[3] += len(message) + 1
+                    continue
+            batches.append([level, [message], process_id, len(message)])
+        if self.unreported_drops:
+            msg = ('{0} log message(s) not sent to Goobi as too many were '
+                   'waiting to be sent.')
+            batches.append(['info', [msg.format(self.unreported_drops)],
+                            process_id, 0])
+            self.unreported_drops = 0
+        return batches
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.buffer)
+                # Wait a little for more messages to send together
+                deadline = time.time() + self.batch_wait
+                while not (self.urgent or self.flushing):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batches = self._batches()
+                self.urgent = False
+                self.sending = True
+            failed = 0
+            for level, messages, process_id, _ in batches:
+                if not self.com.addToProcessLog(level, '\n'.join(messages),
+                                                process_id):
+                    failed += 1
+            with self.condition:
+                self.stats['calls'] += len(batches)
+                self.stats['failed'] += failed
+                self.sending = False
+                self.condition.notify_all()
+
 
 class GoobiLogger():
     """
@@ -24,6 +166,14 @@ class GoobiLogger():
     type_critical = 'critical'
     type_user = 'user'
     
+    py_levels = {'debug': logging.DEBUG,
+                 'info': logging.INFO,
+                 'user': logging.INFO,
+                 'warning': logging.WARNING,
+                 'error': logging.ERROR,
+                 'exception': logging.ERROR,
+                 'critical': logging.CRITICAL}
+    
     
     def __init__( self, 
                   host, 
@@ -31,11 +181,15 @@ class GoobiLogger():
                   process_id, 
                   pyLogger=None, 
                   use_goobi_communication = True,
-                  intervals_between_alive_logs = 60*10):
+                  intervals_between_alive_logs = 60*10,
+                  asynchronous = True):
         
         self.host = host
         self.password_token = password_token
         self.use_goobi_communication = use_goobi_communication
+        # Send messages to Goobi in the background (see LogShipper)
+        self.asynchronous = asynchronous
+        self.shipper = None
         if self.use_goobi_communication: self._com()
         self.process_id = process_id
         self.pyLogger = pyLogger
@@ -63,83 +217,107 @@ class GoobiLogger():
             self.info(alive_msg)
             self.last_alive_timestamp = time.time()
     
-    # logger like interface to goobi.
-    def info( self, message ) :
-        return self._log( 'info', message )
+    # logger like interface to goobi. Messages can have %-style args, which
+    # are only formatted if the message is logged.
+    def info( self, message, *args ) :
+        return self._log( 'info', message, *args )
         
-    def debug( self, message ) :
-        return self._log( 'debug', message )
+    def debug( self, message, *args ) :
+        return self._log( 'debug', message, *args )
     
-    def exception( self, message ) :
-        self._pyLog('exception', message)
-        return self._log( 'error', str(message) )
+    def exception( self, message, *args ) :
+        self._pyLog('exception', message, *args)
+        return self._log( 'error', str(message), *args )
         
-    def warning( self, message ): # Not an actual goobi message but here to complete the set of logging functions. 
-        return self._log( 'warning' , message )
+    def warning( self, message, *args ): # Not an actual goobi message but here to complete the set of logging functions. 
+        return self._log( 'warning' , message, *args )
         
-    def error( self, message ) :
-        return self._log( 'error', message )
+    def error( self, message, *args ) :
+        return self._log( 'error', message, *args )
         
-    def critical( self, message ) :
-        return self._log( 'critical', message )
+    def critical( self, message, *args ) :
+        return self._log( 'critical', message, *args )
         
-    def user( self, message ): # Not part of the python logging but here for completeness.
-        return self._log( 'user', message )
+    def user( self, message, *args ): # Not part of the python logging but here for completeness.
+        return self._log( 'user', message, *args )
+    
+    def flush( self, timeout=FLUSH_TIMEOUT ):
+        '''
+        Wait until messages waiting to be sent to Goobi are sent.
+        '''
+        if self.shipper:
+            return self.shipper.flush(timeout)
+        return True
+    
+    def shipping_stats( self ):
+        '''
+        Return counts of messages sent, dropped and calls to Goobi.
+        '''
+        if self.shipper:
+            with self.shipper.condition:
+                return dict(self.shipper.stats)
+        return None
     
     def _com( self ):
         self.com = GoobiCommunicate( self.host, self.password_token, self.debugging_on )
+        if self.asynchronous:
+            if self.shipper is None:
+                self.shipper = LogShipper( self.com )
+            else:
+                self.shipper.com = self.com
         
-    def _log( self, level, message ):
-        
-        self._pyLog( level, "(PID" + str(self.process_id).zfill(8) +") " + message )
-        dt = datetime.datetime.utcnow().isoformat()
-        formatted_message = self.log_format.format(date=dt,
-                                                   process_id=self.process_id,
-                                                   level=level,
-                                                   message=message )
+    def _log( self, level, message, *args ):
         
-        goobi_message = self.goobi_log_format.format(process_id=self.process_id,
-                                                     level=level,
-                                                     message=message )
-        
-        #if self.debugging_on:
-        #    print(formatted_message)
+        self._pyLog( level, "(PID" + str(self.process_id).zfill(8) +") " + str(message), *args )
         
+        # The level of the Goobi process log entry - the messages are 
+        # formatted with the original level
+        goobi_level = level
         if level == 'warning':
-            level = 'info'
+            goobi_level = 'info'
         elif level == 'critical' :
-            level = 'error'
+            goobi_level = 'error'
         elif level == 'exception' :
-            level = 'error'
-            
+            goobi_level = 'error'
+        
+        send = (self.use_goobi_communication and
+                (goobi_level != 'debug' or self.debugging_on))
+        if goobi_level != 'error' and not send:
+            # Nothing more to do - don't format the message
+            return None
+        if args:
+            message = str(message) % args
         
         # Push the error out to stderr, this will cause Goobi to pause the step if the script is an automatic one.
-        if level == 'error' :
+        if goobi_level == 'error' :
+            dt = datetime.datetime.utcnow().isoformat()
+            formatted_message = self.log_format.format(date=dt,
+                                                       process_id=self.process_id,
+                                                       level=level,
+                                                       message=message )
             sys.stderr.write( "stderr: " + formatted_message + "\n" )
         
-        if (not (level == 'debug') or 
-                (level == 'debug' and self.debugging_on)):
-            if self.use_goobi_communication:
-                return self.com.addToProcessLog(level,goobi_message,
-                                                self.process_id )
+        if send:
+            goobi_message = self.goobi_log_format.format(process_id=self.process_id,
+                                                         level=level,
+                                                         message=message )
+            if self.shipper:
+                return self.shipper.put(goobi_level, goobi_message,
+                                        self.process_id)
+            return self.com.addToProcessLog(goobi_level,goobi_message,
+                                            self.process_id )
 
         
-    def _pyLog( self, level, message ):
+    def _pyLog( self, level, message, *args ):
     
         if self.pyLogger != None:
-            if level == 'warning' :
-                self.pyLogger.warning( message )
-            elif level == 'debug' :
-                self.pyLogger.debug( message )
-            elif level == 'error' :
-                self.pyLogger.error( message )
-            elif level == 'critical' :
-                self.pyLogger.critical( message )
-            elif level == 'info':
-                self.pyLogger.info( message )
-            elif level == 'exception':
-                self.pyLogger.exception( message )
+            py_level = self.py_levels.get( level, logging.INFO )
+            if not self.pyLogger.isEnabledFor( py_level ):
+                return
+            if level == 'exception':
+                self.pyLogger.exception( message, *args )
             elif level == 'user' :
-                self.pyLogger.info( "(Goobi User level) " + message )
+                self.pyLogger.info( "(Goobi User level) " + str(message), *args )
+            else:
+                self.pyLogger.log( py_level, message, *args )
                 
-    
\ No newline at end of file
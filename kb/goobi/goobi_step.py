@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
-import sys, os, os.path, re, traceback, datetime, subprocess
-import logging, logging.handlers
+import time
+# Start of the imports of a step, see profile_startup
+_imports_started = time.perf_counter()
+import sys, os, os.path, re, traceback, datetime, socket
+import logging
 from tools import tools
+from tools.startup_profile import StartupProfile
+from tools import instrumentation
+from tools import polling
 
 from abc import abstractmethod, ABCMeta
 
@@ -32,6 +38,8 @@ class Step( object ):
                 to report to a previous step)
             debug - override config debug value to display additional 
                 information and output more information.
+            profile_startup - if true, print how long each phase of the
+                start of the step took (see tools/startup_profile.py).
         
         First define the setup(s) function.
             give the step a name, 
@@ -82,6 +90,14 @@ class Step( object ):
     
         
     def __init__( self ) :
+        global _imports_started
+        # Imports are only timed for the first step of a process
+        started = _imports_started or time.perf_counter()
+        _imports_started = None
+        self.startup = StartupProfile(started)
+        # Wall clock time of start, for the elapsed time in log records
+        self.started = time.time() - (time.perf_counter() - started)
+        self.startup.mark('imports')
     
         # Default names for essential config
         self.cli_process_id_arg = "process_id"
@@ -125,6 +141,7 @@ class Step( object ):
         
         # Run setup for specific workflow script
         self.setup()
+        self.startup.mark('setup')
         
         # Update 
         self.essential_config_sections.update( [self.config_main_section] ) 
@@ -138,6 +155,7 @@ class Step( object ):
             self.getCommandLine( must_have=self.essential_commandlines )
         # Get process id
         self.process_id = self.command_line.get(self.cli_process_id_arg)
+        self.startup.mark('command line')
         # Load system configuration information
         if self.system_config_path == '':
             if not self.command_line.has("system_config_path"):
@@ -146,6 +164,7 @@ class Step( object ):
                 self.system_config_path = self.command_line.system_config_path 
         self.getConfig(self.system_config_path,
                        must_have=self.essential_system_config_sections )
+        self.startup.mark('system config')
         
         # Load config specific for step
         if self.command_line.has("config_path"):
@@ -172,6 +191,7 @@ class Step( object ):
             self.info_message('config_path: '+self.config_path)
             self.getConfig(self.config_path,
                            must_have=self.essential_config_sections )
+        self.startup.mark('step config')
         
         if self.command_line.has(self.cli_step_name_arg) and self.name == '':
             self.name = self.command_line.get(self.cli_step_name_arg)
@@ -193,11 +213,13 @@ class Step( object ):
                                                      logger_name + "_logger")
         if error:
             self.exit( error,self.glogger )
+        self.startup.mark('loggers')
         self.goobi_com = GoobiCommunicate(self.config.goobi.host,
                                           self.config.goobi.passcode,
                                           self.debug,
                                           process_id = self.process_id
                                           )
+        self.startup.mark('goobi communication')
             #
         # Check Commandline parameters
         if error_command_line:
@@ -228,9 +250,27 @@ class Step( object ):
         update_message += ', REPORT-PROBLEM:' + ( "ON" if self.auto_report_problem else "OFF" ) # if unsuccessful
         update_message += ', DEBUG:' + ( "ON" if self.debug else "OFF" ) + "."
         self.debug_message( update_message )
+        self.reportStartup()
 
 
     def begin(self) :
+        '''
+        Run the step. Return True if it succeeded.
+        '''
+        started = time.time()
+        ok = False
+        try:
+            with instrumentation.timer('step'):
+                ok = self.runStep()
+            return ok
+        finally:
+            # Send the messages of a failed step now, not at exit
+            self.flushLogs()
+            commands = self.commandUsage()
+            self.logCommandUsage(commands)
+            self.writeMetrics(started, ok, commands)
+    
+    def runStep(self) :
         if self.detach:
             # Detach from goobi.
             self.detachSelf()
@@ -266,6 +306,92 @@ class Step( object ):
                 self.error_message(error_msg)
         return (error == None)
     
+    def flushLogs( self ):
+        '''
+        Wait until the messages logged to the Goobi process log are sent
+        (see LogShipper in goobi/goobi_logger.py).
+        '''
+        glogger = getattr( self, 'glogger', None )
+        if isinstance( glogger, GoobiLogger ):
+            glogger.flush()
+
+    def commandUsage( self ):
+        '''
+        Return the resources used by the commands the step ran, per program
+        (see command_usage in tools/processing/processing.py).
+        '''
+        # Not imported if the step ran no commands
+        processing = sys.modules.get('tools.processing.processing')
+        if processing is None:
+            return {}
+        return processing.command_usage()
+
+    def logCommandUsage( self, commands ):
+        '''
+        Log the resources used by each program the step ran if
+        log_command_usage = true in the config.
+        '''
+        try:
+            if not self.getSetting('log_command_usage', bool, default=False):
+                return
+        except (KeyError, ValueError):
+            return
+        for name, usage in sorted(commands.items(),
+                                  key=lambda item: -item[1]['wall_time']):
+            self.info_message('%s: %d runs, %.1f s wall time, %.1f s user, '
+                              '%.1f s system, max %d MB resident memory',
+                              name, usage['runs'], usage['wall_time'],
+                              usage['user_time'], usage['system_time'],
+                              usage['max_rss_kb'] // 1024)
+
+    def writeMetrics( self, started, ok, commands=None ):
+        '''
+        Write the timers and counters of the step (see tools/instrumentation.py)
+        and the resources used by the commands it ran to the folder 
+        step_metrics (setting metrics_folder) in the process folder. Set
+        write_metrics = false in the config to turn it off.
+        '''
+        if not self.command_line.has('process_path'):
+            return
+        try:
+            if not self.getSetting('write_metrics', bool, default=True):
+                return
+            folder = self.getSetting('metrics_folder', default='step_metrics')
+        except (KeyError, ValueError):
+            return
+        folder = os.path.join(self.command_line.get('process_path'), folder)
+        name = self.config_main_section or str(self.name).replace(' ', '_')
+        step_id = None
+        if self.command_line.has(self.cli_step_id_arg):
+            step_id = self.command_line.get(self.cli_step_id_arg)
+        info = {'step': self.name,
+                'script': os.path.basename(sys.argv[0]),
+                'process_id': self.process_id,
+                'step_id': step_id,
+                'ok': ok,
+                'started': datetime.datetime.utcfromtimestamp(started).isoformat() + 'Z',
+                'wall_time': round(time.time() - started, 6),
+                'startup': dict((phase, round(seconds, 6))
+                                for phase, seconds in self.startup.phases),
+                'commands': commands or {}}
+        path = instrumentation.write_metrics(folder, name, info)
+        if path:
+            self.debug_message('Step metrics written to %s', path)
+
+    def reportStartup( self ):
+        '''
+        Print and log the startup phases if profile_startup=true.
+        '''
+        if not (self.command_line.has('profile_startup') and
+                self.command_line.get('profile_startup').lower() == 'true'):
+            return
+        self.startup.mark('checks')
+        title = '{0} (process {1})'.format(self.name, self.process_id)
+        report = self.startup.report(title)
+        print(report)
+        if self.glogger:
+            self.glogger.debug(report)
+
     def reportToStep( self, message ):
         """
             Pass control back to a previous step
@@ -282,6 +408,8 @@ class Step( object ):
             raise KeyError(msg)
         prev_step_name = self.auto_report_problem
 
+        # The process log in Goobi should be complete when the task goes back
+        self.flushLogs()
         self.goobi_com.reportToPrevStep(step_id,prev_step_name,message)
         
     def closeStep(self):
@@ -290,6 +418,8 @@ class Step( object ):
         '''
         
         if self.command_line.has(self.cli_step_id_arg): # Prefer this one
+            # Send the messages of the step before it is closed
+            self.flushLogs()
             self.goobi_com.closeStep( self.command_line.get( self.cli_step_id_arg ) )
         #elif self.command_line.has(self.cli_process_id_arg) :
         #    self.goobi_com.closeStepByProcessId( self.command_line.get( self.cli_process_id_arg ) )
@@ -326,11 +456,9 @@ class Step( object ):
         """
            Return section as dictionary if it exists, otherwise raise key error
         """
-        value = None
         if config == None:
             config = self.config
-        if section in self.config.config.sections():
-            value = dict(self.config.config.items(section))
+        value = config.section(section)
         if value is None:
             error = 'Section {0} not defined in config file.'
             error = error.format(section)
@@ -411,6 +539,36 @@ class Step( object ):
                     ret_val = (ret_val.lower() == 'true')
         return ret_val
 
+    def getPollingPolicy(self, retry_wait, retry_num, page_count=None,
+                         history_key=None):
+        '''
+        Create a polling policy for waiting on work outside of Goobi.
+
+        The deadline is retry_wait*retry_num seconds and retry_wait is the
+        longest wait between two polls. If page_count is given, the expected
+        duration is estimated from the throughput history in the file given
+        by "poll_history_file" (command line or config) under history_key,
+        which defaults to the main config section of the step.
+
+        :param retry_wait: longest wait in seconds between two polls
+        :param retry_num: number of retry_wait periods before giving up
+        :param page_count: (optional) number of pages the awaited job handles
+        :param history_key: (optional) key for the throughput history
+        '''
+        min_wait = self.getSetting('poll_min_wait', float, default=10)
+        history = None
+        if page_count:
+            history_file = self.getSetting('poll_history_file', default='')
+            if history_file:
+                history = polling.ThroughputHistory(history_file)
+        if history_key is None:
+            history_key = self.config_main_section
+        return polling.policyFromRetries(retry_wait, retry_num,
+                                         min_wait=min_wait,
+                                         history=history,
+                                         history_key=history_key,
+                                         page_count=page_count)
+
     def debugging( self) :
         debug = self.getConfigItem( "debug", self.config )
         if not debug:
@@ -549,22 +707,29 @@ class Step( object ):
                        'Cannot create logger for log file {2}.')
                 err = err.format(parent_log_folder,log_folder,log_file)
                 raise IOError(err)
+        # Imported when needed, to keep the startup of steps short
+        from goobi import step_logging
         try:
             rotating_logger_handler = logging.handlers.RotatingFileHandler( log_file, maxBytes=log_max_bytes, backupCount=log_backup_count, encoding='utf-8')
-            # Add Process ID to the log
-            pid = "unknown"
-            if command_line.has( self.cli_process_id_arg ) :
-                pid = str( command_line.get(self.cli_process_id_arg) )
-            
-            rotating_logger_handler.setFormatter( logging.Formatter( "[PID " + pid + '] %(asctime)s (%(levelname)s)   %(message)s') )
+            # log_format = json writes a JSON object per record, see
+            # goobi/step_logging.py
+            if str(self.getSetting('log_format', default='text')).lower() == 'json':
+                rotating_logger_handler.setFormatter( step_logging.JsonFormatter() )
+            else:
+                # Add Process ID to the log
+                pid = "unknown"
+                if command_line.has( self.cli_process_id_arg ) :
+                    pid = str( command_line.get(self.cli_process_id_arg) )
+                
+                rotating_logger_handler.setFormatter( logging.Formatter( "[PID " + pid + '] %(asctime)s (%(levelname)s)   %(message)s') )
             
             if debug :
                 rotating_logger_handler.setLevel( logging.DEBUG )
             else:
                 rotating_logger_handler.setLevel( logging.INFO )
-                
+            
+            # Added to the logger by startLogQueue
             self.glogger_handlers["rotating"] = rotating_logger_handler
-            logger.addHandler( rotating_logger_handler )
             
         except IOError:
             
@@ -582,11 +747,31 @@ class Step( object ):
             if not log_email_subject:
                 log_email_subject = "Goobi Error " + str(self.name)
                 
-            email_logger_handler = logging.handlers.SMTPHandler( "smtp.ox.ac.uk", logger.name + "@goobi.bodleian.ox.ac.uk", log_email, log_email_subject)
+            log_email_host = self.getSetting( "log_email_host", default="localhost" )
+            if ":" in log_email_host:
+                host, port = log_email_host.rsplit( ":", 1 )
+                log_email_host = ( host, int( port ) )
+            log_email_from = self.getSetting( "log_email_from",
+                                              default=logger.name + "@" + socket.getfqdn() )
+            email_logger_handler = logging.handlers.SMTPHandler( log_email_host, log_email_from, log_email, log_email_subject)
             email_logger_handler.setLevel( logging.WARNING )
             
+            # Added to the logger by startLogQueue
             self.glogger_handlers["email"] = email_logger_handler
-            logger.addHandler( email_logger_handler )
+    
+    def startLogQueue( self, command_line, logger ):
+        '''
+        Pass the records of logger to the file and email handlers in a
+        background thread, tagged with process and step id.
+        '''
+        from goobi import step_logging
+        ids = [ command_line.get( arg ) if command_line.has( arg ) else None
+                for arg in ( self.cli_process_id_arg, self.cli_step_id_arg ) ]
+        context = step_logging.StepContextFilter( ids[0], ids[1], self.name,
+                                                  self.started )
+        step_logging.start_queue_logging( logger,
+                                          list( self.glogger_handlers.values() ),
+                                          context )
         
         
     def getGoobiLogger( self, config, command_line, logger, debug ):
@@ -618,6 +803,9 @@ class Step( object ):
     #
         # Create our base logger
         logger = self.getLogger( config, id, debug )
+        # For the file and email handlers. Imported when needed, to keep the
+        # startup of steps short
+        import logging.handlers
         #
         # Add e-mail log in configured
         if use_email:
@@ -625,6 +813,7 @@ class Step( object ):
         #
         # Add rotary file log if configured
         error = self.addRotatingLog( config, config_main_section, command_line, logger, debug )
+        self.startLogQueue( command_line, logger )
         if error:
             return logger, error # Logger will log the error to the email log as the file handler has failed
         #
@@ -633,34 +822,38 @@ class Step( object ):
             logger = self.getGoobiLogger( config, command_line, logger, debug )
         return logger, None    
     
-    def error_message( self, message ):
-        self.error( message )
-    def error( self, message ):
+    # Messages can have %-style args, formatted only if the message is
+    # logged, e.g. self.info('Found %d files in %s', count, path)
+    def error_message( self, message, *args ):
+        self.error( message, *args )
+    def error( self, message, *args ):
         if self.glogger:
-            self.glogger.error( message )
-        self.debuggingPrint( "Error: " + str(message) )
+            self.glogger.error( message, *args )
+        self.debuggingPrint( "Error: " + str(message), *args )
         
-    def warning_message( self, message ):
-        self.warning( message )
-    def warning( self, message ):
+    def warning_message( self, message, *args ):
+        self.warning( message, *args )
+    def warning( self, message, *args ):
         if self.glogger:
-            self.glogger.warning( message )
-        self.debuggingPrint( "Warning: " + str(message) )
+            self.glogger.warning( message, *args )
+        self.debuggingPrint( "Warning: " + str(message), *args )
         
-    def info_message( self, message ):
-        self.info( message )
-    def info( self, message ):
+    def info_message( self, message, *args ):
+        self.info( message, *args )
+    def info( self, message, *args ):
         if self.glogger:
-            self.glogger.info( message )
-        self.debuggingPrint("Info: " + str(message) )
+            self.glogger.info( message, *args )
+        self.debuggingPrint("Info: " + str(message), *args )
     
-    def debug_message( self, message ):
+    def debug_message( self, message, *args ):
         if self.debug:
-            self.debuggingPrint(message)
+            self.debuggingPrint(message, *args)
         
-    def debuggingPrint( self, message ):
+    def debuggingPrint( self, message, *args ):
         if self.glogger:
-            self.glogger.debug(message)
+            self.glogger.debug(message, *args)
         if self.print_debug:
+            if args:
+                message = str(message) % args
             message = message.encode('ascii','replace').decode()
             print("Debug: " + str(message))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+'''
+Metrics of step jobs processed by the step server.
+
+For each step script, the number of jobs done and failed, the throughput
+over the last hour and percentiles of the time jobs waited in the queue
+and took to run are kept. The busy time of the step job processors gives
+their utilisation, which tells whether core_num/processor_num fit the
+load. The metrics are reported by the status verb of the step server and
+its optional HTTP status endpoint (see goobi/status_server.py).
+'''
+import collections
+import math
+import os
+import threading
+import time
+
+from goobi.fair_queue import split_cmd
+
+# Number of latest durations per script used for percentiles
+SAMPLE_SIZE = 500
+# Seconds of finished jobs counted in throughput
+THROUGHPUT_WINDOW = 60*60
+PERCENTILES = [50, 90, 99]
+
+
+def script_name(cmd):
+    '''
+    Return the file name of the script run by a step job command.
+    '''
+    cmd_list = split_cmd(cmd)
+    if len(cmd_list) > 1:
+        return os.path.basename(cmd_list[1])
+    return cmd
+
+
+def percentiles(values, points=PERCENTILES):
+    '''
+    Return dict "p<n>" -> n'th percentile (nearest rank) of values.
+    '''
+    if not values:
+        return dict(('p{0}'.format(p), None) for p in points)
+    values = sorted(values)
+    result = {}
+    for p in points:
+        rank = max(int(math.ceil(p/100.0*len(values))) - 1, 0)
+        result['p{0}'.format(p)] = round(values[min(rank, len(values)-1)], 3)
+    return result
+
+
+class ScriptMetrics():
+    '''
+    Counts and latest durations of the jobs of one step script.
+    '''
+    def __init__(self):
+        self.done = 0
+        self.failed = 0
+        self.run_times = collections.deque(maxlen=SAMPLE_SIZE)
+        self.wait_times = collections.deque(maxlen=SAMPLE_SIZE)
+        self.finished = collections.deque()
+
+    def record(self, wait_time, run_time, ok, now):
+        self.done += 1
+        if not ok:
+            self.failed += 1
+        self.wait_times.append(wait_time)
+        self.run_times.append(run_time)
+        self.finished.append(now)
+        # Trimmed here too, so the history stays bounded when no one asks
+        # for the status
+        self.trim(now)
+
+    def trim(self, now):
+        '''
+        Forget the jobs finished before the throughput window.
+        '''
+        while self.finished and now - self.finished[0] > THROUGHPUT_WINDOW:
+            self.finished.popleft()
+
+    def summary(self, now):
+        self.trim(now)
+        return {'done': self.done,
+                'failed': self.failed,
+                'jobs_last_hour': len(self.finished),
+                'run_time': percentiles(self.run_times),
+                'wait_time': percentiles(self.wait_times)}
+
+
+class JobMetrics():
+    '''
+    Thread safe collection of step job metrics.
+    '''
+    def __init__(self, workers=1):
+        '''
+        :param workers: number of step job processors
+        '''
+        self.workers = workers
+        self.started = time.time()
+        self.busy_time = 0.0
+        self.scripts = {}
+        self.lock = threading.Lock()
+
+    def record(self, job, ok, finished=None):
+        '''
+        Record a job run by a processor. job.started must be set.
+        '''
+        finished = finished or time.time()
+        run_time = max(finished - job.started, 0.0)
+        wait_time = max(job.started - job.enqueued, 0.0)
+        name = script_name(job.cmd)
+        with self.lock:
+            self.busy_time += run_time
+            if name not in self.scripts:
+                self.scripts[name] = ScriptMetrics()
+            self.scripts[name].record(wait_time, run_time, ok, finished)
+
+    def utilisation(self, running_jobs=(), now=None):
+        '''
+        Return the share of processor time spent on jobs since start, and
+        the share of processors busy now.
+        '''
+        now = now or time.time()
+        # Time of jobs still running counts as busy as well
+        busy = self.busy_time + sum(now - job.started for job in running_jobs
+                                    if job.started)
+        capacity = max(now - self.started, 1e-9) * max(self.workers, 1)
+        return {'workers': self.workers,
+                'busy_now': len(running_jobs),
+                'busy_share_now': round(len(running_jobs)/float(max(self.workers, 1)), 3),
+                'busy_share_since_start': round(min(busy/capacity, 1.0), 3),
+                'uptime': round(now - self.started, 1)}
+
+    def summary(self, now=None):
+        '''
+        Return dict script name -> counts, throughput and percentiles.
+        '''
+        now = now or time.time()
+        with self.lock:
+            return dict((name, metrics.summary(now))
+                        for name, metrics in self.scripts.items())
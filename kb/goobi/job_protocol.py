@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+'''
+Protocol between step job clients and the step server.
+
+A message is a JSON object sent as a 4 byte big endian length followed by
+the UTF-8 encoded JSON. A request names a verb, e.g.
+
+    {"verb": "submit", "args": ["python", "/opt/.../script.py", "process_id=1"]}
+    {"verb": "batch-submit", "jobs": [{"args": [...]}, {"cmd": "python ..."}]}
+    {"verb": "status"}
+    {"verb": "status", "job_id": "3f2a..."}
+    {"verb": "cancel", "job_id": "3f2a..."}
+    {"verb": "claim", "node": "box2", "max_jobs": 2, "running": [...]}
+    {"verb": "complete", "node": "box2", "job_id": "3f2a...", "ok": true}
+
+and the response is a JSON object with "ok" set to true or false and an
+"error" message if false. A client may send several requests on the same
+connection.
+
+A job submitted while its priority lane is full is rejected with "busy"
+set to true and "retry_after" telling how many seconds to wait before
+submitting it again (see submit()).
+
+Messages are shorter than 16 MB, so the first byte of a message is always
+0. Anything else is taken as the old plain text protocol: the step job
+command (or a single word like "quit") on one line.
+'''
+import json
+import random
+import shlex
+import socket
+import struct
+import time
+
+MAX_MESSAGE = 2**24 - 1
+
+VERB_SUBMIT = 'submit'
+VERB_BATCH_SUBMIT = 'batch-submit'
+VERB_STATUS = 'status'
+VERB_CANCEL = 'cancel'
+VERB_SHUTDOWN = 'shutdown'
+# Used between step servers, see goobi/cluster.py
+VERB_CLAIM = 'claim'
+VERB_COMPLETE = 'complete'
+
+# First wait in seconds, max wait and max number of retries when submitting
+RETRY_WAIT = 5
+RETRY_MAX_WAIT = 300
+RETRIES = 8
+# Seconds a submit keeps retrying in all, so a Goobi script task isn't 
+# blocked for long by a busy or stopped step server
+SUBMIT_DEADLINE = 300
+
+
+class ProtocolError(Exception):
+    def __init__(self, msg):
+        '''
+        Raised when a message can't be read or is not valid.
+        '''
+        self.strerror = msg
+
+    def __str__(self):
+        return self.strerror
+
+
+def encode(message):
+    data = json.dumps(message).encode('utf-8')
+    if len(data) > MAX_MESSAGE:
+        raise ProtocolError('Message of {0} bytes is too long.'.format(len(data)))
+    return struct.pack('>I', len(data)) + data
+
+
+def _read_exactly(rfile, size):
+    data = rfile.read(size)
+    if data is None or len(data) < size:
+        raise ProtocolError('Connection closed in the middle of a message.')
+    return data
+
+
+def read_message(rfile):
+    '''
+    Read a message from a binary file-like object (e.g. socket.makefile('rb')).
+    Return None if the connection was closed before a new message.
+    '''
+    header = rfile.read(4)
+    if not header:
+        return None
+    if len(header) < 4:
+        raise ProtocolError('Connection closed in the middle of a message.')
+    size = struct.unpack('>I', header)[0]
+    if size > MAX_MESSAGE:
+        raise ProtocolError('Message of {0} bytes is too long.'.format(size))
+    try:
+        message = json.loads(_read_exactly(rfile, size).decode('utf-8'))
+    except ValueError as e:
+        raise ProtocolError('Message is not valid JSON: {0}'.format(e))
+    if not isinstance(message, dict):
+        raise ProtocolError('Message must be a JSON object.')
+    return message
+
+
+def job_command(job):
+    '''
+    Return the command line of a job in a submit request: either "cmd" as is
+    or "args" quoted for the shell, so arguments may contain spaces.
+    '''
+    if 'args' in job:
+        args = job['args']
+        if (not isinstance(args, list) or len(args) < 2 or
+                not all(isinstance(a, str) for a in args)):
+            raise ProtocolError('"args" must be a list of at least two strings.')
+        return ' '.join(shlex.quote(a) for a in args)
+    if 'cmd' in job:
+        cmd = job['cmd']
+        if not isinstance(cmd, str) or len(cmd.split()) < 2:
+            raise ProtocolError('"cmd" must be a command with arguments.')
+        return cmd.strip()
+    raise ProtocolError('A job must have "args" or "cmd".')
+
+
+class StepJobConnection():
+    '''
+    Client connection to a step server, e.g.
+
+        with StepJobConnection('localhost', 37000) as conn:
+            response = conn.request({'verb': 'submit', 'args': args})
+    '''
+    def __init__(self, host, port, timeout=30):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.rfile = self.sock.makefile('rb')
+
+    def request(self, message):
+        self.sock.sendall(encode(message))
+        response = read_message(self.rfile)
+        if response is None:
+            raise ProtocolError('Connection closed by server.')
+        return response
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def request(host, port, message, timeout=30):
+    '''
+    Send a single request to the step server and return the response.
+    '''
+    with StepJobConnection(host, port, timeout) as conn:
+        return conn.request(message)
+
+
+def submit(host, port, args, retries=RETRIES, max_wait=RETRY_MAX_WAIT,
+           timeout=30, log=None, deadline=SUBMIT_DEADLINE):
+    '''
+    Submit a step job given as a list of arguments and return the response.
+
+    If the server is busy or can't be reached, wait and try again up to
+    retries times: as long as the server asks for (retry_after) or else
+    RETRY_WAIT seconds doubled on each retry, at most max_wait seconds, plus
+    up to 20% so clients rejected together don't come back together. A job
+    that did reach the server before the connection failed is not queued
+    twice, as the server coalesces identical jobs.
+
+    No retry is made that would end more than deadline seconds (None for no
+    limit) after the first attempt: the last busy response is returned or 
+    the last error raised instead.
+
+    :param log: optional function called with a message before each retry
+    '''
+    wait = RETRY_WAIT
+    started = time.time()
+    for attempt in range(retries + 1):
+        last_attempt = attempt == retries
+        try:
+            response = request(host, port, {'verb': VERB_SUBMIT, 'args': args},
+                               timeout)
+            if not response.get('busy') or last_attempt:
+                return response
+            delay = response.get('retry_after') or wait
+            reason = response.get('error')
+            error = None
+        except (OSError, ProtocolError) as e:
+            if last_attempt:
+                raise
+            delay = wait
+            reason = str(e)
+            error = e
+        delay = min(delay, max_wait) * random.uniform(1.0, 1.2)
+        if deadline is not None and time.time() + delay - started > deadline:
+            if log:
+                msg = 'Step server {0}:{1} did not take job ({2}) within {3} sec. Giving up.'
+                log(msg.format(host, port, reason, deadline))
+            if error is not None:
+                raise error
+            return response
+        if log:
+            msg = 'Step server {0}:{1} did not take job ({2}). Retrying in {3:.0f} sec.'
+            log(msg.format(host, port, reason, delay))
+        time.sleep(delay)
+        wait = min(wait*2, max_wait)
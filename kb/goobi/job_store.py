@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+'''
+Durable storage for step jobs placed on the step server.
+
+Jobs are written to a SQLite database (WAL journal) when they are added to
+the queue, marked as claimed when a processor takes them and deleted
+(acknowledged) when the processor is done with them. When the step server
+starts, every job that was not acknowledged - queued or claimed by a
+processor that never finished - is loaded again, so a job is executed at
+least once even if the server is killed or crashes.
+
+A job that has been claimed max_attempts times without being acknowledged,
+e.g. because it crashes the server every time, is marked as failed instead
+of being run again. Failed jobs are kept in the database to be looked into.
+'''
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+# Times a job is claimed before it is marked as failed
+MAX_ATTEMPTS = 5
+
+
+class SqliteJobStore():
+    '''
+    Enqueue/claim/ack store of step job commands in a SQLite database.
+    '''
+    state_queued = 'queued'
+    state_claimed = 'claimed'
+    state_failed = 'failed'
+
+    def __init__(self, path, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        folder = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=FULL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS step_jobs ('
+                                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                'uid TEXT, '
+                                'cmd TEXT NOT NULL, '
+                                'state TEXT NOT NULL, '
+                                'enqueued REAL NOT NULL, '
+                                'claimed REAL, '
+                                'attempts INTEGER NOT NULL DEFAULT 0)')
+        columns = [row[1] for row in 
+                   self.connection.execute('PRAGMA table_info(step_jobs)')]
+        if 'uid' not in columns:
+            self.connection.execute('ALTER TABLE step_jobs ADD COLUMN uid TEXT')
+
+    def _execute(self, sql, args=()):
+        with self.lock:
+            return self.connection.execute(sql, args)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        '''
+        Run the statements in the with block as one transaction, holding the
+        database's write lock from the start, so no other connection (e.g.
+        another step server on the same database) changes the rows read.
+        '''
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def enqueue(self, cmd, uid=None):
+        '''
+        Store a new job and return its id.
+        '''
+        cursor = self._execute('INSERT INTO step_jobs '
+                               '(uid, cmd, state, enqueued) '
+                               'VALUES (?, ?, ?, ?)',
+                               (uid, cmd, self.state_queued, time.time()))
+        return cursor.lastrowid
+
+    def claim(self, job_id):
+        '''
+        Mark a queued job as taken by a processor. Return the new state of
+        the job: state_claimed, state_failed if it has been claimed 
+        max_attempts times already, or None if it isn't queued (e.g. it is 
+        claimed by someone else or gone).
+        '''
+        with self._transaction() as connection:
+            row = connection.execute('SELECT state, attempts FROM step_jobs '
+                                     'WHERE id = ?', (job_id,)).fetchone()
+            if row is None or row[0] != self.state_queued:
+                return None
+            if row[1] >= self.max_attempts:
+                connection.execute('UPDATE step_jobs SET state = ? '
+                                   'WHERE id = ?', (self.state_failed, job_id))
+                return self.state_failed
+            connection.execute('UPDATE step_jobs SET state = ?, claimed = ?, '
+                               'attempts = attempts + 1 WHERE id = ?',
+                               (self.state_claimed, time.time(), job_id))
+            return self.state_claimed
+
+    def release(self, job_id):
+        '''
+        Put a claimed job back in the queued state.
+        '''
+        self._execute('UPDATE step_jobs SET state = ?, claimed = NULL '
+                      'WHERE id = ?', (self.state_queued, job_id))
+
+    def ack(self, job_id):
+        '''
+        Remove a job that has been processed.
+        '''
+        self._execute('DELETE FROM step_jobs WHERE id = ?', (job_id,))
+
+    def recover(self):
+        '''
+        Return all unacknowledged jobs as a list of (id, cmd, attempts, uid) in
+        the order they were added. Claimed jobs are put back in the queued state,
+        as the processor that claimed them is gone - or marked as failed if
+        they have been claimed max_attempts times.
+        '''
+        with self._transaction() as connection:
+            connection.execute('UPDATE step_jobs SET state = ? '
+                               'WHERE state = ? AND attempts >= ?',
+                               (self.state_failed, self.state_claimed,
+                                self.max_attempts))
+            connection.execute('UPDATE step_jobs SET state = ?, claimed = NULL '
+                               'WHERE state = ?',
+                               (self.state_queued, self.state_claimed))
+            cursor = connection.execute('SELECT id, cmd, attempts, uid '
+                                        'FROM step_jobs WHERE state = ? '
+                                        'ORDER BY id', (self.state_queued,))
+            return cursor.fetchall()
+
+    def failed(self):
+        '''
+        Return the jobs marked as failed as a list of (id, cmd, attempts, uid).
+        '''
+        cursor = self._execute('SELECT id, cmd, attempts, uid FROM step_jobs '
+                               'WHERE state = ? ORDER BY id',
+                               (self.state_failed,))
+        return cursor.fetchall()
+
+    def count(self, state=None):
+        if state is None:
+            cursor = self._execute('SELECT COUNT(*) FROM step_jobs')
+        else:
+            cursor = self._execute('SELECT COUNT(*) FROM step_jobs '
+                                   'WHERE state = ?', (state,))
+        return cursor.fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
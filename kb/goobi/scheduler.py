@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+'''
+Resource aware selection of step jobs for the step server.
+
+Every step job belongs to a job class, which tells how many cores and how
+much memory a job of the class uses and how many jobs of the class may run
+at the same time (slots). A job declares its class with the argument
+"job_class=<name>" in the step job command; otherwise the class is looked
+up from the name of the script, and finally the default class is used.
+
+The step server runs more processor threads than it has cores. Before a
+processor starts a job, the scheduler checks that the job fits within the
+free cores, memory and slots of its class. Jobs that don't fit are left in
+the queue and later jobs that do fit are started instead, so IO bound
+copy/move steps run alongside CPU bound conversion steps without
+oversubscribing the box. A job that has waited longer than max_bypass
+seconds can no longer be overtaken, so big jobs are not starved by a
+stream of small ones.
+'''
+import os
+import time
+
+from goobi.fair_queue import get_argument, split_cmd
+
+
+class JobClass():
+    '''
+    Resource profile of a kind of step job.
+    '''
+    def __init__(self, name, cpu=1.0, memory=512, slots=None):
+        '''
+        :param name: name of class
+        :param cpu: number of cores a job uses
+        :param memory: memory in MB a job uses
+        :param slots: max number of jobs of this class running at the same
+            time. None for no limit besides cpu and memory.
+        '''
+        self.name = name
+        self.cpu = float(cpu)
+        self.memory = float(memory)
+        self.slots = slots
+
+    def __repr__(self):
+        return 'JobClass({0}, cpu={1}, memory={2}, slots={3})'.format(
+            self.name, self.cpu, self.memory, self.slots)
+
+
+DEFAULT_CLASS = 'default'
+
+# Name -> (cpu, memory in MB, slots)
+DEFAULT_JOB_CLASSES = {
+    # Multithreaded image processing, e.g. ImageMagick in preprocessing
+    'cpu_heavy': (4, 4096, 1),
+    # Single threaded conversion tools, e.g. tesseract, convert, pdftk
+    'cpu': (1, 1024, None),
+    # Copying and moving files, waiting for other servers. Uses no core to
+    # speak of, so it always runs alongside CPU bound jobs (within its slots)
+    'io': (0, 256, 8),
+    DEFAULT_CLASS: (1, 512, None),
+}
+
+# Script file name -> job class name
+DEFAULT_SCRIPT_CLASSES = {
+    'preprocess_dod_images.py': 'cpu_heavy',
+    'create_color_dod_pdf.py': 'cpu',
+    'add_binding_to_dod_bw_pdf.py': 'cpu',
+    'add_frontispieces_to_dod_pdfs.py': 'cpu',
+    'create_thumbnails.py': 'cpu',
+    'split_limb_pdf.py': 'cpu',
+    'copy_to_ocr.py': 'io',
+    'copy_to_limb.py': 'io',
+    'copy_to_webserver.py': 'io',
+    'move_to_goobi.py': 'io',
+    'move_from_ocr_to_goobi.py': 'io',
+    'move_invalid_files.py': 'io',
+    'wait_for_ocr.py': 'io',
+    'wait_for_limb.py': 'io',
+}
+
+
+def total_memory():
+    '''
+    Return the physical memory of the machine in MB.
+    '''
+    try:
+        return (os.sysconf('SC_PAGE_SIZE') *
+                os.sysconf('SC_PHYS_PAGES')) / (1024*1024)
+    except (ValueError, OSError, AttributeError):
+        return 8192
+
+
+class ResourceScheduler():
+    '''
+    Keeps track of the cores, memory and class slots used by running jobs.
+
+    The scheduler is not thread safe by itself - it is used while holding the
+    condition of the step job queue it is attached to.
+    '''
+    def __init__(self, cpu_capacity=None, memory_capacity=None,
+                 job_classes=None, script_classes=None, max_bypass=15*60,
+                 logger=None):
+        '''
+        :param cpu_capacity: number of cores to fill. Default all cores.
+        :param memory_capacity: MB of memory to fill. Default 80% of memory.
+        :param job_classes: dict name -> dict(cpu=, memory=, slots=) that
+            adds to or overrides DEFAULT_JOB_CLASSES
+        :param script_classes: dict script file name -> job class name that
+            adds to or overrides DEFAULT_SCRIPT_CLASSES
+        :param max_bypass: seconds after which a waiting job can no longer
+            be overtaken by later jobs
+        '''
+        self.cpu_capacity = float(cpu_capacity or os.cpu_count() or 1)
+        self.memory_capacity = float(memory_capacity or total_memory()*0.8)
+        self.max_bypass = max_bypass
+        self.logger = logger
+        self.job_classes = {}
+        for name, (cpu, memory, slots) in DEFAULT_JOB_CLASSES.items():
+            self.job_classes[name] = JobClass(name, cpu, memory, slots)
+        for name, settings in (job_classes or {}).items():
+            self.job_classes[name] = JobClass(name, **settings)
+        self.script_classes = dict(DEFAULT_SCRIPT_CLASSES)
+        self.script_classes.update(script_classes or {})
+        self.cpu_used = 0.0
+        self.memory_used = 0.0
+        self.running = {}
+
+    def classify(self, job):
+        '''
+        Return the JobClass of a job, i.e. the class from a "job_class=<name>"
+        argument, the class of the script or the default class.
+        '''
+        job_class = getattr(job, 'job_class', None)
+        if job_class is not None:
+            return job_class
+        name = get_argument(job.cmd, 'job_class')
+        cmd_list = split_cmd(job.cmd)
+        if name is None and len(cmd_list) > 1:
+            name = self.script_classes.get(os.path.basename(cmd_list[1]))
+        if name not in self.job_classes:
+            if name is not None and self.logger:
+                msg = 'Unknown job class "{0}" for step job {1}. Using {2}.'
+                msg = msg.format(name, job.cmd, DEFAULT_CLASS)
+                self.logger.warning(msg)
+            name = DEFAULT_CLASS
+        job.job_class = self.job_classes[name]
+        return job.job_class
+
+    def _demand(self, job_class):
+        # A job bigger than the whole box still runs - when it is alone
+        return (min(job_class.cpu, self.cpu_capacity),
+                min(job_class.memory, self.memory_capacity))
+
+    def fits(self, job):
+        job_class = self.classify(job)
+        slots = job_class.slots
+        if slots is not None and self.running.get(job_class.name, 0) >= slots:
+            return False
+        cpu, memory = self._demand(job_class)
+        return (self.cpu_used + cpu <= self.cpu_capacity + 1e-9 and
+                self.memory_used + memory <= self.memory_capacity + 1e-9)
+
+    def select(self, jobs):
+        '''
+        Return the index of the first job in jobs that can start now, or None.
+        Jobs that have waited longer than max_bypass block later jobs.
+        '''
+        now = time.time()
+        for i, job in enumerate(jobs):
+            if self.fits(job):
+                return i
+            if now - job.enqueued > self.max_bypass:
+                return None
+        return None
+
+    def start(self, job):
+        job_class = self.classify(job)
+        cpu, memory = self._demand(job_class)
+        self.cpu_used += cpu
+        self.memory_used += memory
+        self.running[job_class.name] = self.running.get(job_class.name, 0)+1
+
+    def finish(self, job):
+        job_class = self.classify(job)
+        cpu, memory = self._demand(job_class)
+        self.cpu_used = max(self.cpu_used - cpu, 0.0)
+        self.memory_used = max(self.memory_used - memory, 0.0)
+        self.running[job_class.name] = max(
+            self.running.get(job_class.name, 0)-1, 0)
+
+    def utilisation(self):
+        return {'cpu_used': self.cpu_used,
+                'cpu_capacity': self.cpu_capacity,
+                'memory_used': self.memory_used,
+                'memory_capacity': self.memory_capacity,
+                'running': dict(self.running)}
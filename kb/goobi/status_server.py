@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+'''
+Optional HTTP status endpoint of the step server.
+
+When "status_port" is set in the step server config, GET /status on
+http://<status_host>:<status_port>/ returns the same JSON as the status
+verb of the step server (see goobi/tcp_server.py), e.g. for monitoring or
+a quick look with curl. The endpoint only reads; it can't change the
+queue.
+'''
+import http.server
+import json
+import threading
+
+
+class StatusHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, step_job_queue, logger=None):
+        self.step_job_queue = step_job_queue
+        self.logger = logger
+        http.server.ThreadingHTTPServer.__init__(self, server_address,
+                                                 StatusHTTPHandler)
+
+
+class StatusHTTPHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path not in ('', '/status'):
+            self.send_error(404, 'Only /status is available.')
+            return
+        body = json.dumps(self.server.step_job_queue.status(), indent=2,
+                          sort_keys=True).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.logger:
+            msg = 'Status request from {0}: {1}'
+            msg = msg.format(self.client_address[0], format % args)
+            self.server.logger.debug(msg)
+
+
+def start_status_server(server_address, step_job_queue, logger=None):
+    '''
+    Start serving status in a daemon thread and return the server. Stop it
+    with server.shutdown().
+    '''
+    server = StatusHTTPServer(server_address, step_job_queue, logger)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='status_server')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -9,103 +9,758 @@ Created on 20/06/2014
 import sys
 import os
 import queue
-from threading import Thread
+from threading import Thread, Condition, Event
 import time
 import traceback
+import uuid
 
 # I dont like it, http://stackoverflow.com/a/4284378
 lib_path = os.path.abspath(os.path.dirname(os.path.realpath(__file__))+os.sep+'../')
 sys.path.append(lib_path)
 from tools.processing import processing
+from goobi.fair_queue import (FairQueue, get_argument, job_key, job_lane, 
+                               job_workflow, split_cmd)
+from goobi.job_metrics import script_name
+
+# Placed in a processor's own queue to make it stop after the current job
+STOP = object()
+
+
+def report_problem(goobi_com, job, message, logger=None):
+    '''
+    Send the step of a job that was killed or cancelled back to the step 
+    given by its auto_report_problem argument in Goobi, so the step isn't 
+    left "in work". Jobs without step_id and auto_report_problem are not 
+    reported.
+    '''
+    step_id = get_argument(job.cmd, 'step_id')
+    prev_step_name = get_argument(job.cmd, 'auto_report_problem')
+    if not step_id or not prev_step_name:
+        return
+    if goobi_com is None:
+        err = ('Step job {0} can not be reported to Goobi - no Goobi host '
+               'set up for step server.')
+        if logger: logger.error(err.format(job.cmd))
+        return
+    try:
+        goobi_com.reportToPrevStep(step_id,prev_step_name,message)
+        msg = 'Step {0} sent back to "{1}" in Goobi.'
+        if logger: logger.info(msg.format(step_id,prev_step_name))
+    except Exception as e:
+        err = 'Failed to report step job {0} to Goobi: {1}'
+        if logger: logger.error(err.format(job.cmd,e))
+
+class QueueFullError(Exception):
+    def __init__(self, lane, size, retry_after):
+        '''
+        Raised when a job is submitted to a lane holding its max number of 
+        jobs.
+        '''
+        self.lane = lane
+        self.size = size
+        self.retry_after = retry_after
+        self.strerror = ('Step server busy: {0} jobs in the {1} lane. '
+                         'Retry after {2} sec.')
+        self.strerror = self.strerror.format(size,lane,retry_after)
+    
+    def __str__(self):
+        return self.strerror
+
+class StepJob():
+    '''
+    A step job command, i.e. a python script and its arguments, and the id 
+    it has in the job store of the queue it was placed in (if any).
+    
+    uid identifies the job towards clients (see goobi.job_protocol).
+    
+    Jobs claimed from another step server (see goobi.cluster) are not 
+    durable, i.e. not stored in the job store, and have an on_done 
+    callback reporting them back. node is the name of the worker node 
+    running a job handed out to it.
+    '''
+    def __init__(self,cmd,job_id=None,attempts=0,uid=None):
+        self.cmd = cmd
+        self.id = job_id
+        self.uid = uid or uuid.uuid4().hex
+        self.started = None
+        self.cancel_event = Event()
+        self.durable = True
+        self.on_done = None
+        self.node = None
+        self.lease_expires = None
+        self.attempts = attempts
+        self.enqueued = time.time()
+        self.lane = job_lane(cmd)
+        self.workflow = job_workflow(cmd)
+        self.process_id = get_argument(cmd,'process_id')
+        self.key = job_key(cmd)
+    
+    def __str__(self):
+        return self.cmd
+    
+    def cancel(self):
+        '''
+        Make the processor running the job kill it.
+        '''
+        self.cancel_event.set()
 
 class StepJobQueue():
+    '''
+    Thread safe queue of step jobs, ordered by priority lane and fair 
+    queuing between workflows (see goobi.fair_queue).
+    
+    Getting a job blocks on a condition until a job is added, so a job is
+    picked up the moment it arrives instead of on the next poll. Queues can 
+    share a condition (see StepJobProcessor), which lets a processor wait 
+    on several queues at once.
+    
+    If a job store (see goobi.job_store) is given, every job is stored when 
+    added, claimed when taken and acknowledged with ack() when processed. 
+    Jobs left in the store from an earlier run are placed in the queue 
+    again when it is created.
+    
+    If a scheduler (see goobi.scheduler) is given, processors taking jobs 
+    from this queue only start jobs that fit the free resources.
     
-    def __init__(self,logger):
-        self.step_job_queue = queue.Queue()
+    If metrics (see goobi.job_metrics) are given, processors record the 
+    jobs they run from this queue in them.
+    
+    Jobs can also be claimed by worker nodes (see goobi.cluster). If a node
+    affinity is given, only jobs allowed on a node are started there.
+    
+    A job submitted while a job with the same script, process_id and 
+    step_id is queued is coalesced with the queued job, as Goobi sometimes 
+    triggers a step twice. Only one job per process_id runs at a time, so 
+    two jobs never work on the same process folder at once.
+    
+    max_queued (dict lane -> number) limits the number of jobs waiting in a
+    lane. A job submitted to a full lane is rejected with QueueFullError, 
+    telling the client to retry after retry_after seconds.
+    
+    A job cancelled while queued is reported to Goobi using goobi_com (see 
+    report_problem).
+    '''
+    
+    def __init__(self,logger,condition=None,store=None,scheduler=None,
+                 weights=None,running=None,metrics=None,affinity=None,
+                 lease_time=60,max_queued=None,retry_after=30,
+                 goobi_com=None):
+        self.weights = weights
+        self.step_job_queue = FairQueue(weights)
+        # uid -> job for queued and for running jobs
+        self.queued = {}
+        # key (see goobi.fair_queue.job_key) -> queued job
+        self.keyed = {}
+        self.running = running if running is not None else {}
+        self.condition = condition if condition is not None else Condition()
         self.logger = logger
+        self.store = store
+        self.scheduler = scheduler
+        self.metrics = metrics
+        self.affinity = affinity
+        self.lease_time = lease_time
+        self.max_queued = max_queued or {}
+        self.retry_after = retry_after
+        self.goobi_com = goobi_com
+        if self.store is not None:
+            self.recover()
+    
+    def recover(self):
+        '''
+        Place all unacknowledged jobs in the job store in the queue.
+        '''
+        jobs = []
+        duplicates = []
+        with self.condition:
+            for job_id, cmd, attempts, uid in self.store.recover():
+                job = StepJob(cmd,job_id,attempts,uid)
+                if job.key is not None and job.key in self.keyed:
+                    duplicates.append(job)
+                    continue
+                jobs.append(job)
+                self._enqueue(job)
+            self.condition.notify_all()
+        for job in duplicates:
+            self.ack(job)
+        if jobs and self.logger:
+            msg = '{0} step job(s) recovered from job store: {1}'
+            msg = msg.format(len(jobs),', '.join(str(j) for j in jobs))
+            self.logger.info(msg)
+        failed = self.store.failed()
+        if failed and self.logger:
+            msg = ('{0} step job(s) failed after {1} attempts are kept in the '
+                   'job store and not run again: {2}')
+            msg = msg.format(len(failed),self.store.max_attempts,
+                             ', '.join(row[1] for row in failed))
+            self.logger.warning(msg)
     
     def get_queue(self):
         return self.step_job_queue
     
-    def get(self,block=True, timeout=0.5):
-        return self.step_job_queue.get(block, timeout)
+    def qsize(self):
+        with self.condition:
+            return len(self.step_job_queue)
+    
+    def empty(self):
+        return self.qsize() == 0
+    
+    def get(self,block=True, timeout=None):
+        while True:
+            with self.condition:
+                if block:
+                    self.condition.wait_for(lambda: self.step_job_queue, timeout)
+                if not self.step_job_queue:
+                    raise queue.Empty
+                job = self.take(0)
+            if job is STOP or self.claim(job):
+                return job
+    
+    def take(self, index):
+        '''
+        Remove and return the job at index. Must be called while holding the
+        condition.
+        '''
+        job = self.step_job_queue[index]
+        del self.step_job_queue[index]
+        if job is not STOP:
+            self._unqueue(job)
+        return job
+    
+    def _enqueue(self, job, first=False):
+        if first:
+            self.step_job_queue.appendleft(job)
+        else:
+            self.step_job_queue.append(job)
+        if job is not STOP:
+            self.queued[job.uid] = job
+            if job.key is not None:
+                self.keyed[job.key] = job
+    
+    def _unqueue(self, job):
+        self.queued.pop(job.uid, None)
+        if job.key is not None and self.keyed.get(job.key) is job:
+            del self.keyed[job.key]
+    
+    def _queued_duplicate(self, job):
+        if job is STOP or job.key is None:
+            return None
+        return self.keyed.get(job.key)
+    
+    def _admit(self, job):
+        '''
+        Raise QueueFullError if the lane of job is full. Must be called while
+        holding the condition.
+        '''
+        max_queued = self.max_queued.get(job.lane)
+        if max_queued is None:
+            return
+        size = self.step_job_queue.lane_size(job.lane)
+        if size >= max_queued:
+            raise QueueFullError(job.lane,size,self.retry_after)
+    
+    def put(self, job, first=False, coalesce=False, admit=False):
+        '''
+        Place job in queue and return it. With coalesce, a job with the same
+        key as a queued job is dropped and the queued job is returned. With
+        admit, QueueFullError is raised if the lane of the job is full.
+        '''
+        if isinstance(job, str):
+            job = StepJob(job)
+        if coalesce or admit:
+            with self.condition:
+                duplicate = self._queued_duplicate(job) if coalesce else None
+                if duplicate is None and admit:
+                    self._admit(job)
+            if duplicate is not None:
+                return duplicate
+        if (self.store is not None and job is not STOP and 
+                job.durable and job.id is None):
+            job.id = self.store.enqueue(job.cmd,job.uid)
+        with self.condition:
+            duplicate = self._queued_duplicate(job) if coalesce else None
+            if duplicate is None:
+                self._enqueue(job, first)
+                # Wake all waiting processors - with a shared condition a 
+                # processor may be waiting for another queue than this one
+                self.condition.notify_all()
+        if duplicate is not None:
+            # Identical job placed in queue while this one was stored
+            self.ack(job)
+            return duplicate
+        return job
     
     def add(self, data):
-        data = ' '.join(data)
-        self.step_job_queue.put(data)
-        msg = ('{0} placed in queue. Approx. {1} in queue.')
-        msg = msg.format(data,self.step_job_queue.qsize())
+        return self.submit(' '.join(data))
+    
+    def submit(self, cmd):
+        '''
+        Place the step job command cmd in the queue and return the job - or
+        the queued job doing the same (see goobi.fair_queue.job_key).
+        Raise QueueFullError if the lane of the job is full.
+        '''
+        new_job = StepJob(cmd)
+        try:
+            job = self.put(new_job, coalesce=True, admit=True)
+        except QueueFullError as e:
+            self.logger.warning('{0} rejected. {1}'.format(cmd,e))
+            raise
+        if job is not new_job:
+            msg = ('{0} is already in queue as step job {1}. Not added again.')
+            msg = msg.format(cmd,job.uid)
+        else:
+            msg = ('{0} placed in {1} lane for workflow {2}. Approx. {3} in queue.')
+            msg = msg.format(cmd,job.lane,job.workflow,self.qsize())
         self.logger.info(msg)
+        return job
+    
+    def cancel(self, uid):
+        '''
+        Remove a queued job or kill a running job. Return True if the job 
+        was queued or running.
+        '''
+        with self.condition:
+            job = self.queued.get(uid)
+            if job is None:
+                job = self.running.get(uid)
+                if job is None:
+                    return False
+                job.cancel()
+                msg = 'Step job {0} ({1}) cancelled while running.'
+                self.logger.info(msg.format(uid,job.cmd))
+                return True
+            self.step_job_queue.remove(job)
+            self._unqueue(job)
+        self.ack(job)
+        msg = 'Step job {0} ({1}) cancelled while queued.'
+        self.logger.info(msg.format(uid,job.cmd))
+        err = '{0} cancelled while queued.'.format(script_name(job.cmd))
+        report_problem(self.goobi_com,job,err,self.logger)
+        return True
+    
+    def job_state(self, uid):
+        '''
+        Return "queued", "running" or None if the job is unknown, i.e. done,
+        cancelled or never added.
+        '''
+        with self.condition:
+            if uid in self.queued:
+                return 'queued'
+            if uid in self.running:
+                return 'running'
+        return None
+    
+    def lane_sizes(self):
+        with self.condition:
+            return self.step_job_queue.lane_sizes()
+    
+    def status(self):
+        '''
+        Return a dict with queue depth per lane, the running jobs and, if 
+        available, resource use and job metrics.
+        '''
+        now = time.time()
+        with self.condition:
+            running_jobs = list(self.running.values())
+            status = {'queued': len(self.step_job_queue),
+                      'lanes': self.step_job_queue.lane_sizes(),
+                      'running': len(running_jobs)}
+            if self.scheduler is not None:
+                status['resources'] = self.scheduler.utilisation()
+        status['running_jobs'] = [{'job_id': job.uid,
+                                   'script': script_name(job.cmd),
+                                   'cmd': job.cmd,
+                                   'lane': job.lane,
+                                   'workflow': job.workflow,
+                                   'node': job.node,
+                                   'elapsed': round(now - job.started, 1)}
+                                  for job in sorted(running_jobs,
+                                                    key=lambda j: j.started)]
+        if self.metrics is not None:
+            status['utilisation'] = self.metrics.utilisation(running_jobs,now)
+            status['scripts'] = self.metrics.summary(now)
+        return status
+    
+    def claim(self, job):
+        '''
+        Mark a job taken from the queue as claimed in the job store. Return
+        False if it must not run: it isn't queued in the store (any more) or
+        has failed too many times.
+        '''
+        if self.store is None or job.id is None:
+            return True
+        state = self.store.claim(job.id)
+        if state == self.store.state_claimed:
+            job.attempts += 1
+            return True
+        if state == self.store.state_failed:
+            msg = ('Step job {0} ({1}) failed {2} times. It is not run again, '
+                   'but kept in the job store as failed.')
+            self.logger.error(msg.format(job.uid,job.cmd,job.attempts))
+        else:
+            msg = 'Step job {0} ({1}) is not queued in the job store. Not run.'
+            self.logger.warning(msg.format(job.uid,job.cmd))
+        return False
+    
+    def ack(self, job):
+        if self.store is not None and job.id is not None:
+            self.store.ack(job.id)
+    
+    def done(self, job, ok):
+        '''
+        Acknowledge a processed job and report it back if it was claimed 
+        from another step server.
+        '''
+        self.ack(job)
+        if job.on_done is not None:
+            job.on_done(job, ok)
+    
+    def select(self):
+        '''
+        Return the index of the first job that may start now or None.
+        Must be called while holding the condition.
+        '''
+        if not self.step_job_queue:
+            return None
+        if self.step_job_queue[0] is STOP:
+            return 0
+        locked = self.locked_processes()
+        if self.affinity is None and not locked:
+            if self.scheduler is None:
+                return 0
+            return self.scheduler.select(self.step_job_queue)
+        now = time.time()
+        allowed = [i for i, job in enumerate(self.step_job_queue) 
+                   if job.process_id not in locked and 
+                   (self.affinity is None or self.affinity.allows(job, now=now))]
+        if not allowed:
+            return None
+        if self.scheduler is None:
+            return allowed[0]
+        index = self.scheduler.select([self.step_job_queue[i] for i in allowed])
+        return None if index is None else allowed[index]
+    
+    def locked_processes(self):
+        '''
+        Return the process ids of the running jobs. Must be called while 
+        holding the condition.
+        '''
+        return set(job.process_id for job in self.running.values()
+                   if job.process_id is not None)
+    
+    def claim_remote(self, node, max_jobs, cpu=None, memory=None, 
+                     running=(), wait=0):
+        '''
+        Hand out up to max_jobs jobs to worker node, fitting within cpu cores
+        and memory MB if given. Renew the leases of the jobs in running, the
+        uids of the jobs the node is running. Wait up to wait seconds for a
+        job if none is available.
+        
+        Return the jobs handed out and the uids in running that the node 
+        should cancel, i.e. cancelled or no longer leased to it.
+        '''
+        now = time.time()
+        # The leases are only renewed when the node asks again
+        deadline = now + min(wait, self.lease_time/2.0)
+        with self.condition:
+            cancel = []
+            for uid in running:
+                job = self.running.get(uid)
+                if job is None or job.node != node or job.cancel_event.is_set():
+                    cancel.append(uid)
+                else:
+                    job.lease_expires = now + self.lease_time
+            while True:
+                jobs = self._select_remote(node, max_jobs, cpu, memory)
+                remaining = deadline - time.time()
+                if jobs or remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            now = time.time()
+            for job in jobs:
+                self.step_job_queue.remove(job)
+                self._unqueue(job)
+                job.started = now
+                job.node = node
+                job.lease_expires = now + self.lease_time
+                self.running[job.uid] = job
+        claimed = []
+        for job in jobs:
+            if not self.claim(job):
+                with self.condition:
+                    self.running.pop(job.uid, None)
+                    self.condition.notify_all()
+                continue
+            claimed.append(job)
+            msg = 'Step job {0} ({1}) handed out to node {2}.'
+            self.logger.info(msg.format(job.uid,job.cmd,node))
+        return claimed, cancel
+    
+    def _select_remote(self, node, max_jobs, cpu, memory):
+        jobs = []
+        now = time.time()
+        locked = self.locked_processes()
+        for job in self.step_job_queue:
+            if len(jobs) >= max_jobs:
+                break
+            if job is STOP or job.process_id in locked:
+                continue
+            if self.affinity is not None and not self.affinity.allows(job,node,now):
+                continue
+            if self.scheduler is not None and cpu is not None:
+                job_class = self.scheduler.classify(job)
+                if job_class.cpu > cpu + 1e-9 or job_class.memory > memory:
+                    # Let the node take a job bigger than it has free only
+                    # when it is idle, like the scheduler does locally
+                    if jobs or not self._node_idle(node):
+                        continue
+                cpu -= job_class.cpu
+                memory -= job_class.memory
+            jobs.append(job)
+            if job.process_id is not None:
+                locked.add(job.process_id)
+        return jobs
+    
+    def _node_idle(self, node):
+        return not any(job.node == node for job in self.running.values())
+    
+    def complete_remote(self, node, uid, ok):
+        '''
+        Mark a job handed out to node as done. Return False if the job is 
+        not leased to node (any more).
+        '''
+        with self.condition:
+            job = self.running.get(uid)
+            if job is None or job.node != node:
+                return False
+            del self.running[uid]
+            self.condition.notify_all()
+        if self.metrics is not None:
+            self.metrics.record(job, ok)
+        self.ack(job)
+        msg = 'Step job {0} ({1}) done on node {2}.'
+        self.logger.info(msg.format(uid,job.cmd,node))
+        return True
+    
+    def requeue_expired(self):
+        '''
+        Place jobs of worker nodes whose leases have run out in the queue 
+        again.
+        '''
+        now = time.time()
+        with self.condition:
+            expired = [job for job in self.running.values()
+                       if job.lease_expires is not None and 
+                       job.lease_expires < now]
+            for job in expired:
+                del self.running[job.uid]
+                if job.cancel_event.is_set():
+                    continue
+                if self._queued_duplicate(job) is not None:
+                    # Submitted again meanwhile - the queued job does it
+                    job.cancel()
+                    continue
+                node = job.node
+                job.node = None
+                job.started = None
+                job.lease_expires = None
+                self._enqueue(job)
+                msg = 'Lease of step job {0} on node {1} ran out. Job placed in queue again.'
+                self.logger.warning(msg.format(job.cmd,node))
+            if expired:
+                self.condition.notify_all()
+        for job in expired:
+            if job.cancel_event.is_set():
+                self.ack(job)
+            elif self.store is not None and job.id is not None:
+                self.store.release(job.id)
+    
+    def start(self, job):
+        '''
+        Mark a job taken from this queue as running and reserve resources 
+        for it. Must be called while holding the condition.
+        '''
+        job.started = time.time()
+        self.running[job.uid] = job
+        if self.scheduler is not None:
+            self.scheduler.start(job)
+    
+    def finish(self, job):
+        '''
+        Remove a job started with start() from the running jobs and free its
+        resources.
+        '''
+        with self.condition:
+            self.running.pop(job.uid, None)
+            if self.scheduler is not None:
+                self.scheduler.finish(job)
+            self.condition.notify_all()
+    
+    def drain(self):
+        '''
+        Remove and return all jobs in queue. Jobs are kept in the job store,
+        so they are placed in the queue again on next start.
+        '''
+        with self.condition:
+            jobs = list(self.step_job_queue)
+            self.step_job_queue.clear()
+            self.queued.clear()
+            self.keyed.clear()
+        return jobs
 
 class StepJobProcessor(Thread):
     '''
-    Todo: Document
+    Worker thread executing step jobs.
+    
+    Each processor has its own (non-shared) queue and optionally a queue 
+    shared with other processors. Both queues use the condition of the 
+    shared queue, so the processor sleeps until a job is placed in either of
+    them. Jobs in the processor's own queue are taken first.
+    
+    A job is acknowledged in the queue it came from when it has been
+    processed, so a job interrupted by a crash is run again on next start.
+    
+    stop() places a STOP sentinel first in the processor's own queue, so the
+    processor exits as soon as the job it is running (if any) is done.
+    
+    If a runner (see goobi.step_runner) is given, python step scripts are 
+    run in a warm process from the runner instead of a new shell.
+    
+    A job running longer than its timeout - from timeouts (script file name
+    -> seconds) or default_timeout - or cancelled while running is killed 
+    with its whole process group. If the job has the arguments step_id and
+    auto_report_problem, the step is then sent back to the step named by 
+    auto_report_problem in Goobi using goobi_com (see report_problem), like
+    a failing step does. goobi_com is also used by the processor's own 
+    queue for jobs cancelled while queued.
     '''
-    def __init__(self,logger=None,shared_job_queue=None):
+    def __init__(self,logger=None,shared_job_queue=None,runner=None,
+                 timeouts=None,default_timeout=None,goobi_com=None):
         super(StepJobProcessor, self).__init__()
+        self.shared_job_queue = shared_job_queue
+        self.runner = runner
+        self.timeouts = timeouts or {}
+        self.default_timeout = default_timeout
+        self.goobi_com = goobi_com
+        condition = None
+        scheduler = None
+        weights = None
+        running = None
+        metrics = None
+        affinity = None
         if shared_job_queue is not None:
-            self.shared_job_queue = shared_job_queue
-        self.step_job_queue = queue.Queue()
+            condition = shared_job_queue.condition
+            scheduler = shared_job_queue.scheduler
+            weights = shared_job_queue.weights
+            running = shared_job_queue.running
+            metrics = shared_job_queue.metrics
+            affinity = shared_job_queue.affinity
+        self.step_job_queue = StepJobQueue(logger,condition,
+                                           scheduler=scheduler,
+                                           weights=weights,
+                                           running=running,
+                                           metrics=metrics,
+                                           affinity=affinity,
+                                           goobi_com=goobi_com)
         self.running = True
         self.logger = logger
  
     def add(self, data):
-        data = ' '.join(data)
-        self.step_job_queue.put(data)
-        msg = ('{0} placed in queue. Approx. {1} in queue.')
-        msg = msg.format(data,self.step_job_queue.qsize())
-        self.logger.info(msg)
+        self.step_job_queue.add(data)
  
     def stop(self):
         self.running = False
+        self.step_job_queue.put(STOP,first=True)
+    
+    def next_job(self):
+        '''
+        Block until a job that may start now is available in the processor's
+        own queue or the shared queue. Return the job and the queue it was 
+        taken from.
+        '''
+        queues = [self.step_job_queue]
+        if self.shared_job_queue is not None:
+            queues.append(self.shared_job_queue)
+        condition = self.step_job_queue.condition
+        while True:
+            with condition:
+                while True:
+                    selected = None
+                    for q in queues:
+                        index = q.select()
+                        if index is not None:
+                            selected = (q, index)
+                            break
+                    if selected is not None:
+                        break
+                    # Woken when a job is added or a running job is done
+                    condition.wait()
+                q, index = selected
+                job = q.take(index)
+                if job is not STOP:
+                    q.start(job)
+            if job is STOP or q.claim(job):
+                return job, q
+            # Not to be run - free what start() reserved for it
+            q.finish(job)
  
     def run(self):
-        while self.running:
+        while True:
+            job, source_queue = self.next_job()
+            if job is STOP:
+                break
+            ok = False
             try:
-                time.sleep(4.5)
-                # block until items is placed in queue:
-                if self.step_job_queue.qsize() > 0:
-                    msg = 'Approx. step jobs in non-shared queue: {0}'
-                    msg = msg.format(self.step_job_queue.qsize())
-                    self.logger.info(msg)
-                    job = self.step_job_queue.get(block=True, timeout=0.5)
-                elif self.shared_job_queue is not None:
-                    # shared_job_queue is shared between multiple process
-                    # and thus makes multiprocessing possible
-                    job = self.shared_job_queue.get(block=True, timeout=0.5)
-                else:
-                    # Try anyway
-                    job = self.step_job_queue.get(block=True, timeout=0.5)
-                self.process(job)
-            except queue.Empty:
-                pass
-                #sys.stdout.write('.')
-                #sys.stdout.flush()
-        if not self.step_job_queue.empty():
-            if self.logger: 
-                step_jobs_left = []
-                while not self.step_job_queue.empty():
-                    step_jobs_left.append(self.step_job_queue.get())
-                msg = 'Step jobs left in the queue: {0}'
-                msg = msg.format(', '.join(step_jobs_left))
-                self.logger.info(msg)
+                ok = self.process(job)
+            except Exception:
+                if self.logger: self.logger.error(traceback.format_exc())
+            finally:
+                if source_queue.metrics is not None:
+                    source_queue.metrics.record(job, ok)
+                source_queue.finish(job)
+            source_queue.done(job, ok)
+        step_jobs_left = [str(j) for j in self.step_job_queue.drain() 
+                          if j is not STOP]
+        if step_jobs_left and self.logger:
+            msg = 'Step jobs left in the queue: {0}'
+            msg = msg.format(', '.join(step_jobs_left))
+            self.logger.info(msg)
         msg = 'Step job processor closed.'
         if self.logger: self.logger.info(msg)
                 
-    def process(self,cmd):
+    def job_timeout(self, cmd):
+        '''
+        Return the seconds a step job may run, or None for no limit.
+        '''
+        cmd_list = split_cmd(cmd)
+        script = os.path.basename(cmd_list[1]) if len(cmd_list) > 1 else cmd
+        return self.timeouts.get(script, self.default_timeout)
+    
+    def process(self,job):
         """
-        cmds is simply the of arguments from sys.arg.
+        job.cmd is simply the of arguments from sys.arg.
         The first element is the filename of the calling client.
         The second argument is the path to the python script to be called and
         the arguments to this call.
+        Return True if the step job succeeded.
         """
-        cmd_list = cmd.split()
-        if len(cmd_list) >= 1:
+        cmd = job.cmd
+        cmd_list = split_cmd(cmd)
+        if len(cmd_list) > 1:
             step_job_filename = os.path.basename(cmd_list[1])
             msg = 'Starting step job: {0}'.format(step_job_filename)
             self.logger.info(msg)
+            timeout = self.job_timeout(cmd)
             try:
-                result = processing.run_cmd(cmd, shell=True, print_output=False)
+                if self.runner is not None and self.runner.can_run(cmd):
+                    result = self.runner.run(cmd, raise_errors=False,
+                                             timeout=timeout,
+                                             cancel_event=job.cancel_event)
+                else:
+                    result = processing.run_cmd(cmd, shell=True, 
+                                                print_output=False,
+                                                timeout=timeout,
+                                                raise_errors=False,
+                                                cancel_event=job.cancel_event)
             except Exception as e:
                 err = 'An error occured when processing step job {0}'
                 err = err.format(cmd)
@@ -115,9 +770,27 @@ class StepJobProcessor(Thread):
                 if self.logger: 
                     self.logger.error(err)
                     self.logger.error(traceback.format_exc())
-                return
+                return False
+            if result['timedout'] or result['cancelled']:
+                if result['timedout']:
+                    err = '{0} killed after timeout of {1} sec.'
+                else:
+                    err = '{0} cancelled while running.'
+                err = err.format(step_job_filename,timeout)
+                if self.logger: 
+                    self.logger.error(err)
+                    self.logger.error(result['output'])
+                report_problem(self.goobi_com,job,err,self.logger)
+                return False
+            if result['erred']:
+                err = 'Step job {0} failed with result {1}.'
+                err = err.format(step_job_filename,result['output'])
+                if self.logger: self.logger.error(err)
+                return False
             msg = 'Step job {0} completed with result{1}.'
             msg = msg.format(step_job_filename,result['output'])
             self.logger.info(msg)
+            return True
         else:
-            if self.logger: self.logger.error('An empty job placed on queue.')
\ No newline at end of file
+            if self.logger: self.logger.error('An empty job placed on queue.')
+            return False
\ No newline at end of file
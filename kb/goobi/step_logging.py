@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+'''
+Logging pipeline of steps.
+
+A step logs through a QueueHandler only: records are put in a queue and a
+QueueListener thread passes them on to the sinks (the rotating log file
+and the email log), so a slow disk or mail server doesn't hold up the
+step. Log messages to Goobi are sent in the background by GoobiLogger
+(see LogShipper in goobi/goobi_logger.py).
+
+Messages can be logged with %-style arguments, e.g.
+
+    self.info('Counted %d images in %s', count, path)
+
+They are only formatted by the sinks, and records below the level of all
+sinks aren't made at all.
+
+Every record is tagged with process_id, step_id, the step name and the
+seconds since the step started (elapsed). With log_format = json in the
+config the log file gets a JSON object per line with these and any extra
+fields, e.g. self.glogger.getLogger().info('Done', extra={'pages': 12}):
+
+    {"elapsed": 1.234, "level": "INFO", "message": "Done", "pages": 12,
+     "process_id": "123", "step": "...", "step_id": "456", ...}
+'''
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+# Attributes of every LogRecord - other attributes are extra fields
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None)))
+_RECORD_ATTRIBUTES.update(['message', 'asctime'])
+# Tags added by StepContextFilter
+TAGS = ['process_id', 'step_id', 'step', 'elapsed']
+
+_listeners = []
+_listeners_lock = threading.Lock()
+
+
+class StepContextFilter(logging.Filter):
+    '''
+    Tags records with the process and step they were logged by.
+    '''
+    def __init__(self, process_id=None, step_id=None, step=None,
+                 started=None):
+        super(StepContextFilter, self).__init__()
+        self.process_id = process_id
+        self.step_id = step_id
+        self.step = step
+        self.started = started or time.time()
+
+    def filter(self, record):
+        record.process_id = self.process_id
+        record.step_id = self.step_id
+        record.step = self.step
+        record.elapsed = round(record.created - self.started, 3)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Formats a record as a JSON object on one line.
+    '''
+    def format(self, record):
+        entry = {'time': datetime.datetime.utcfromtimestamp(
+                     record.created).isoformat() + 'Z',
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'thread': record.threadName,
+                 'message': record.getMessage()}
+        for name, value in vars(record).items():
+            if name in TAGS or name not in _RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class StepQueueHandler(logging.handlers.QueueHandler):
+    '''
+    QueueHandler that leaves formatting to the sinks. The records stay in
+    this process, so they don't have to be made picklable.
+    '''
+    def prepare(self, record):
+        if record.exc_info:
+            # The listener may format it after the exception is gone
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def start_queue_logging(logger, handlers, context_filter=None):
+    '''
+    Make logger pass its records to handlers in a QueueListener thread.
+    Return the listener. The logger's level is set to the lowest level of
+    the handlers, so records no handler takes are not made.
+    
+    Without handlers (e.g. the log file couldn't be opened) no queue is set
+    up and the records propagate to the parent loggers as usual, so they
+    are not lost. None is returned then.
+    '''
+    for handler in list(logger.handlers):
+        if isinstance(handler, StepQueueHandler):
+            # From an earlier step in this process
+            logger.removeHandler(handler)
+            stop(handler.listener)
+    if not handlers:
+        logger.propagate = True
+        return None
+    log_queue = queue.SimpleQueue()
+    queue_handler = StepQueueHandler(log_queue)
+    if context_filter is not None:
+        queue_handler.addFilter(context_filter)
+    listener = logging.handlers.QueueListener(log_queue, *handlers,
+                                              respect_handler_level=True)
+    queue_handler.listener = listener
+    logger.setLevel(min(handler.level or logging.DEBUG
+                        for handler in handlers))
+    logger.addHandler(queue_handler)
+    # The sinks get the records from the listener only
+    logger.propagate = False
+    listener.start()
+    with _listeners_lock:
+        _listeners.append(listener)
+    return listener
+
+
+def stop(listener):
+    '''
+    Let listener pass on the records in its queue and stop it.
+    '''
+    with _listeners_lock:
+        if listener not in _listeners:
+            return
+        _listeners.remove(listener)
+    listener.stop()
+
+
+def stop_all():
+    '''
+    Stop all listeners, writing the records still queued. Called at exit
+    (see goobi_logger.flush_all).
+    '''
+    with _listeners_lock:
+        listeners = list(_listeners)
+    for listener in listeners:
+        stop(listener)
+
+atexit.register(stop_all)
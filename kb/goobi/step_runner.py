@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+'''
+Warm execution of step jobs on the step server.
+
+Running a step job as "python script.py ..." in a shell pays for a new
+interpreter and for importing the Step base class and the tools every
+time. The WarmStepRunner instead keeps a multiprocessing fork server with
+these modules already imported. For each job a process is forked from the
+fork server, which loads the step script as a module, creates the Step
+subclass defined in it with the job's arguments as sys.argv and calls
+begin() - exactly what the script's __main__ block does.
+
+Every job still runs in its own process, so a crash, sys.exit() or left
+over state in one step job doesn't affect other jobs or the server.
+Output written to stdout/stderr by the job is collected like the output of
+a shell job.
+'''
+import importlib.util
+import inspect
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import traceback
+
+from goobi import goobi_logger
+from goobi import step_logging
+from goobi.fair_queue import split_cmd
+from tools.processing import processing
+
+# Modules imported once in the fork server instead of in every step job
+DEFAULT_PRELOAD = ['goobi.goobi_step',
+                   'goobi.goobi_communicate',
+                   'goobi.goobi_logger',
+                   'config.config_reader',
+                   'cli.command_line',
+                   'tools.tools',
+                   'tools.filesystem.fs',
+                   'tools.processing.processing']
+
+PYTHON_EXECUTABLES = ['python', 'python3', sys.executable]
+
+
+def find_step_class(module):
+    '''
+    Return the Step subclass defined in module, or None.
+    '''
+    from goobi.goobi_step import Step
+    for obj in vars(module).values():
+        if (inspect.isclass(obj) and issubclass(obj, Step) and
+                obj is not Step and obj.__module__ == module.__name__):
+            return obj
+    return None
+
+
+def _run_step_job(script_path, args, output_path):
+    '''
+    Run in the forked process: load the step script and begin its step.
+    Exit code is 0 if the step succeeded.
+    '''
+    # Send all output of the job to output_path
+    fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    # A process group of its own, so child processes can be killed with it
+    os.setsid()
+    exit_code = 1
+    try:
+        # Time the startup of the step from now, not from when the fork 
+        # server imported goobi_step
+        from goobi import goobi_step
+        goobi_step._imports_started = time.perf_counter()
+        script_dir = os.path.dirname(os.path.abspath(script_path))
+        if script_dir not in sys.path:
+            sys.path.insert(0, script_dir)
+        sys.argv = [script_path] + list(args)
+        name = 'step_job_' + os.path.splitext(os.path.basename(script_path))[0]
+        spec = importlib.util.spec_from_file_location(name, script_path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        step_class = find_step_class(module)
+        if step_class is None:
+            print('No Step class found in {0}'.format(script_path))
+        else:
+            exit_code = 0 if step_class().begin() else 1
+    except SystemExit as e:
+        if e.code in (None, 0):
+            exit_code = 0
+        else:
+            exit_code = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        # os._exit doesn't run atexit functions
+        goobi_logger.flush_all()
+        step_logging.stop_all()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    os._exit(exit_code)
+
+
+class WarmStepRunner():
+    '''
+    Runs step job commands of the form "python <script.py> <args>" in
+    processes forked from a warm fork server.
+    '''
+    def __init__(self, preload=None):
+        self.context = multiprocessing.get_context('forkserver')
+        # '__main__' makes the fork server import the main module (e.g.
+        # step_server.py) once, instead of every job importing it again
+        self.context.set_forkserver_preload(['__main__'] +
+                                            list(preload or DEFAULT_PRELOAD))
+
+    def can_run(self, cmd):
+        '''
+        Return True if cmd is a python step script this runner can execute.
+        '''
+        cmd_list = split_cmd(cmd)
+        return (len(cmd_list) > 1 and
+                cmd_list[0] in PYTHON_EXECUTABLES and
+                cmd_list[1].endswith('.py') and
+                os.path.isfile(cmd_list[1]))
+
+    def start(self, cmd):
+        '''
+        Start a step job and return (process, output_path).
+        '''
+        cmd_list = split_cmd(cmd)
+        fd, output_path = tempfile.mkstemp(prefix='step_job_', suffix='.out')
+        os.close(fd)
+        process = self.context.Process(target=_run_step_job,
+                                       args=(cmd_list[1], cmd_list[2:],
+                                             output_path),
+                                       daemon=False)
+        process.start()
+        return process, output_path
+
+    def _join(self, process, timeout, cancel_event):
+        '''
+        Wait for process to end. Return None, or "timedout"/"cancelled" if
+        its process group was killed.
+        '''
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            wait = None
+            if cancel_event is not None:
+                wait = 1
+            if deadline is not None:
+                remaining = max(deadline - time.time(), 0)
+                wait = remaining if wait is None else min(wait, remaining)
+            process.join(wait)
+            if not process.is_alive():
+                return None
+            if cancel_event is not None and cancel_event.is_set():
+                reason = 'cancelled'
+            elif deadline is not None and time.time() >= deadline:
+                reason = 'timedout'
+            else:
+                continue
+            def wait_process(t):
+                process.join(t)
+                return not process.is_alive()
+            processing.kill_process_group(process.pid, wait_process)
+            return reason
+
+    def collect(self, process, output_path, timeout=None, cancel_event=None):
+        '''
+        Wait for a job started with start() and return a result like
+        processing.run_cmd: a dict with output, erred, timedout, cancelled,
+        stdout and stderr. The job's process group is killed after timeout
+        seconds or when cancel_event is set.
+        '''
+        killed = self._join(process, timeout, cancel_event)
+        try:
+            with open(output_path, 'rb') as f:
+                stdout = f.read()
+        finally:
+            os.remove(output_path)
+        output = 'Stdout: {0}. Stderr: {1}'.format(stdout, b'')
+        if killed == 'timedout':
+            output = 'Step job timeout after {0} sec. {1}'.format(timeout,
+                                                                   output)
+        elif killed == 'cancelled':
+            output = 'Step job cancelled. {0}'.format(output)
+        return {'output': output,
+                'timedout': killed == 'timedout',
+                'cancelled': killed == 'cancelled',
+                'erred': killed is None and process.exitcode != 0,
+                'exitcode': process.exitcode,
+                'stdout': stdout,
+                'stderr': b''}
+
+    def run(self, cmd, raise_errors=True, timeout=None, cancel_event=None):
+        process, output_path = self.start(cmd)
+        retval = self.collect(process, output_path, timeout, cancel_event)
+        retval['cmd'] = cmd
+        if retval['timedout'] and raise_errors:
+            raise processing.TimeoutError(retval['output'])
+        if retval['cancelled'] and raise_errors:
+            raise processing.CancelledError(retval['output'])
+        if retval['erred'] and raise_errors:
+            err = 'Process "{0}" failed with error code {1}. Process output was: {2}.'
+            err = err.format(cmd, retval['exitcode'], retval['output'])
+            raise IOError(err)
+        return retval
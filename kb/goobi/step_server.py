@@ -14,30 +14,88 @@ import json
 lib_path = os.path.abspath(os.path.dirname(os.path.realpath(__file__))+os.sep+'../')
 sys.path.append(lib_path)
 from goobi.step_job_processor import StepJobProcessor, StepJobQueue
+from goobi.job_store import SqliteJobStore
+from goobi.job_metrics import JobMetrics
+from goobi.scheduler import ResourceScheduler
+from goobi.step_runner import WarmStepRunner
+from goobi.status_server import start_status_server
+from goobi import cluster
+from goobi.goobi_communicate import GoobiCommunicate
+from config.config_reader import ConfigReader
 from goobi.tcp_server import StepJobTCPServer, StepJobTCPHandler
 import tools.logging.logger as logger
 
 class ConvertServer():
     
+    def goobi_communicate(self,config,confGet):
+        '''
+        Return a GoobiCommunicate for reporting killed step jobs to Goobi, 
+        using goobi_host and goobi_passcode from config or else the goobi 
+        section of the system config file. None if neither is available.
+        '''
+        host = confGet(config,'goobi_host',None)
+        passcode = confGet(config,'goobi_passcode',None)
+        if host is None or passcode is None:
+            system_config_path = confGet(config,'system_config_path',
+                                         os.path.join(lib_path,'workflows',
+                                                      'system','config.ini'))
+            try:
+                system_config = ConfigReader(system_config_path)
+                host = system_config.goobi.host
+                passcode = system_config.goobi.passcode
+            except Exception as e:
+                err = ('No Goobi host for reporting killed step jobs - '
+                       'failed to read {0}: {1}')
+                self.logger.warning(err.format(system_config_path,e))
+                return None
+        return GoobiCommunicate(host,passcode)
+    
     def signal_term_handler(self,signal, frame):
         self.logger.info('Processor terminated with SIGTERM. Closing gently down.')
         self.server.server_close()
         self.logger.info('Server closed.')
         self.logger.info('Closing {0} step job processor(s).'.format(len(self.step_job_processors)))
-        for step_processor in self.step_job_processors:
-            step_processor.stop()
-            step_processor.join()
+        self.stop_processors()
         self.logger.info('{0} step job processor(s) stopped.'.format(len(self.step_job_processors)))
         self.logger.log_section('Existing server.')
         sys.exit(0)
     
+    def stop_processors(self):
+        '''
+        Tell all step job processors to stop when their current job is done,
+        wait for them and log the jobs left in the shared queue.
+        '''
+        if self.status_server is not None:
+            self.status_server.shutdown()
+            self.status_server.server_close()
+        if self.remote_worker is not None:
+            self.remote_worker.stop()
+        self.lease_reaper.stop()
+        for step_processor in self.step_job_processors:
+            step_processor.stop()
+        for step_processor in self.step_job_processors:
+            step_processor.join()
+        step_jobs_left = [str(j) for j in self.job_queue.drain()]
+        if step_jobs_left:
+            msg = 'Step jobs left in the shared queue: {0}'
+            msg = msg.format(', '.join(step_jobs_left))
+            if self.job_store is not None:
+                msg += ' They are kept in {0} for next start.'
+                msg = msg.format(self.job_store.path)
+            self.logger.info(msg)
+        if self.job_store is not None:
+            self.job_store.close()
+    
     def __init__(self,config_path=None):
         '''
         Initialize step server.
         
-        NB: confGet not yet implemented. Consider using 
-        kb/config/config_reader.py and thus use the settings in 
-        kb/workflows/system/config.ini
+        Settings are read from the optional json file config_path, e.g.
+        {"port": 37000, "core_num": 4, "queue_path": "/tmp/step_jobs.db"}.
+        Missing settings fall back to the defaults below.
+        
+        NB: Consider using kb/config/config_reader.py and thus use the 
+        settings in kb/workflows/system/config.ini
         
         ''' 
         def confGet(config, var,default):
@@ -47,7 +105,8 @@ class ConvertServer():
         
         config = None
         if config_path and os.path.exists(config_path):
-            config = json.load(config_path, parse_float= True, parse_int=True)
+            with open(config_path) as config_file:
+                config = json.load(config_file)
         
         # Setup logger
         log_path = confGet(config,'log_path','/opt/digiverso/logs/step_server/')
@@ -58,33 +117,116 @@ class ConvertServer():
         host = confGet(config,'host','localhost')
         port = confGet(config,'port',37000)
         self.address = (host, port)
-        # Create one processor per core - tesseract 3.03 is not multithreaded
-        # TODO: Add functionality so first thread will always take from non shared
-        # queue, and the others always from the shared.
-        # I.e. if multiple threads call a program with multithreading built-in
-        # the system will heavily loaded. 
+        # The scheduler fills core_num cores - tesseract 3.03 is not 
+        # multithreaded, so a "cpu" job uses one core, while multithreaded
+        # tools are given a job class using more cores (see goobi/scheduler.py).
+        # There are more processor threads than cores, so IO bound jobs can 
+        # run alongside the CPU bound ones.
         self.core_num = confGet(config,'core_num',1)
+        self.processor_num = confGet(config,'processor_num',2*self.core_num)
+        self.scheduler = ResourceScheduler(
+                            cpu_capacity=self.core_num,
+                            memory_capacity=confGet(config,'memory_mb',None),
+                            job_classes=confGet(config,'job_classes',None),
+                            script_classes=confGet(config,'script_classes',None),
+                            max_bypass=confGet(config,'max_bypass',15*60),
+                            logger=self.logger)
         self.step_job_processors = []
         
-        self.job_queue = StepJobQueue(self.logger)
+        # Jobs are stored on disk until processed, so no jobs are lost if the
+        # server is stopped or crashes. Set queue_path to '' to disable.
+        queue_path = confGet(config,'queue_path',
+                             os.path.join(log_path,'step_jobs.db'))
+        self.job_store = None
+        if queue_path:
+            self.logger.info('Using job store {0}'.format(queue_path))
+            self.job_store = SqliteJobStore(queue_path)
+        # Other step servers can claim jobs from this one, and with 
+        # "coordinator": "<host>:<port>" this one claims jobs from another 
+        # (see goobi/cluster.py). Jobs with node=<name> or an argument 
+        # starting with a path in node_paths, e.g. {"/mnt/box2/": "box2"}, 
+        # only run on that node - unless they have waited steal_after sec.
+        self.node = confGet(config,'node',cluster.node_name())
+        affinity = cluster.NodeAffinity(self.node,
+                                        confGet(config,'node_paths',None),
+                                        confGet(config,'steal_after',None))
+        # Jobs from workflows with higher weight get a larger share of each 
+        # priority lane, e.g. {"dod": 2, "tidsskrift": 1, "basis": 1}
+        # With max_queued, e.g. {"bulk": 2000, "normal": 5000}, jobs beyond 
+        # the limit of their lane are rejected and the client is told to 
+        # retry after retry_after seconds.
+        # Killed or cancelled step jobs with auto_report_problem are 
+        # reported to Goobi
+        goobi_com = self.goobi_communicate(config,confGet)
+        self.job_queue = StepJobQueue(self.logger,store=self.job_store,
+                                      scheduler=self.scheduler,
+                                      weights=confGet(config,'workflow_weights',None),
+                                      metrics=JobMetrics(self.processor_num),
+                                      affinity=affinity,
+                                      lease_time=confGet(config,'lease_time',
+                                                         cluster.LEASE_TIME),
+                                      max_queued=confGet(config,'max_queued',None),
+                                      retry_after=confGet(config,'retry_after',30),
+                                      goobi_com=goobi_com)
+        self.lease_reaper = cluster.LeaseReaper(self.job_queue,
+                                                self.job_queue.lease_time/4.0)
+        self.remote_worker = None
+        coordinator = confGet(config,'coordinator',None)
+        if coordinator:
+            self.remote_worker = cluster.RemoteWorker(
+                                    cluster.parse_address(coordinator),
+                                    self.node,self.job_queue,
+                                    self.processor_num,self.logger)
+        # With "execution": "warm" python step scripts are run in processes 
+        # forked from a server with the step modules already imported, 
+        # instead of in a new python interpreter (see goobi/step_runner.py)
+        execution = confGet(config,'execution','shell')
+        self.runner = None
+        if execution == 'warm':
+            self.logger.info('Running step jobs in warm processes.')
+            self.runner = WarmStepRunner(
+                                preload=confGet(config,'warm_preload',None))
+        # Step jobs running longer than their timeout are killed, e.g. 
+        # "job_timeouts": {"preprocess_dod_images.py": 14400}, "job_timeout": 
+        # 21600. No timeout by default.
+        job_timeouts = confGet(config,'job_timeouts',None)
+        job_timeout = confGet(config,'job_timeout',None)
         # Create StepJobProcesser and StepJobServer 
-        self.logger.info('Initiating {0} step job processor(s)...'.format(self.core_num))
-        for i in range(self.core_num):
+        self.logger.info('Initiating {0} step job processor(s)...'.format(self.processor_num))
+        for i in range(self.processor_num):
             self.logger.info('Initiating step job processor {0}...'.format(i+1))
             self.step_job_processors.append(StepJobProcessor(shared_job_queue=self.job_queue,
-                                                             logger=self.logger))
+                                                             logger=self.logger,
+                                                             runner=self.runner,
+                                                             timeouts=job_timeouts,
+                                                             default_timeout=job_timeout,
+                                                             goobi_com=goobi_com))
         self.logger.info('Step job processor(s) started.')
         self.server = StepJobTCPServer(server_address = self.address,
                                        RequestHandlerClass = StepJobTCPHandler,
                                        bind_and_activate=True,
                                        step_job_queue= self.job_queue,
                                        logger=self.logger)
+        # Queue, running jobs and metrics as JSON on 
+        # http://<status_host>:<status_port>/status if status_port is set
+        self.status_address = (confGet(config,'status_host','localhost'),
+                               confGet(config,'status_port',None))
+        self.status_server = None
     
     def start(self):
         self.logger.log_section('Starting step job processor(s)...')
         for step_processor in self.step_job_processors:
             step_processor.start()
             self.logger.info('Step job processor started.')
+        self.lease_reaper.start()
+        if self.remote_worker is not None:
+            self.remote_worker.start()
+        if self.status_address[1]:
+            self.status_server = start_status_server(self.status_address,
+                                                     self.job_queue,
+                                                     self.logger)
+            msg = 'Status available on http://{0}:{1}/status'
+            self.logger.info(msg.format(*self.status_address))
         self.logger.info('Step server started, awaiting jobs...')
         signal.signal(signal.SIGTERM, self.signal_term_handler)
         try:
@@ -99,13 +241,11 @@ class ConvertServer():
         self.server.server_close()
         self.logger.info('Server closed.')
         self.logger.log_section('Stopping {0} step job processor thread(s).'.format(len(self.step_job_processors)))
-        for step_processor in self.step_job_processors:
-            step_processor.stop()
-            step_processor.join()
-            self.logger.info('{0} step job processor thread stopped.')
+        self.stop_processors()
         self.logger.info('{0} step job processor thread(s) stopped.'.format(len(self.step_job_processors)))
         self.logger.log_section('Existing server.')
 
 if __name__ == "__main__":
-    cs = ConvertServer()
+    config_path = sys.argv[1] if len(sys.argv) > 1 else None
+    cs = ConvertServer(config_path)
     cs.start()
@@ -6,11 +6,24 @@ Created on 20/06/2014
 
 @author: jeel
 '''
+import socket
 import socketserver
 import threading
 import time
 
-class StepJobTCPServer(socketserver.TCPServer):
+from goobi import job_protocol
+from goobi.job_protocol import ProtocolError
+from goobi.step_job_processor import QueueFullError
+
+class StepJobTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    '''
+    Step server front end. Each connection is handled in its own thread, so
+    a slow client doesn't hold back other submissions.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+    
     #http://stackoverflow.com/questions/15889241/send-a-variable-to-a-tcphandler-in-python
     def __init__(self, 
                  server_address, 
@@ -27,39 +40,195 @@ class StepJobTCPServer(socketserver.TCPServer):
                                         RequestHandlerClass, 
                                         bind_and_activate=True)
 
-class StepJobTCPHandler(socketserver.BaseRequestHandler):
+def stop_server(server):
+    '''
+    Shut down server in a separate thread - shutdown() waits for 
+    serve_forever to return, see BaseServer in socketserver.
+    '''
+    def stop(server):
+        server.shutdown()
+        time.sleep(0.3)
+    threading.Thread(target=stop, args=(server,)).start()
+
+class StepJobTCPHandler(socketserver.StreamRequestHandler):
     """
-    Todo: document
+    Handles a connection from a step job client.
+    
+    Clients speak the length prefixed JSON protocol described in 
+    goobi/job_protocol.py, or the old plain text protocol: one line with 
+    a step job command or a single command word like "quit".
     """
+    # Seconds a client may be silent before the connection is closed
+    timeout = 30
+    
+    shutdown_commands = ['quit','exit','close','die','incinerate']
 
     def handle(self):
-        step_job_queue = self.server.step_job_queue
-        # self.request is the TCP socket connected to the client
-        self.data = self.request.recv(1024).strip().decode() # Comes as bytes, convert to string
+        try:
+            first_byte = self.rfile.peek(1)[:1]
+        except socket.timeout:
+            return
+        if not first_byte:
+            return
+        if first_byte == b'\x00':
+            self.handle_messages()
+        else:
+            self.handle_text()
+    
+    def log_debug(self, msg):
         if self.server.logger:
-            msg = "{0} wrote: {1}"
-            msg = msg.format(self.client_address[0],self.data)
             self.server.logger.debug(msg)
+    
+    def handle_messages(self):
+        while True:
+            try:
+                message = job_protocol.read_message(self.rfile)
+            except ProtocolError as e:
+                self.send({'ok': False, 'error': str(e)})
+                return
+            except socket.timeout:
+                return
+            if message is None:
+                return
+            msg = "{0} sent: {1}"
+            msg = msg.format(self.client_address[0],message)
+            self.log_debug(msg)
+            self.send(self.dispatch(message))
+    
+    def send(self, response):
+        self.wfile.write(job_protocol.encode(response))
+        self.wfile.flush()
+    
+    def dispatch(self, message):
+        verbs = {job_protocol.VERB_SUBMIT: self.do_submit,
+                 job_protocol.VERB_BATCH_SUBMIT: self.do_batch_submit,
+                 job_protocol.VERB_STATUS: self.do_status,
+                 job_protocol.VERB_CANCEL: self.do_cancel,
+                 job_protocol.VERB_SHUTDOWN: self.do_shutdown,
+                 job_protocol.VERB_CLAIM: self.do_claim,
+                 job_protocol.VERB_COMPLETE: self.do_complete}
+        verb = message.get('verb')
+        if verb not in verbs:
+            return {'ok': False, 'error': 'Unknown verb "{0}".'.format(verb)}
+        try:
+            return verbs[verb](message)
+        except ProtocolError as e:
+            return {'ok': False, 'error': str(e)}
+    
+    def submit(self, cmd):
+        try:
+            job = self.server.step_job_queue.submit(cmd)
+        except QueueFullError as e:
+            return {'ok': False, 'busy': True, 'lane': e.lane,
+                    'retry_after': e.retry_after, 'error': str(e)}
+        return {'ok': True, 'job_id': job.uid, 'lane': job.lane}
+    
+    def do_submit(self, message):
+        return self.submit(job_protocol.job_command(message))
+    
+    def do_batch_submit(self, message):
+        jobs = message.get('jobs')
+        if not isinstance(jobs, list):
+            raise ProtocolError('"jobs" must be a list of jobs.')
+        # Check all jobs before placing any of them in the queue
+        cmds = [job_protocol.job_command(job) for job in jobs]
+        # Jobs rejected because their lane is full have "busy" in their 
+        # result, so the client can submit them again later
+        results = [self.submit(cmd) for cmd in cmds]
+        return {'ok': all(r['ok'] for r in results), 'results': results}
+    
+    def do_status(self, message):
+        step_job_queue = self.server.step_job_queue
+        job_id = message.get('job_id')
+        if job_id is not None:
+            state = step_job_queue.job_state(job_id)
+            return {'ok': True, 'job_id': job_id, 'state': state or 'unknown'}
+        status = step_job_queue.status()
+        status['ok'] = True
+        return status
+    
+    def do_cancel(self, message):
+        job_id = message.get('job_id')
+        if job_id is None:
+            raise ProtocolError('"job_id" missing.')
+        state = self.server.step_job_queue.job_state(job_id) or 'unknown'
+        if self.server.step_job_queue.cancel(job_id):
+            return {'ok': True, 'job_id': job_id, 'state': state, 
+                    'cancelled': True}
+        return {'ok': False, 'job_id': job_id, 'state': 'unknown',
+                'error': 'Job is neither queued nor running.'}
+    
+    def do_claim(self, message):
+        node = message.get('node')
+        if not node:
+            raise ProtocolError('"node" missing.')
+        try:
+            max_jobs = int(message.get('max_jobs', 1))
+            cpu = message.get('cpu')
+            memory = message.get('memory')
+            cpu = None if cpu is None else float(cpu)
+            memory = None if memory is None else float(memory)
+            # Keep the wait below the timeout of the connection
+            wait = min(max(float(message.get('wait', 0)), 0), self.timeout/2)
+        except (TypeError, ValueError):
+            raise ProtocolError('"max_jobs", "cpu", "memory" and "wait" must be numbers.')
+        running = message.get('running', [])
+        if not isinstance(running, list):
+            raise ProtocolError('"running" must be a list of job ids.')
+        jobs, cancel = self.server.step_job_queue.claim_remote(node,max_jobs,
+                                                               cpu,memory,
+                                                               running,wait)
+        return {'ok': True, 
+                'jobs': [{'job_id': job.uid, 'cmd': job.cmd} for job in jobs],
+                'cancel': cancel,
+                'lease_time': self.server.step_job_queue.lease_time}
+    
+    def do_complete(self, message):
+        node = message.get('node')
+        job_id = message.get('job_id')
+        if not node or not job_id:
+            raise ProtocolError('"node" and "job_id" must be given.')
+        ok = bool(message.get('ok', False))
+        if self.server.step_job_queue.complete_remote(node,job_id,ok):
+            return {'ok': True, 'job_id': job_id}
+        return {'ok': False, 'job_id': job_id, 
+                'error': 'Job is not running on node {0}.'.format(node)}
+    
+    def do_shutdown(self, message):
+        stop_server(self.server)
+        return {'ok': True}
+    
+    def handle_text(self):
+        step_job_queue = self.server.step_job_queue
+        try:
+            line = self.rfile.readline(job_protocol.MAX_MESSAGE)
+        except socket.timeout:
+            return
+        self.data = line.strip().decode() # Comes as bytes, convert to string
+        msg = "{0} wrote: {1}"
+        msg = msg.format(self.client_address[0],self.data)
+        self.log_debug(msg)
         command_arguments = self.data.split()
         command_lenght = len(command_arguments)
         if command_lenght == 1:
             command = command_arguments[0] 
-            # TODO: add command to get info about queue
-            if command in ['quit','exit','close','die','incinerate']:
+            if command in self.shutdown_commands:
                 r = ('"{0}" recieved correctly. Shutting down server.')
                 r = r.format(self.data).encode() # encode to bytes to send via socket
-                self.request.sendall(r)
-                def stop_server(server):
-                    server.shutdown()
-                    time.sleep(0.3)
-                # shutdown must be called in a separate thread due to server_forever mechanism - se BaseServer in socketserver
-                threading.Thread(target=stop_server, args=(self.server,)).start().run()
+                self.wfile.write(r)
+                stop_server(self.server)
             else:
                 r = ('"{0}" recieved correctly. Nothing done.')
                 r = r.format(self.data).encode() # encode to bytes to send via socket
-                self.request.sendall(r)
+                self.wfile.write(r)
         elif command_lenght > 1:
-            step_job_queue.add(command_arguments)
+            try:
+                step_job_queue.submit(self.data)
+            except QueueFullError as e:
+                r = ('"{0}" rejected. {1}')
+                r = r.format(self.data,e).encode()
+                self.wfile.write(r)
+                return
             r = ('"{0}" recieved correctly and added to queue')
             r = r.format(self.data).encode() # encode to bytes to send via socket
-            self.request.sendall(r)
\ No newline at end of file
+            self.wfile.write(r)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+from optparse import OptionParser
+
+from goobi.goobi_communicate import GoobiCommunicate
+from goobi.goobi_emulator import start_emulator
+from goobi.goobi_logger import GoobiLogger
+from goobi.job_metrics import percentiles
+
+MODES = ['calls', 'logger', 'bulk', 'steps']
+
+def main():
+	'''
+	Benchmark the communication with Goobi and the throughput of steps
+	offline, against the Goobi emulator (goobi/goobi_emulator.py) started
+	here, or against another host with --host.
+
+	Modes:
+		calls - --calls addToProcessLog/AddProperty calls from --workers threads
+		logger - --calls messages logged with GoobiLogger, until all are sent
+		bulk - --calls AddProperty calls with GoobiCommunicate.bulk()
+		steps - run --step-script --calls times, closing the step in Goobi
+
+	e.g.
+		python goobi_load_test.py --mode calls --calls 2000 --workers 8 --latency 0.02 --failure-rate 0.05
+	'''
+	options = getOptions()
+	emulator = None
+	host = options.host
+	if not host:
+		emulator = start_emulator(token=options.token, latency=options.latency,
+								  jitter=options.jitter,
+								  failure_rate=options.failure_rate,
+								  drop_rate=options.drop_rate)
+		host = '127.0.0.1:{0}'.format(emulator.server_port)
+	print('Load test "{0}" against {1}'.format(options.mode, host))
+	if options.mode == 'calls':
+		result = runCalls(host, options)
+	elif options.mode == 'logger':
+		result = runLogger(host, options)
+	elif options.mode == 'bulk':
+		result = runBulk(host, options)
+	else:
+		result = runSteps(host, options)
+	if emulator:
+		result['goobi_calls'] = emulator.state()['calls']
+		emulator.shutdown()
+	print(json.dumps(result, indent=2, sort_keys=True))
+
+def summary(durations, failed, elapsed):
+	return {'calls': len(durations),
+			'failed': failed,
+			'seconds': round(elapsed, 3),
+			'calls_per_second': round(len(durations)/max(elapsed, 1e-9), 1),
+			'latency': percentiles(durations)}
+
+def runCalls(host, options):
+	'''
+	Make options.calls calls from options.workers threads
+	'''
+	com = GoobiCommunicate(host, options.token, use_spool=False)
+	durations = []
+	failed = [0]
+	lock = threading.Lock()
+	def work(worker):
+		for i in range(worker, options.calls, options.workers):
+			start = time.time()
+			if i % 2:
+				ok = com.addProperty('load_test', i, overwrite=True, process_id=i % 100)
+			else:
+				ok = com.addToProcessLog('info', 'Load test message {0}'.format(i), i % 100)
+			with lock:
+				durations.append(time.time() - start)
+				if not ok: failed[0] += 1
+	start = time.time()
+	threads = [threading.Thread(target=work, args=(w,)) for w in range(options.workers)]
+	for thread in threads: thread.start()
+	for thread in threads: thread.join()
+	result = summary(durations, failed[0], time.time() - start)
+	result['connections'] = com.connection_stats()
+	return result
+
+def runLogger(host, options):
+	'''
+	Log options.calls messages and wait until they are sent
+	'''
+	glogger = GoobiLogger(host, options.token, 1)
+	glogger.com.spool = None
+	start = time.time()
+	for i in range(options.calls):
+		glogger.info('Load test message {0}'.format(i))
+	logged = time.time() - start
+	glogger.flush()
+	sent = time.time() - start
+	return {'messages': options.calls,
+			'seconds_logging': round(logged, 3),
+			'seconds_until_sent': round(sent, 3),
+			'shipping': glogger.shipping_stats(),
+			'connections': glogger.com.connection_stats()}
+
+def runBulk(host, options):
+	'''
+	Set a property on options.calls processes with bulk()
+	'''
+	com = GoobiCommunicate(host, options.token, use_spool=False)
+	calls = [(i, 'addProperty', {'name': 'load_test', 'value': i, 'overwrite': True})
+			 for i in range(options.calls)]
+	start = time.time()
+	results = com.bulk(calls, max_workers=options.workers)
+	elapsed = time.time() - start
+	return {'calls': len(results),
+			'failed': len([r for r in results if not r['ok']]),
+			'seconds': round(elapsed, 3),
+			'calls_per_second': round(len(results)/max(elapsed, 1e-9), 1),
+			'connections': com.connection_stats()}
+
+def runSteps(host, options):
+	'''
+	Run options.step_script options.calls times, one after the other, with
+	a system config pointing at host
+	'''
+	work_dir = tempfile.mkdtemp(prefix='goobi_load_test_')
+	try:
+		config_path = os.path.join(work_dir, 'config.ini')
+		with open(config_path, 'w') as config_file:
+			config_file.write(STEP_CONFIG.format(host=host, token=options.token,
+												 log=os.path.join(work_dir, 'step.log')))
+		env = dict(os.environ, GOOBI_SPOOL=os.path.join(work_dir, 'spool'))
+		durations = []
+		failed = 0
+		start = time.time()
+		for i in range(options.calls):
+			cmd = [sys.executable, options.step_script, 'process_id={0}'.format(i),
+				   'step_id={0}'.format(i), 'auto_complete=true',
+				   'process_path={0}'.format(work_dir),
+				   'system_config_path={0}'.format(config_path)]
+			cmd += options.step_args.split() if options.step_args else []
+			step_start = time.time()
+			step = subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL,
+								  stderr=subprocess.PIPE, universal_newlines=True)
+			durations.append(time.time() - step_start)
+			if step.returncode != 0 or step.stderr:
+				# Goobi steps fail by writing to stderr
+				failed += 1
+				msg = 'Step run {0} failed with exit code {1}: {2}'
+				print(msg.format(i, step.returncode, step.stderr.strip()))
+		result = summary(durations, failed, time.time() - start)
+		result['steps'] = result.pop('calls')
+		result['steps_per_second'] = result.pop('calls_per_second')
+		return result
+	finally:
+		shutil.rmtree(work_dir, ignore_errors=True)
+
+# System config for steps run by the load test
+STEP_CONFIG = '''[general]
+debug = false
+log = {log}
+log_max_bytes = 1000000
+log_backup_count = 1
+log_use_email = false
+log_use_gui_msg = true
+log_email =
+log_email_subject =
+
+[goobi]
+host = {host}
+passcode = {token}
+
+[test]
+'''
+
+def getOptions():
+	parser=OptionParser()
+	parser.add_option('--mode', dest='mode', default='calls', choices=MODES,
+		help='One of: ' + ', '.join(MODES))
+	parser.add_option('--calls', dest='calls', type='int', default=1000,
+		help='Number of calls, messages or step runs.')
+	parser.add_option('--workers', dest='workers', type='int', default=8,
+		help='Number of threads making calls (calls and bulk).')
+	parser.add_option('--host', dest='host',
+		help='Goobi host:port to test. If not given, a local emulator is started.')
+	parser.add_option('--token', dest='token', default='load_test')
+	parser.add_option('--latency', dest='latency', type='float', default=0.0,
+		help='Seconds the emulator delays every call.')
+	parser.add_option('--jitter', dest='jitter', type='float', default=0.0)
+	parser.add_option('--failure-rate', dest='failure_rate', type='float', default=0.0,
+		help='Share of calls the emulator answers with 503.')
+	parser.add_option('--drop-rate', dest='drop_rate', type='float', default=0.0,
+		help='Share of calls the emulator drops without an answer.')
+	parser.add_option('--step-script', dest='step_script',
+		default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'empty_step.py'),
+		help='Step script run in steps mode. Default: empty_step.py next to this script.')
+	parser.add_option('--step-args', dest='step_args',
+		help='More arguments for the step script, e.g. "debug=true".')
+	(options, args) = parser.parse_args()
+	return options
+
+if __name__ == '__main__':
+	main()
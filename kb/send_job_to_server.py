@@ -5,8 +5,8 @@ Created on 26/03/2014
 
 @author: jeel
 '''
-import socket
 from goobi.goobi_step import Step
+from goobi import job_protocol
 import os
 import sys
 
@@ -35,33 +35,37 @@ class StepJobClient( Step ) :
         return error
         
     def send_job_to_server(self):
-        # Create a socket (SOCK_STREAM means a TCP socket)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.glogger.debug('Send data: {0}'.format(self.step_job_cmd))
-        # Connect to server
+        '''
+        Submit the step job to the step server with the JSON protocol (see
+        goobi/job_protocol.py). The arguments are sent as a list, so 
+        arguments containing spaces reach the step job unchanged.
+        If the server is busy or down, the job is sent again with backoff.
+        '''
         msg = 'Connecting to server {0}:{1}'
         msg = msg.format(self.host, self.port)
         self.glogger.debug(msg)
-        sock.connect((self.host, self.port))
-        msg = 'Connected to server {0}:{1}'
-        msg = msg.format(self.host, self.port)
-        self.glogger.debug(msg)
-        # Send data to server
-        sock.sendall((self.step_job_cmd + "\n").encode()) # Convert to bytes
-        msg = 'Data sent to server {0}:{1} - {2}'
-        msg = msg.format(self.host, self.port,self.step_job_cmd)
-        self.glogger.debug(msg)
-        # Receive reciept from the server
-        reciept = sock.recv(1024).decode() # comes as bytes
+        self.glogger.debug('Send data: {0}'.format(self.step_job_cmd))
+        response = job_protocol.submit(self.host, self.port,
+                                       self.step_job_args,
+                                       retries=self.retries,
+                                       log=self.glogger.warning,
+                                       deadline=self.submit_deadline)
         msg = 'Reciept recieved from server {0}:{1} - {2}.'
-        msg = msg.format(self.host,self.port,reciept)
-        self.glogger.debug(msg)
-        msg = 'Step job {0} sent to server'.format(self.step_job_filename)
+        msg = msg.format(self.host,self.port,response)
         self.glogger.debug(msg)
-        # Close socket
-        sock.close()
-        msg = 'Connection to socket server {0}:{1} has been closed.'
-        msg = msg.format(self.host,self.port)
+        if response.get('busy'):
+            err = ('Step server {0}:{1} was busy and did not take step job {2} '
+                   'within {3} sec: {4}')
+            err = err.format(self.host,self.port,self.step_job_filename,
+                             self.submit_deadline,response.get('error'))
+            raise IOError(err)
+        if not response.get('ok'):
+            err = 'Step server {0}:{1} did not accept step job {2}: {3}'
+            err = err.format(self.host,self.port,self.step_job_filename,
+                             response.get('error'))
+            raise IOError(err)
+        msg = 'Step job {0} sent to server with id {1}'
+        msg = msg.format(self.step_job_filename,response.get('job_id'))
         self.glogger.debug(msg)
 
     def getVariables(self):
@@ -72,12 +76,20 @@ class StepJobClient( Step ) :
         
         self.host = self.getConfigItem('host') 
         self.port = int(self.getConfigItem('port'))
+        self.retries = self.getSetting('submit_retries', int,
+                                       default=job_protocol.RETRIES)
+        # Seconds to keep trying before the step fails
+        self.submit_deadline = self.getSetting('submit_deadline', int,
+                                               default=job_protocol.SUBMIT_DEADLINE)
         
         # sys.argv consist of 
         #    0: this path to this script
         #    1: "python"
         #    2: path to step job to execute
         #    3: arguments to step job
+        # The arguments to the step job may include "priority=<lane>" 
+        # (interactive, normal or bulk) to choose the priority lane on the 
+        # server, see goobi/fair_queue.py
         step_job_args = sys.argv[1:]
         # First arg must be python, second must be a script that exists
         if len(step_job_args) < 3:
@@ -96,12 +108,12 @@ class StepJobClient( Step ) :
             err = err.format(step_job_args[1])
             raise ValueError(err)
         self.step_job_filename = step_job_args[1]
-        self.step_job_cmd = ' '.join(step_job_args)
-        if 'add_auto_complete=true' in self.step_job_cmd:
-            self.step_job_cmd = self.step_job_cmd.replace('add_auto_complete=true',
-                                                          'auto_complete=true')
         # Add "auto_complete" to step command
         # Do it this way to avoid "send_job_to_server" to do the auto complete
+        self.step_job_args = [a.replace('add_auto_complete=true',
+                                        'auto_complete=true')
+                              for a in step_job_args]
+        self.step_job_cmd = ' '.join(self.step_job_args)
         
         
 if __name__ == '__main__' :
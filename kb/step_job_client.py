@@ -5,17 +5,17 @@ Created on 26/03/2014
 
 @author: jeel
 '''
-import socket
 import sys
 import tools.logging.logger as logger
 import os
+from goobi import job_protocol
 
 class StepJobClient() :
     
     def __init__(self):
         log_path = '/opt/digiverso/logs/step_client/' 
         log_level = 'INFO'
-        self.logger = logger.setup(log_path,log_level)
+        self.logger = logger.logger(log_path,log_level)
         
         
         '''
@@ -24,7 +24,9 @@ class StepJobClient() :
         1: hostname for server: hostname=<string>
         2: port for server: port=<int>
         3: path to the python script to be executed by server
-        4...: arguments to the python script to be executed by the server
+        4...: arguments to the python script to be executed by the server,
+            optionally including "priority=<lane>" (interactive, normal or
+            bulk) to choose the priority lane on the server
         
         Lenght of sys.argv must thus be equal or larger than 4 
         '''
@@ -59,43 +61,37 @@ class StepJobClient() :
         
     def sendJobToServer(self):
         '''
-        Todo: document this
-        Todo: try-catch exceptions and return meaningful response
+        Submit the step job with the JSON protocol (see goobi/job_protocol.py).
+        If the server is busy or down, the job is sent again with backoff.
+        Return True if the server accepted the job.
         '''
-        # Create a socket (SOCK_STREAM means a TCP socket)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         data = ' '.join(self.step_job_args)
         self.logger.debug('Send data: {0}'.format(data))
         try:
-            # Connect to server and send data
             msg = 'Connecting to server {0}:{1}'
             msg = msg.format(self.host, self.port)
             self.logger.debug(msg)
-            sock.connect((self.host, self.port))
-            msg = 'Connected to server {0}:{1}'
-            msg = msg.format(self.host, self.port)
-            self.logger.debug(msg)
-            sock.sendall(data + "\n")
-            msg = 'Data sent to server {0}:{1} - {2}'
-            msg = msg.format(self.host, self.port,data)
-            self.logger.debug(msg)
-            # Receive data from the server and shut down
-            reciept = sock.recv(1024)
+            reciept = job_protocol.submit(self.host, self.port, 
+                                          self.step_job_args,
+                                          log=self.logger.warning)
             msg = 'Reciept recieved from server {0}:{1} - {2}.'
             msg = msg.format(self.host,self.port,reciept)
             self.logger.debug(msg)
-            msg = 'Step job {0} sent to server'.format(self.step_job_filename)
-            self.logger.info(msg)
         except Exception as e:
             self.logger.error(str(e))
             return False
-        finally:
-            sock.close()
-        return None
+        if not reciept.get('ok'):
+            err = 'Step job {0} not accepted by server: {1}'
+            err = err.format(self.step_job_filename,reciept.get('error'))
+            self.logger.error(err)
+            return False
+        msg = 'Step job {0} sent to server'.format(self.step_job_filename)
+        self.logger.info(msg)
         return True
 
         #return reciept
 if __name__ == '__main__' :
-    StepJobClient().sendJobToServer()
+    # A job not taken by the server fails the script task in Goobi
+    sys.exit(0 if StepJobClient().sendJobToServer() else 1)
 
     
\ No newline at end of file
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+'''
+In-memory index of directory listings.
+
+Wait steps check the same OCR/LIMB output folders and the same input image
+folder over and over. Instead of listing the folder for every question
+(how many files with these extensions, what is the first pdf, does the toc
+exist) a folder is scanned once with os.scandir and the snapshot is reused
+until the modification time of the folder changes, i.e. until a file is
+added, removed or renamed in it.
+
+A folder modified very recently is always rescanned, as a change within
+the same timestamp tick would otherwise go unnoticed.
+'''
+import os
+import threading
+import time
+
+# Folders modified less than this many seconds ago are not trusted
+RACY_WINDOW = 2.0
+# Max number of folders kept in the index
+MAX_ENTRIES = 256
+
+_index = {}
+_lock = threading.Lock()
+
+
+def _ext(name):
+    return os.path.splitext(name)[-1].lstrip('.')
+
+
+class DirectorySnapshot(object):
+    '''
+    The entries of a single folder at a given modification time.
+    '''
+    def __init__(self, path, mtime, entries):
+        '''
+        :param path: path to folder
+        :param mtime: st_mtime_ns of folder when scanned
+        :param entries: dict of entry name -> True if entry is a file
+        '''
+        self.path = path
+        self.mtime = mtime
+        self.entries = entries
+        self.names = sorted(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def exists(self, name):
+        return name in self.entries
+
+    def isFile(self, name):
+        return self.entries.get(name, False)
+
+    def files(self):
+        return [n for n in self.names if self.entries[n]]
+
+    def withExtension(self, valid_exts, files_only=False):
+        '''
+        Return sorted names with an extension (without dot) in valid_exts.
+        '''
+        return [n for n in self.names
+                if _ext(n) in valid_exts and
+                (not files_only or self.entries[n])]
+
+    def countWithExtension(self, valid_exts, files_only=False):
+        return len(self.withExtension(valid_exts, files_only))
+
+    def firstWithExtension(self, ext):
+        '''
+        Return the first name (sorted) ending with ext, or None.
+        '''
+        for name in self.names:
+            if name.endswith(ext):
+                return name
+        return None
+
+
+def _scan(path, mtime):
+    entries = {}
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                entries[entry.name] = entry.is_file()
+            except OSError:
+                entries[entry.name] = False
+    return DirectorySnapshot(path, mtime, entries)
+
+
+def snapshot(path):
+    '''
+    Return a DirectorySnapshot of path, from the index if the folder has not
+    changed since it was scanned. Raises OSError if path is not a folder.
+    '''
+    key = os.path.abspath(path)
+    st = os.stat(key)
+    mtime = st.st_mtime_ns
+    with _lock:
+        snap = _index.get(key)
+    if snap is not None and snap.mtime == mtime:
+        return snap
+    snap = _scan(key, mtime)
+    # Only keep the snapshot if the folder has been quiet for a while
+    if time.time() - st.st_mtime > RACY_WINDOW:
+        with _lock:
+            if len(_index) >= MAX_ENTRIES and key not in _index:
+                _index.pop(next(iter(_index)))
+            _index[key] = snap
+    return snap
+
+
+def invalidate(path=None):
+    '''
+    Forget the snapshot of path, or of all folders if path is None.
+    '''
+    with _lock:
+        if path is None:
+            _index.clear()
+        else:
+            _index.pop(os.path.abspath(path), None)
+
+
+def countWithExtension(path, valid_exts, files_only=False):
+    return snapshot(path).countWithExtension(valid_exts, files_only)
+
+
+def firstWithExtension(path, ext):
+    return snapshot(path).firstWithExtension(ext)
@@ -8,6 +8,7 @@ Created on 13/06/2014
 '''
 import os
 import filecmp
+from tools.filesystem import dir_index
 
 
 def clear_folder(path,also_folder=False,ignore_exceptions=True):
@@ -135,16 +136,7 @@ def create_folder(path):
         os.makedirs(path)
 
 def getFilesInFolderWithExts(src, valid_exts,absolute=False):
+    retval = dir_index.snapshot(src).withExtension(valid_exts, files_only=True)
     if absolute:
-        retval = [os.path.join(src,f)
-                  for f in os.listdir(src)
-                  if (os.path.isfile(os.path.join(src,f)) and
-                      os.path.splitext(f)[-1].lstrip('.') in valid_exts)]
-    else:
-        retval = [f for f in os.listdir(src)
-                  if (os.path.isfile(os.path.join(src,f)) and
-                      os.path.splitext(f)[-1].lstrip('.') in valid_exts)]
-    retval = sorted(retval)
+        retval = [os.path.join(src,f) for f in retval]
     return retval
-
-
@@ -15,6 +15,7 @@ import pprint
 from tools.pdf import misc as pdf_tools
 from tools.image_tools import misc as image_tools
 from tools.filesystem import fs
+from tools import instrumentation
 
 class ImagePreprocessor():
     def __init__(self,src,settings,logger,debug=False):
@@ -564,6 +565,7 @@ class ImagePreprocessor():
     
     def add_to_avg_time_stat(self,proc_time_stat):
         for k,v in proc_time_stat.items():
+            instrumentation.observe('image_preprocessor.' + k, v)
             if k in self.img_proc_info['avg_time_stat']:
                 self.img_proc_info['avg_time_stat'][k][0] += v # sum of secs
                 self.img_proc_info['avg_time_stat'][k][1] += 1 # counts
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+'''
+Timers, counters and histograms to see where the wall time of a step goes.
+
+Time a block or a function:
+
+    from tools import instrumentation
+
+    with instrumentation.timer('convert'):
+        ...
+
+    @instrumentation.timed('mets.addImages')
+    def addImages(...):
+
+or record values and counts yourself:
+
+    instrumentation.observe('page_size_mb', size)
+    instrumentation.count('pages')
+
+Each name keeps a histogram of its values: count, total, min, max, mean
+and counts per bucket (BUCKETS, in seconds for timers). Recording takes a
+lock and a few dict operations, so it can be used in loops over pages.
+
+The metrics are kept per process. Step.begin writes them, with the
+startup phases of the step, as JSON to <process_path>/step_metrics/ when
+the step ends (see write_metrics in goobi/goobi_step.py).
+'''
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+
+# Upper bounds of the histogram buckets
+BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300]
+
+
+class Histogram(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+
+    def summary(self):
+        buckets = {}
+        for i, n in enumerate(self.buckets):
+            if n:
+                bound = 'le_{0}'.format(BUCKETS[i]) if i < len(BUCKETS) else 'inf'
+                buckets[bound] = n
+        return {'count': self.count,
+                'total': round(self.total, 6),
+                'min': None if self.min is None else round(self.min, 6),
+                'max': None if self.max is None else round(self.max, 6),
+                'mean': round(self.total/self.count, 6) if self.count else None,
+                'buckets': buckets}
+
+
+class Metrics(object):
+    '''
+    Thread safe collection of named histograms and counters.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(value)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def timed(self, name=None):
+        '''
+        Decorator timing each call of a function as name (default the
+        function's module and name).
+        '''
+        def decorator(function):
+            timer_name = name or '{0}.{1}'.format(function.__module__,
+                                                 function.__name__)
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with Timer(self, timer_name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        with self.lock:
+            return {'timers': dict((name, histogram.summary())
+                                   for name, histogram in self.histograms.items()),
+                    'counters': dict(self.counters)}
+
+
+class Timer(object):
+    '''
+    Context manager recording the seconds spent in it. A block left with
+    an exception is recorded as well, and counted as <name>.failed.
+    '''
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.started = None
+        self.seconds = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self.started
+        self.metrics.observe(self.name, self.seconds)
+        if exc_type is not None:
+            self.metrics.count(self.name + '.failed')
+        return False
+
+
+# Metrics of this process
+metrics = Metrics()
+observe = metrics.observe
+count = metrics.count
+timer = metrics.timer
+timed = metrics.timed
+snapshot = metrics.snapshot
+reset = metrics.reset
+
+
+def command_name(cmd):
+    '''
+    Return the name of the program run by cmd (a string or a list).
+    '''
+    if isinstance(cmd, (list, tuple)):
+        program = str(cmd[0]) if cmd else ''
+    else:
+        program = str(cmd).strip().split(' ', 1)[0]
+    return os.path.basename(program.strip('"\''))
+
+
+def write_metrics(folder, name, info=None):
+    '''
+    Write the metrics of this process and info (a dict) as JSON to a new
+    file <name>-<time>-<pid>.json in folder. Return its path, or None if
+    it couldn't be written - metrics are never worth failing a step for.
+    '''
+    data = dict(info or {})
+    data.update(snapshot())
+    file_name = '{0}-{1}-{2}.json'.format(
+        name, time.strftime('%Y%m%dT%H%M%S'), os.getpid())
+    path = os.path.join(folder, file_name)
+    try:
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as metrics_file:
+            json.dump(data, metrics_file, indent=2, sort_keys=True,
+                      default=str)
+    except OSError:
+        return None
+    return path
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+'''
+Lazy loading of modules that are slow to import.
+
+    subprocess = lazy_import.lazy_module('subprocess')
+
+returns a module object right away and imports the module the first time an
+attribute of it is used, e.g. subprocess.Popen. A step that never uses the
+module doesn't pay for importing it, which matters for short steps where
+imports are most of the run time (see profile_startup in goobi/goobi_step.py).
+
+Use it for modules only needed by some functions of a module, not for
+modules whose names are used in "from x import y" at module level.
+'''
+import importlib
+import importlib.util
+import sys
+import types
+
+
+class _LazyModule(types.ModuleType):
+    '''
+    Stands in for a module until an attribute of it is used. The module is
+    then imported with importlib (which is thread safe, unlike
+    importlib.util.LazyLoader before python 3.12) and its attributes copied.
+    '''
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazy_module(name):
+    '''
+    Return module name, loaded on first attribute access.
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    if importlib.util.find_spec(name) is None:
+        raise ImportError('No module named {0}'.format(name), name=name)
+    return _LazyModule(name)
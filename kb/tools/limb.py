@@ -3,6 +3,7 @@
 
 import tools.tools as tools
 from tools.errors import DataError
+from tools.filesystem import dir_index
 import os
 
 def tocExists(toc_dir):
@@ -22,7 +23,7 @@ def altoFileCountMatches(alto_dir, input_files_dir,valid_exts):
     number of input files.
     Return boolean
     '''
-    numAlto = len(os.listdir(alto_dir))
+    numAlto = len(dir_index.snapshot(alto_dir))
     numInputFiles = tools.getFileCountWithExtension(input_files_dir,valid_exts)
 
     return numAlto == numInputFiles
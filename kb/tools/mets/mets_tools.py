@@ -6,7 +6,6 @@ Created on 19/08/2014
 
 @author: jeel
 '''
-from xml.dom import minidom
 import pprint
 import sys
 
@@ -16,6 +15,11 @@ from tools.mets import file_sec_tools
 from tools.mets import log_struct_map_tools
 from tools.mets import dmd_sec_tools
 from tools.mets import struct_link_tools
+from tools import instrumentation
+from tools.lazy_import import lazy_module
+
+# Only needed when a METS file is parsed
+minidom = lazy_module('xml.dom.minidom')
 
 
 #===============================================================================
@@ -70,6 +74,7 @@ def articleExists(dict_tree, title, start_page, end_page):
     return False
     
 
+@instrumentation.timed('mets.addNewDocStruct')
 def addNewDocStruct(dict_tree,doc_struct_info,parrent_attrib=None):
     '''
     Returns a dict tree with a (new) doc struct inserted. 
@@ -117,6 +122,7 @@ def containsImages(dict_tree):
     # Both file_sec_tools and physical struct map must be non empty
     return (not empty_file_sec and not empty_phys_struct_map)
 
+@instrumentation.timed('mets.addImages')
 def addImages(dict_tree,image_src):
     '''
     Returns a dict_tree where all the images from image_src has been inserted
@@ -145,6 +151,7 @@ def addImages(dict_tree,image_src):
     dict_tree = file_sec_tools.insert(dict_tree, file_section)
     return dict_tree
 
+@instrumentation.timed('mets.addOffsetToPhysicalStructMap')
 def addOffsetToPhysicalStructMap(dict_tree, page_offset):
     '''
     Adds page_offset to all orderlabels. page_offset is a positive integer.
@@ -159,6 +166,7 @@ def addOffsetToPhysicalStructMap(dict_tree, page_offset):
 # Methods to add pages from children to parent, if parent has no pages
 #===============================================================================
 
+@instrumentation.timed('mets.expandPagesFromChildrenToParent')
 def expandPagesFromChildrenToParent(dict_tree):
     div_key = '{http://www.loc.gov/METS/}div'
     logical_struct_map = log_struct_map_tools.getLogicalStructMap(dict_tree)
@@ -207,6 +215,7 @@ def addPagesOnLevel(logical_struct_map,dict_tree):
 # and splitting pdf-files
 #===============================================================================
 
+@instrumentation.timed('mets.getIssueData')
 def getIssueData(mets_file):
     '''
     Get the required data from the meta.xml
@@ -234,6 +243,7 @@ def getIssueData(mets_file):
             issue_data.update(getDmdMetadata(dmd_sec,dmd_id))
     return issue_data
 
+@instrumentation.timed('mets.getArticleData')
 def getArticleData(data,sections):
     ret_sections = dict([(s,[]) for s in sections])
     mets_ns = 'http://www.loc.gov/METS/'
@@ -389,6 +399,7 @@ def hasMetadataField(data,metadata_key='TitleDocMain'):
             return True
     return False
 
+@instrumentation.timed('mets.addFieldToDocType')
 def addFieldToDocType(data,doc_type,field_name,field_content):
     '''
     Add field_name with content field_content to a random dmd_sec with doc_type.
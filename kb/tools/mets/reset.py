@@ -2,7 +2,11 @@
 # -*- coding: utf-8
 import os
 from datetime import datetime
-from xml.etree.ElementTree import ElementTree, ParseError
+
+from tools.lazy_import import lazy_module
+
+# Only needed when a METS file is reset
+ET = lazy_module('xml.etree.ElementTree')
 
 """
 This function resets a METS-file (meta.xml) to it's initial state. This makes it possible to re-run the workflow.
@@ -55,10 +59,10 @@ def reset_mets_file(folder, test=False, debug=False):
     output_file = input_file
     if test:
         output_file = os.path.join(folder, '{0}_meta_test.xml'.format(datetime.now().strftime("%Y%m%d-%H%M%S")))
-    etree = ElementTree()
+    etree = ET.ElementTree()
     try:
         tree = etree.parse(input_file)
-    except ParseError as e:
+    except ET.ParseError as e:
         print("resetMetsFile: {0} kunne ikkes parses af ElementTree. Fejl besked: {1}".format(input_file, e))
         return False
 
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+'''
+Polling policy for steps that wait for something outside of Goobi, e.g. the
+OCR server or LIMB, to finish.
+
+Instead of a fixed "sleep retry_wait, retry retry_num times" loop the policy
+works with a deadline (the total time a step is allowed to wait) and
+estimates when the job is expected to be done from the page count and the
+historical throughput of earlier jobs:
+
+    - the first check is done immediately, so jobs that are already done
+      are picked up without any waiting
+    - before the expected completion time the policy sleeps most of the
+      remaining expected time, so few polls are wasted on a job that can't
+      be done yet
+    - after the expected completion time the wait between polls grows
+      exponentially from min_wait up to max_wait, with random jitter so
+      many waiting steps don't poll a shared folder in lockstep
+    - no wait ever passes the deadline, and a final check is done at the
+      deadline
+'''
+import json
+import os
+import random
+import time
+
+
+class ThroughputHistory(object):
+    '''
+    Keeps a running average of seconds per page for named jobs (e.g. the
+    config section of a wait step) in a small json file:
+
+        {"wait_for_ocr": {"sec_per_page": 4.2, "samples": 17}, ...}
+
+    Failing to read or write the file is never an error - the history is
+    only used to estimate, so it is simply treated as empty.
+    '''
+    def __init__(self, path, weight=0.3):
+        '''
+        :param path: path to json file. If empty, nothing is stored.
+        :param weight: weight of a new sample in the running average.
+        '''
+        self.path = path
+        self.weight = weight
+        self.data = self._load()
+
+    def _load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        return data
+
+    def secondsPerPage(self, key, default=None):
+        entry = self.data.get(key)
+        if entry and entry.get('sec_per_page'):
+            return float(entry['sec_per_page'])
+        return default
+
+    def expectedDuration(self, key, page_count, default_sec_per_page=None):
+        '''
+        Return expected duration in seconds for a job with page_count pages,
+        or None if nothing is known about the job.
+        '''
+        sec_per_page = self.secondsPerPage(key, default_sec_per_page)
+        if sec_per_page is None or not page_count:
+            return None
+        return sec_per_page*page_count
+
+    def record(self, key, page_count, duration):
+        '''
+        Add the duration of a finished job with page_count pages to the
+        history of key.
+        '''
+        if not self.path or not page_count or page_count <= 0:
+            return
+        sample = float(duration)/page_count
+        # Reload to keep samples written by other steps in the meantime
+        self.data = self._load()
+        entry = self.data.get(key)
+        if entry and entry.get('sec_per_page'):
+            avg = ((1-self.weight)*float(entry['sec_per_page']) +
+                   self.weight*sample)
+            samples = int(entry.get('samples', 0)) + 1
+        else:
+            avg = sample
+            samples = 1
+        self.data[key] = {'sec_per_page': round(avg, 4), 'samples': samples}
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.data, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class PollingPolicy(object):
+    '''
+    Decides when to check whether a job is done. Use wait() to poll a check
+    function until it returns something truthy or the deadline is reached:
+
+        policy = PollingPolicy(timeout=10*60*60, min_wait=10, max_wait=300,
+                               expected_duration=2400)
+        if not policy.wait(ocrIsReady):
+            return 'Timed out waiting for ocr output.'
+    '''
+    def __init__(self, timeout, min_wait=5, max_wait=300,
+                 expected_duration=None, backoff=2.0, jitter=0.2,
+                 history=None, history_key=None, page_count=None):
+        '''
+        :param timeout: seconds from start of wait() to the deadline
+        :param min_wait: shortest wait between two polls
+        :param max_wait: longest wait between two polls after the expected
+            completion time
+        :param expected_duration: (optional) expected seconds until the job
+            is done. If not given it is estimated from history and
+            page_count.
+        :param backoff: factor the wait grows with for each poll after the
+            expected completion time
+        :param jitter: relative random variation of each wait, e.g. 0.2 for
+            +/- 20%
+        :param history: (optional) ThroughputHistory used to estimate the
+            expected duration and to record the duration when done
+        :param history_key: key of the job in history
+        :param page_count: number of pages the job processes
+        '''
+        self.timeout = max(float(timeout), 0)
+        self.min_wait = max(float(min_wait), 0.01)
+        self.max_wait = max(float(max_wait), self.min_wait)
+        self.backoff = max(float(backoff), 1.0)
+        self.jitter = min(max(float(jitter), 0.0), 1.0)
+        self.history = history
+        self.history_key = history_key
+        self.page_count = page_count
+        if (expected_duration is None and history is not None and
+                history_key is not None):
+            expected_duration = history.expectedDuration(history_key,
+                                                         page_count)
+        self.expected_duration = expected_duration
+        self.started = None
+        self.deadline = None
+        self.polls = 0
+        self.overdue_polls = 0
+
+    def start(self):
+        self.started = time.time()
+        self.deadline = self.started + self.timeout
+        self.polls = 0
+        self.overdue_polls = 0
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return time.time() - self.started
+
+    def remaining(self):
+        if self.deadline is None:
+            return self.timeout
+        return max(self.deadline - time.time(), 0.0)
+
+    def nextWait(self):
+        '''
+        Return seconds to wait before the next poll, never past the deadline.
+        '''
+        elapsed = self.elapsed()
+        if (self.expected_duration is not None and
+                elapsed < self.expected_duration):
+            # Cover most of the time left until the job is expected done, so
+            # the polls close in on the expected completion time.
+            wait = max((self.expected_duration - elapsed)*0.8, self.min_wait)
+        else:
+            wait = min(self.min_wait*(self.backoff**self.overdue_polls),
+                       self.max_wait)
+            self.overdue_polls += 1
+        if self.jitter:
+            wait *= random.uniform(1-self.jitter, 1+self.jitter)
+        return min(max(wait, 0.0), self.remaining())
+
+    def wait(self, check, log=None):
+        '''
+        Call check() until it returns something truthy or the deadline is
+        reached. Return True if check succeeded, otherwise False.
+
+        :param check: function without arguments
+        :param log: (optional) function taking a message, e.g. a debug logger
+        '''
+        self.start()
+        while True:
+            self.polls += 1
+            if check():
+                self._recordDuration()
+                return True
+            remaining = self.remaining()
+            if remaining <= 0:
+                if log:
+                    msg = 'Deadline reached after {0} polls in {1} seconds.'
+                    msg = msg.format(self.polls, round(self.elapsed()))
+                    log(msg)
+                return False
+            wait = self.nextWait()
+            if log:
+                msg = ('Not ready after poll {0} - sleeping for {1} seconds '
+                       '({2} seconds left before deadline).')
+                msg = msg.format(self.polls, round(wait, 1), round(remaining))
+                log(msg)
+            time.sleep(wait)
+
+    def _recordDuration(self):
+        # A job that was done at the first poll finished at some unknown
+        # time before we started waiting, so it says nothing of throughput.
+        if self.history is None or self.history_key is None:
+            return
+        if self.polls > 1:
+            self.history.record(self.history_key, self.page_count,
+                                self.elapsed())
+
+
+def policyFromRetries(retry_wait, retry_num, min_wait=None, **kwargs):
+    '''
+    Create a PollingPolicy from the classic retry_wait/retry_num settings:
+    the deadline is retry_wait*retry_num seconds and retry_wait is the
+    longest wait between two polls.
+    '''
+    retry_wait = float(retry_wait)
+    if min_wait is None:
+        min_wait = min(retry_wait, 10)
+    return PollingPolicy(timeout=retry_wait*int(retry_num),
+                         min_wait=min(float(min_wait), retry_wait),
+                         max_wait=retry_wait,
+                         **kwargs)
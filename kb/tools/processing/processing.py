@@ -10,7 +10,11 @@ import subprocess
 import time
 import signal
 import os
-import shlex
+import selectors
+import threading
+from concurrent import futures
+
+from tools import instrumentation
 
 class TimeoutError(Exception):
     def __init__(self, value):
@@ -18,55 +22,342 @@ class TimeoutError(Exception):
     def __str__(self):
         return repr(self.value)
 
+class CancelledError(Exception):
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+# Seconds a process group gets to exit on SIGTERM before it is killed
+KILL_GRACE = 10
+# Bytes read from a pipe at a time
+READ_SIZE = 65536
+# Longest line passed to an output callback - longer lines are split
+MAX_LINE = 65536
+
+def kill_process_group(pid, wait, grace=KILL_GRACE):
+    '''
+    Terminate process pid and every process in its process group (pid must
+    be the group leader, e.g. started with os.setsid): send SIGTERM, give 
+    the process grace seconds to exit, then send SIGKILL to the group to 
+    kill anything left, e.g. children ignoring SIGTERM.
+    
+    wait(timeout) must wait for (and reap) process pid and return True if 
+    it has exited.
+    '''
+    def signal_group(sig):
+        try:
+            os.killpg(pid, sig)
+        except ProcessLookupError:
+            # Group not created yet or already gone - signal the process
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+    signal_group(signal.SIGTERM)
+    wait(grace)
+    signal_group(signal.SIGKILL)
+    wait(None)
+
+class _AccountedPopen(subprocess.Popen):
+    '''
+    Popen reaping the process with os.wait4 to keep the resources it used
+    in self.rusage. They include the children it waited for, e.g. the 
+    program run by a shell.
+    '''
+    rusage = None
+    
+    def _try_wait(self, wait_flags):
+        try:
+            (pid, sts, rusage) = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            # SIGCHLD is ignored or the process was reaped elsewhere - its
+            # status (and usage) is lost
+            pid = self.pid
+            sts = 0
+        else:
+            if pid == self.pid:
+                self.rusage = rusage
+        return (pid, sts)
+
+# Resources used by the commands run in this process, per program name
+_usage = {}
+_usage_lock = threading.Lock()
+
+def _record_usage(usage):
+    with _usage_lock:
+        total = _usage.get(usage['command'])
+        if total is None:
+            total = _usage[usage['command']] = {'runs': 0,
+                                                'wall_time': 0.0,
+                                                'user_time': 0.0,
+                                                'system_time': 0.0,
+                                                'max_rss_kb': 0}
+        total['runs'] += 1
+        for key in ['wall_time', 'user_time', 'system_time']:
+            total[key] = round(total[key] + (usage[key] or 0), 6)
+        total['max_rss_kb'] = max(total['max_rss_kb'], usage['max_rss_kb'] or 0)
+
+def command_usage():
+    '''
+    Return the resources used by the commands run with processExe/run_cmd
+    in this process, per program name, e.g.
+    
+    {'convert': {'runs': 12, 'wall_time': 30.5, 'user_time': 25.3,
+                 'system_time': 1.2, 'max_rss_kb': 512000}, ...}
+    
+    Times are seconds summed over the runs, max_rss_kb is the largest peak
+    resident memory of a single run.
+    '''
+    with _usage_lock:
+        return dict((name, dict(total)) for name, total in _usage.items())
+
+def reset_command_usage():
+    with _usage_lock:
+        _usage.clear()
+
+def _wait_popen(process):
+    def wait(timeout):
+        try:
+            process.wait(timeout)
+            return True
+        except subprocess.TimeoutExpired:
+            return False
+    return wait
+
+class _Output():
+    '''
+    Output read from a pipe of a process. Each line is passed to callback
+    (a str without the line break) as soon as it is read. If max_output 
+    is given, only the first and the last max_output/2 bytes are kept.
+    '''
+    def __init__(self, callback=None, max_output=None):
+        self.callback = callback
+        self.max_output = max_output
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.dropped = 0
+        self.line = bytearray()
+    
+    def add(self, data):
+        if self.max_output is None:
+            self.head += data
+        else:
+            room = max(self.max_output // 2 - len(self.head), 0)
+            self.head += data[:room]
+            self.tail += data[room:]
+            keep = self.max_output - self.max_output // 2
+            if len(self.tail) > keep:
+                self.dropped += len(self.tail) - keep
+                del self.tail[:len(self.tail) - keep]
+        if self.callback is not None:
+            self.line += data
+            while True:
+                end = self.line.find(b'\n')
+                if end < 0:
+                    if len(self.line) < MAX_LINE:
+                        break
+                    end = MAX_LINE
+                self._pass_on(self.line[:end])
+                del self.line[:end + 1]
+    
+    def close(self):
+        if self.callback is not None and self.line:
+            self._pass_on(self.line)
+            self.line = bytearray()
+    
+    def _pass_on(self, line):
+        self.callback(bytes(line).rstrip(b'\r').decode('utf-8', 'replace'))
+    
+    @property
+    def truncated(self):
+        return self.dropped > 0
+    
+    def value(self):
+        if not self.truncated:
+            return bytes(self.head + self.tail)
+        marker = '\n[... {0} bytes left out ...]\n'.format(self.dropped)
+        return bytes(self.head) + marker.encode('ascii') + bytes(self.tail)
+
+def _result(cmd, **values):
+    '''
+    Return a result of run_cmd for cmd with values set.
+    '''
+    retval = {'output': None,
+              'timedout': False,
+              'cancelled': False,
+              'erred': False,
+              'stdout': None,
+              'stderr':None,
+              'cmd':cmd,
+              'usage':None,
+              'truncated':False,
+              'returncode':None}
+    retval.update(values)
+    return retval
+
 class processExe():
     def __init__(self,
                  cmd,
                  shell= False,
                  print_output=False,
                  timeout=None,
-                 raise_errors=True):
+                 raise_errors=True,
+                 cancel_event=None,
+                 stdout_callback=None,
+                 stderr_callback=None,
+                 max_output=None):
+        '''
+        cancel_event is an optional threading.Event. When it is set, the 
+        process group is killed like on timeout.
+        
+        stdout_callback and stderr_callback are called with each line the
+        process writes (a str without the line break) while it runs, e.g.
+        to log the progress of a long conversion.
+        
+        max_output limits the bytes of stdout and of stderr kept in memory:
+        the first and the last max_output/2 bytes are kept, and the result
+        has truncated=True if anything was left out.
+        '''
         self.cmd = cmd
         self.shell = shell
         self.print_output = print_output
         self.timeout=timeout
         self.raise_errors = raise_errors
+        self.cancel_event = cancel_event
+        self.stdout_callback = stdout_callback
+        self.stderr_callback = stderr_callback
+        self.max_output = max_output
+        self.truncated = False
     
     def _start_process(self):
-        return subprocess.Popen(self.cmd,
+        return _AccountedPopen(self.cmd,
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE,
                                 stdin=subprocess.PIPE,
                                 preexec_fn=os.setsid, #to call sigterm to process
                                 shell=self.shell)
+    
+    def _communicate(self, process):
+        '''
+        Read the output of process until it has ended. Both pipes are read
+        as output arrives, so a process writing a lot to one of them never
+        blocks. Return stdout, stderr and None, or "timedout"/"cancelled"
+        if the process group was killed.
+        '''
+        # Nothing is written to the process
+        process.stdin.close()
+        outputs = {process.stdout: _Output(self.stdout_callback, self.max_output),
+                   process.stderr: _Output(self.stderr_callback, self.max_output)}
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        reason = None
+        with selectors.DefaultSelector() as selector:
+            for pipe in outputs:
+                selector.register(pipe, selectors.EVENT_READ)
+            try:
+                while True:
+                    wait = None
+                    if self.cancel_event is not None:
+                        wait = 1
+                    if deadline is not None:
+                        remaining = max(deadline - time.time(), 0)
+                        wait = remaining if wait is None else min(wait, remaining)
+                    if selector.get_map():
+                        self._read(selector, outputs, wait)
+                    elif _wait_popen(process)(wait):
+                        break
+                    if self.cancel_event is not None and self.cancel_event.is_set():
+                        reason = 'cancelled'
+                    elif deadline is not None and time.time() >= deadline:
+                        reason = 'timedout'
+                    if reason:
+                        break
+            except BaseException:
+                # E.g. from a callback - don't leave the process running
+                kill_process_group(process.pid, _wait_popen(process))
+                raise
+            if reason:
+                # Kill whole group - needed because shell is true
+                # Works in linux 
+                kill_process_group(process.pid, _wait_popen(process))
+                # Take what is left in the pipes, but don't wait for 
+                # processes outside the group still holding them
+                while selector.get_map() and self._read(selector, outputs, 0):
+                    pass
+            for pipe in list(selector.get_map().values()):
+                selector.unregister(pipe.fileobj)
+                pipe.fileobj.close()
+        for output in outputs.values():
+            output.close()
+        self.truncated = any(output.truncated for output in outputs.values())
+        return outputs[process.stdout].value(), outputs[process.stderr].value(), reason
+    
+    def _read(self, selector, outputs, wait):
+        '''
+        Read from the pipes with output within wait seconds. Return False
+        if none had any.
+        '''
+        ready = selector.select(wait)
+        for key, events in ready:
+            data = os.read(key.fd, READ_SIZE)
+            if data:
+                outputs[key.fileobj].add(data)
+            else:
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+        return bool(ready)
+
+    def _usage(self, process, started):
+        '''
+        Return the wall time, user and system cpu time (seconds) and peak
+        resident memory (kB) of process, which has exited.
+        '''
+        usage = {'command': instrumentation.command_name(self.cmd),
+                 'wall_time': round(time.time() - started, 6),
+                 'user_time': None,
+                 'system_time': None,
+                 'max_rss_kb': None}
+        if process.rusage is not None:
+            usage['user_time'] = round(process.rusage.ru_utime, 6)
+            usage['system_time'] = round(process.rusage.ru_stime, 6)
+            # kB on Linux
+            usage['max_rss_kb'] = process.rusage.ru_maxrss
+        return usage
 
     def run(self):
         # Todo add this one to get better output from run
-        retval = {'output': None,
-                  'timedout': False,
-                  'erred': False,
-                  'stdout': None,
-                  'stderr':None,
-                  'cmd':self.cmd}
+        retval = _result(self.cmd)
+        started = time.time()
         try:
             process = self._start_process()
         except Exception as e:
             raise e
-        try:
-            error_code = process.wait(self.timeout)
-        except subprocess.TimeoutExpired:
-            # Kill whole group - needed because shell is true
-            # Works in linux 
-            os.killpg(process.pid, signal.SIGTERM)
-            stdout, stderr = process.communicate()
+        stdout, stderr, killed = self._communicate(process)
+        retval['usage'] = self._usage(process, started)
+        _record_usage(retval['usage'])
+        retval['truncated'] = self.truncated
+        retval['returncode'] = process.returncode
+        if killed == 'timedout':
             msg = 'Process "{0}" timeout after {1} sec. Stdout: {2}. Stderr: {3}'
-            msg = msg.format(shlex.split(self.cmd)[0],self.timeout,stdout,stderr)
+            msg = msg.format(instrumentation.command_name(self.cmd),self.timeout,stdout,stderr)
             if self.raise_errors:
                 raise TimeoutError(msg)
             else:
                 retval['timedout'] = True
                 retval['output'] = msg
                 return retval
-        stdout, stderr = process.communicate()
+        if killed == 'cancelled':
+            msg = 'Process "{0}" cancelled. Stdout: {1}. Stderr: {2}'
+            msg = msg.format(instrumentation.command_name(self.cmd),stdout,stderr)
+            if self.raise_errors:
+                raise CancelledError(msg)
+            else:
+                retval['cancelled'] = True
+                retval['output'] = msg
+                return retval
+        error_code = process.returncode
         output = 'Stdout: {0}. Stderr: {1}'.format(stdout, stderr)
         if error_code > 0:
             err = 'Process "{0}" failed with error code {1}. Process output was: {2}.'
@@ -84,7 +375,102 @@ class processExe():
         return retval
 
     
-def run_cmd(cmd,shell=False,print_output=False,timeout=None,raise_errors=True):
-    pe = processExe(cmd,shell,print_output,timeout,raise_errors)
-    return pe.run()
+def run_cmd(cmd,shell=False,print_output=False,timeout=None,raise_errors=True,
+            cancel_event=None,stdout_callback=None,stderr_callback=None,
+            max_output=None):
+    pe = processExe(cmd,shell,print_output,timeout,raise_errors,cancel_event,
+                    stdout_callback,stderr_callback,max_output)
+    with instrumentation.timer('run_cmd.' + instrumentation.command_name(cmd)):
+        return pe.run()
+
+def run_many(cmds,max_workers=None,shell=False,timeout=None,fail_fast=False,
+             raise_errors=True,cancel_event=None,max_output=None):
+    '''
+    Run many commands, max_workers (default the number of cpus) at a time,
+    e.g. a convert per image. Return their results in the order of cmds,
+    each a dict like the result of run_cmd with the key skipped added.
+    
+    A command in cmds is a string or list like the cmd of run_cmd, or a 
+    dict of run_cmd arguments for that command only, e.g. 
+    {'cmd': 'pdftk ...', 'timeout': 600}. shell, timeout and max_output are
+    the defaults for all commands. raise_errors and cancel_event in such a
+    dict are ignored - those of run_many apply to all commands.
+    
+    If fail_fast is true, the first command that fails or times out stops
+    the rest: running commands are killed (cancelled) and the ones not
+    started yet are skipped. Otherwise all commands are run.
+    
+    If raise_errors is true, an error like that of run_cmd is raised for
+    the first command that failed, after all have ended. When cancel_event
+    is set, running commands are killed and the rest skipped.
+    '''
+    runs = []
+    for cmd in cmds:
+        args = {'shell': shell, 'timeout': timeout, 'max_output': max_output}
+        args.update(cmd if isinstance(cmd, dict) else {'cmd': cmd})
+        # Set by run_many for every command
+        args.pop('raise_errors', None)
+        args.pop('cancel_event', None)
+        runs.append(args)
+    if not runs:
+        return []
+    max_workers = max(1, min(max_workers or os.cpu_count() or 1, len(runs)))
+    results = [None] * len(runs)
+    failures = []
+    stop = threading.Event()
+    def run(index):
+        args = runs[index]
+        if stop.is_set():
+            result = _result(args['cmd'], output='Skipped', skipped=True)
+            results[index] = result
+            return result
+        name = instrumentation.command_name(args['cmd'])
+        try:
+            with instrumentation.timer('run_cmd.' + name):
+                result = processExe(raise_errors=False, cancel_event=stop,
+                                    **args).run()
+        except OSError as e:
+            # E.g. the program of a command without shell doesn't exist
+            result = _result(args['cmd'], output=str(e), erred=True)
+        result['skipped'] = False
+        results[index] = result
+        return result
+    with instrumentation.timer('run_many'):
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = set(executor.submit(run, index) 
+                          for index in range(len(runs)))
+            while pending:
+                done, pending = futures.wait(
+                    pending, timeout=None if cancel_event is None else 1,
+                    return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    if result['erred'] or result['timedout']:
+                        failures.append(result)
+                        if fail_fast:
+                            stop.set()
+                if cancel_event is not None and cancel_event.is_set():
+                    stop.set()
+    if raise_errors and failures:
+        raise _run_error(failures[0], len(failures), len(runs))
+    if raise_errors and cancel_event is not None and cancel_event.is_set():
+        msg = 'Commands cancelled: {0} of {1} had ended.'
+        msg = msg.format(len([r for r in results if not (r['cancelled'] or 
+                                                         r['skipped'])]),
+                         len(runs))
+        raise CancelledError(msg)
+    return results
+
+def _run_error(result, failed, total):
+    '''
+    Return the error for the failed result of run_many
+    '''
+    msg = '{0} of {1} commands failed. First: '.format(failed, total)
+    if result['timedout']:
+        return TimeoutError(msg + result['output'])
+    if result['returncode'] is None:
+        return IOError(msg + result['output'])
+    err = 'Process "{0}" failed with error code {1}. Process output was: {2}.'
+    err = err.format(result['cmd'],result['returncode'],result['output'])
+    return IOError(msg + err)
 
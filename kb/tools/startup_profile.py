@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+'''
+Timing of the start of a step, to see where a short step spends its time
+before step() is run: starting python, importing modules, reading the
+command line and config files and setting up logging and Goobi.
+
+Run a step with profile_startup=true on its command line to print the
+phases, e.g.
+
+    Startup of count image files (process 123):
+      process start -> import goobi_step        41.2 ms
+      imports                                   38.5 ms
+      setup                                      0.1 ms
+      ...
+      total                                    102.6 ms (214 modules)
+
+The time from process start is read from /proc and is left out where that
+isn't available.
+'''
+import os
+import sys
+import time
+
+
+def process_age():
+    '''
+    Return seconds since this process was started, or None if unknown.
+    '''
+    try:
+        with open('/proc/self/stat') as stat_file:
+            stat = stat_file.read()
+        with open('/proc/uptime') as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+        # The process name in brackets may contain spaces - fields after it
+        # are counted from the closing bracket. starttime is field 22.
+        fields = stat[stat.rindex(')') + 2:].split()
+        started = int(fields[19]) / float(os.sysconf('SC_CLK_TCK'))
+        return max(uptime - started, 0.0)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupProfile(object):
+    '''
+    Phases of the start of a step, each marked when it ends.
+    '''
+    def __init__(self, started):
+        '''
+        :param started: time.perf_counter() when the first phase started
+        '''
+        self.started = started
+        self.last = started
+        self.phases = []
+        age = process_age()
+        if age is not None:
+            # process_age has a resolution of 1/100 s - good enough to
+            # show the time spent starting python
+            now = time.perf_counter()
+            before = max(age - (now - started), 0.0)
+            self.phases.append(('process start -> import goobi_step', before))
+
+    def mark(self, phase):
+        '''
+        End phase (and start the next one).
+        '''
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def total(self):
+        return sum(seconds for _, seconds in self.phases)
+
+    def report(self, title):
+        '''
+        Return the phases as text.
+        '''
+        lines = ['Startup of {0}:'.format(title)]
+        for phase, seconds in self.phases:
+            lines.append('  {0:<40}{1:>8.1f} ms'.format(phase, seconds*1000))
+        total = '  {0:<40}{1:>8.1f} ms ({2} modules)'
+        lines.append(total.format('total', self.total()*1000, len(sys.modules)))
+        return '\n'.join(lines)
@@ -9,14 +9,19 @@ Created on 26/03/2014
 
 
 import os
-import subprocess
-import csv
 import time
-import shutil
 
 # Import from tools - same package
 from tools import errors
-import hashlib
+from tools.filesystem import dir_index
+from tools import instrumentation
+from tools.lazy_import import lazy_module
+
+# Only used by some of the functions below - imported when first used
+subprocess = lazy_module('subprocess')
+csv = lazy_module('csv')
+shutil = lazy_module('shutil')
+hashlib = lazy_module('hashlib')
 
 def find_or_create_dir(path,change_owner=None):
     '''
@@ -192,8 +197,7 @@ def getFileCountWithExtension(input_files_dir,valid_exts):
     Return the number of files in 'input_files_dir' with the the valid extension
     as defined in the list 'valid_exts'
     '''
-    return len([f for f in os.listdir(input_files_dir)
-                if os.path.splitext(f)[1].lstrip('.') in valid_exts])
+    return dir_index.countWithExtension(input_files_dir, valid_exts)
 
 def getFirstFileWithExtension(dir, ext):
     '''
@@ -201,8 +205,8 @@ def getFirstFileWithExtension(dir, ext):
     with the given extension.
     Useful when we don't know the file name
     '''
-    for file in os.listdir(dir):
-        if file.endswith(ext): return file
+    file = dir_index.firstWithExtension(dir, ext)
+    if file is not None: return file
     # if file not found    
     raise IOError(1, "No file with ext {0} found in dir {1}".format(ext, dir))
 
@@ -342,6 +346,7 @@ def pdfinfo(infile):
  
     return output
 
+@instrumentation.timed('copy_files')
 def copy_files(source, dest, transit=None, delete_original=False, wait_interval=60,
                max_retries=5, logger=None, change_owner=None, valid_exts=None):
     """
@@ -404,7 +409,8 @@ def copy_files(source, dest, transit=None, delete_original=False, wait_interval=
                         if logger: 
                             msg = "Copying file {0}".format(src_file[0])
                             logger.debug(msg)
-                        shutil.copy2(src_file[0], dest_dir)
+                        with instrumentation.timer('copy_files.file'):
+                            shutil.copy2(src_file[0], dest_dir)
                         if change_owner is not None:
                             # Change the owner of the file to "change_owner" (an integer)
                             # and set the correct rights for the file
@@ -439,6 +445,7 @@ def copy_files(source, dest, transit=None, delete_original=False, wait_interval=
                        'seconds. This is the {2} attempt.')
                 msg = msg.format(files_left,retry_in,attempts)
                 logger.debug(msg)
+            instrumentation.count('copy_files.retries')
             time.sleep(wait_interval)
     if files_not_copied:
         files_left = len([e for e in src_files if not e[1]])
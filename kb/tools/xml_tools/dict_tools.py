@@ -7,6 +7,7 @@ Created on 19/08/2014
 @author: jeel
 '''
 from tools.xml_tools import xml_tools
+from tools import instrumentation
 
 def decodeDictTree(dict_tree,encoding='UTF-8'):
     '''
@@ -34,6 +35,7 @@ def decodeDictTree(dict_tree,encoding='UTF-8'):
                 dict_tree[key] = decodeDictTree(dict_tree[key],encoding)
     return dict_tree
 
+@instrumentation.timed('xml.parseXmlToDict')
 def parseXmlToDict(xml_file):
     '''
     Returns a dictionary tree from a XML file
@@ -7,11 +7,16 @@ Created on 08/07/2014
 @author: jeel
 '''
 from collections import defaultdict
-from xml.etree import ElementTree as ET
 import sys
 import pprint
 import codecs
 
+from tools import instrumentation
+from tools.lazy_import import lazy_module
+
+# Only needed when xml is written or parsed
+ET = lazy_module('xml.etree.ElementTree')
+
 def getSubTree(dict_tree,ns=None, elem_name=None,elem_attrib_key=None,
                elem_attrib_val=None):
     '''
@@ -200,6 +205,7 @@ def etree_to_dict(t):
             d[t.tag] = text
     return d
 
+@instrumentation.timed('xml.writeDictTreeToFile')
 def writeDictTreeToFile(dict_tree,dest):
     etree = dict_to_etree(dict_tree)
     etree.write(dest)
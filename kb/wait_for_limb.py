@@ -4,7 +4,7 @@
 from goobi.goobi_step import Step
 import tools.tools as tools
 import tools.limb as limb_tools
-import os, time
+import os
 
 class WaitForLimb( Step ):
 
@@ -69,7 +69,6 @@ class WaitForLimb( Step ):
         previous step before exiting.
         '''
         error = None
-        retry_counter = 0
         try:
             self.getVariables()
             # First check if files already have been copied to goobi
@@ -78,20 +77,17 @@ class WaitForLimb( Step ):
                                         self.input_files,self.goobi_altos,
                                           self.valid_exts)):
                 return error
-            # keep on retrying for the given number of attempts
-            while retry_counter < self.retry_num:
-                
-                if self.limbIsReady():
-                    msg = ('LIMB output is ready - exiting.')
-                    self.debug_message(msg)
-                    return None # this is the only successful exit possible
-                else:
-                    # if they haven't arrived, sit and wait for a while
-                    msg = ('LIMB output not ready - sleeping for {0} seconds...')
-                    msg = msg.format(self.retry_wait)
-                    self.debug_message(msg)
-                    retry_counter += 1
-                    time.sleep(self.retry_wait)
+            # keep on polling until the deadline given by retry_wait*retry_num
+            page_count = None
+            if os.path.isdir(self.input_files):
+                page_count = tools.getFileCountWithExtension(self.input_files,
+                                                             self.valid_exts)
+            policy = self.getPollingPolicy(self.retry_wait, self.retry_num,
+                                           page_count=page_count)
+            if policy.wait(self.limbIsReady, log=self.debug_message):
+                msg = ('LIMB output is ready - exiting.')
+                self.debug_message(msg)
+                return None # this is the only successful exit possible
         except IOError as e:
             # if we get an IO error we need to crash
             error = ('Error reading from directory {0}')
@@ -124,7 +120,8 @@ class WaitForLimb( Step ):
             return False
         if limb_tools.tocExists(self.toc_dir):
             return True
-        if limb_tools.altoFileCountMatches(self.alto_dir, self.input_files):
+        if limb_tools.altoFileCountMatches(self.alto_dir, self.input_files,
+                                           self.valid_exts):
             return True
         return False
 
@@ -4,7 +4,7 @@
 from goobi.goobi_step import Step
 import tools.tools as tools
 import tools.limb as limb_tools
-import os, time
+import os
 from tools.filesystem import fs
 
 class WaitForOcr( Step ):
@@ -59,20 +59,20 @@ class WaitForOcr( Step ):
     def waitForOcr(self):
         '''
         Wait for the PDF-file on the OCR-server is ready.
+        The wait is driven by a polling policy, so the first check is done
+        at once and the following checks are placed around the time the OCR
+        job is expected to be done, given its page count.
         '''
-        retry_counter = 0
-        while retry_counter < self.retry_num:
-            if self.ocrIsReady():
-                msg = ('ocr output is ready - exiting.')
-                self.debug_message(msg)
-                return None # this is the only successful exit possible
-            else:
-                # if they haven't arrived, sit and wait for a while
-                msg = ('ocr output not ready - sleeping for {0} seconds...')
-                msg = msg.format(self.retry_wait)
-                self.debug_message(msg)
-                retry_counter += 1
-                time.sleep(self.retry_wait)
+        page_count = None
+        if os.path.isdir(self.input_files):
+            page_count = tools.getFileCountWithExtension(self.input_files,
+                                                         self.valid_exts)
+        policy = self.getPollingPolicy(self.retry_wait, self.retry_num,
+                                       page_count=page_count)
+        if policy.wait(self.ocrIsReady, log=self.debug_message):
+            msg = ('ocr output is ready - exiting.')
+            self.debug_message(msg)
+            return None # this is the only successful exit possible
         return "Timed out waiting for ocr output."
 
     def getVariables(self):